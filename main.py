@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 """
-Universal Downloader Bot (Railway-ready, python-telegram-bot v20+)
+Universal Downloader Bot (Railway-ready, python-telegram-bot v21.5+)
 
 Asosiy imkoniyatlar:
 - YouTube: faqat MAVJUD formatlar tugmalari chiqadi (144p/360p/720p... mavjud bo'lsa bor).
@@ -25,6 +25,25 @@ Railway/Cloud учун:
   WEBHOOK_PATH       (ixtiyoriy) default: webhook
   PORT               (webhook режимда платформа беради: Railway ва бошқалар)
   DATA_DIR           (fallback json storage uchun; cloud серверда тавсия этилмайди)
+  BOT_ROLE           (ixtiyoriy) all (default) | front | worker
+                     front  — update qabul qiladi, download job'larni Postgres navbatiga qo‘yadi
+                     worker — navbatdan job olib yuklaydi va yuboradi (N ta jarayon/node bo‘lishi mumkin)
+                     front/worker uchun DATABASE_URL majburiy (file_id va callback keshi ham DB orqali umumiy)
+  LOCAL_BOT_API_URL  (ixtiyoriy) Local Bot API server (katta fayllar uchun)
+  LOCAL_BOT_API_FILES_DIR / LOCAL_BOT_API_SERVER_DIR — server `--local` rejimida umumiy volume:
+                     fayl baytlari yuborilmaydi, faqat file:// yo‘li (WORK_DIR shu volume'da bo‘lsa — hardlink)
+  WORK_DIR           (ixtiyoriy) job'lar uchun vaqtinchalik papkalar ildizi (default: tizim temp)
+                     DISK_RESERVE_FACTOR / DISK_MIN_FREE_MB — diskda joy yetmasa job kutadi
+  TG_CONTROL_POOL / TG_UPLOAD_POOL / TG_*_TIMEOUT / TG_HTTP2 — Telegram HTTP pool'lari (getUpdates, tezkor
+                     chaqiruvlar va upload'lar alohida)
+  UPDATE_CONCURRENCY (ixtiyoriy) parallel qayta ishlanadigan update'lar soni (chat ichida tartib saqlanadi)
+  TG_RATE_GLOBAL     (ixtiyoriy) chiquvchi chaqiruvlar limiti (default 30/s; TG_RATE_CHAT / TG_RATE_GROUP_PER_MIN)
+  BACKLOG_MAX_AGE    (ixtiyoriy) restartdan keyin shundan eski (soniya) xabarlar bajarilmaydi (default 600)
+  JOB_EXTRACT_TIMEOUT / JOB_DOWNLOAD_TIMEOUT / JOB_FFMPEG_TIMEOUT / JOB_LOCAL_API_TIMEOUT — bosqich
+                     muddatlari (soniya); ishlar alohida jarayonda bajariladi va muddat o‘tsa o‘ldiriladi
+                     (KILLABLE_WORKERS=0 — o‘chirish)
+  UL_RETRIES         (ixtiyoriy) Telegram'ga upload urinishlari (backoff + jitter, RetryAfter hisobga olinadi);
+                     yuborilmagan fayl UPLOAD_RETRY_TTL soniya saqlanadi — qayta bosilganda qayta yuklanmaydi
 
 Eslatma:
 - MP3 konvertatsiya uchun ffmpeg tavsiya qilinadi. Bo'lmasa m4a/webm audio yuboriladi.
@@ -45,24 +64,40 @@ import asyncio
 import logging
 import tempfile
 import shutil
+import glob
 import secrets
+import random
 import time
 import base64
+import hashlib
+import hmac
+import heapq
+import struct
 import html
+import socket
+import sys
+import threading
+import multiprocessing
+import pickle
+import signal
 import subprocess
 import zipfile
 import urllib.request
 import urllib.error
 from urllib.parse import urlsplit, urlunsplit, urlparse
+from collections import OrderedDict
 from pathlib import Path
 from typing import Dict, Any, Optional, Tuple, List
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, User
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Message, User
 from telegram.constants import ParseMode
-from telegram.request import HTTPXRequest
-from telegram.error import TimedOut
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
+from telegram.error import TimedOut, NetworkError, RetryAfter, BadRequest, Forbidden, ChatMigrated, InvalidToken
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    CallbackContext,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -71,6 +106,7 @@ from telegram.ext import (
 )
 
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadCancelled
 
 try:
     import asyncpg
@@ -104,20 +140,64 @@ DATABASE_URL = (os.getenv("DATABASE_URL") or "").strip()
 
 BOT_USERNAME_TAG = "@universal_downloader_uzb_bot"
 
-CALLBACK_CACHE: Dict[str, Dict[str, Any]] = {}
-CALLBACK_CACHE_MAX = 3000
+# Inline tugmalar payload keshi (LRU + TTL). Bitta link -> bitta request yozuvi, har tugma faqat token.
+CALLBACK_CACHE_MAX = int((os.getenv("CALLBACK_CACHE_MAX") or "20000").strip() or "20000")
+CALLBACK_TTL_HOURS = int((os.getenv("CALLBACK_TTL_HOURS") or "48").strip() or "48")
+CALLBACK_TTL_SECONDS = max(1, CALLBACK_TTL_HOURS) * 60 * 60
+
+# Imzolangan (stateless) callback tokenlar uchun kalit. Berilmasa BOT_TOKEN'dan hosil qilinadi —
+# shunda restart/redeploy va bir nechta replika bir xil tokenlarni taniydi.
+CALLBACK_SECRET = hashlib.sha256(
+    ((os.getenv("CALLBACK_SECRET") or "").strip() or f"cb:{TOKEN}").encode("utf-8")
+).digest()
 
 
 # Telegram стандарт Bot API'да файл юклаш чегараси (одатда ~50MB).
 # Local Bot API server ишлатсангиз, бу чекловни каттароқ қила оласиз.
 TG_MAX_UPLOAD_MB = int((os.getenv("TG_MAX_UPLOAD_MB") or ("1900" if (os.getenv("LOCAL_BOT_API_URL") or "").strip() else "49")).strip() or "49")
 
+# Local Bot API server `--local` rejimida: tayyor fayl umumiy volume'ga qo‘yiladi va serverga faqat
+# file:// yo‘li yuboriladi (baytlar HTTP orqali yuklanmaydi). LOCAL_BOT_API_FILES_DIR — volume bot konteynerida,
+# LOCAL_BOT_API_SERVER_DIR — xuddi shu volume bot-api server konteynerida (bir xil bo‘lsa berish shart emas).
+LOCAL_BOT_API_FILES_DIR = (os.getenv("LOCAL_BOT_API_FILES_DIR") or "").strip()
+LOCAL_BOT_API_SERVER_DIR = (os.getenv("LOCAL_BOT_API_SERVER_DIR") or LOCAL_BOT_API_FILES_DIR).strip()
+LOCAL_API_ZERO_COPY = bool((os.getenv("LOCAL_BOT_API_URL") or "").strip() and LOCAL_BOT_API_FILES_DIR)
+
 # YouTube format tanlashda maksimal ruxsat etilgan hajm (MB). Katta bo'lsa — formatni tanlashga qo'ymaymiz.
 DL_MAX_MB = int((os.getenv("DL_MAX_MB") or "130").strip() or "130")
 
 # YouTube format tanlashda maksimal ruxsat etilgan hajm (MB). Katta bo'lsa — formatni tanlashga qo'ymaymiz.
 YT_MAX_MB = int((os.getenv("YT_MAX_MB") or str(DL_MAX_MB)).strip() or str(DL_MAX_MB))
 
+# Job'lar uchun vaqtinchalik papkalar ildizi (dlbot_*). Katta diskka yo‘naltirish mumkin, masalan WORK_DIR=/data/work
+WORK_ROOT = Path((os.getenv("WORK_DIR") or tempfile.gettempdir())).resolve()
+# Disk admission: har bir job uchun (taxminiy hajm × factor) joy band qilinadi; sig‘masa job kutadi.
+# merge/remux paytida fayl 2–3 nusxada turadi, shuning uchun default 3.
+DISK_RESERVE_FACTOR = float((os.getenv("DISK_RESERVE_FACTOR") or "3").strip() or "3")
+# Audio job'lar uchun taxminiy hajm (MB): menyuda hajm yo‘q, DL_MAX_MB esa video uchun eng yomon holat
+DISK_AUDIO_EST_MB = int((os.getenv("DISK_AUDIO_EST_MB") or "30").strip() or "30")
+# Doim bo‘sh qolishi kerak bo‘lgan joy (MB)
+DISK_MIN_FREE_MB = int((os.getenv("DISK_MIN_FREE_MB") or "512").strip() or "512")
+# Joy bo‘shashini maksimal kutish (sekund), keyin foydalanuvchiga "server band" deymiz
+DISK_WAIT_SECONDS = int((os.getenv("DISK_WAIT_SECONDS") or "600").strip() or "600")
+
+# Platforma profillarini o‘lchangan o‘tkazuvchanlik bo‘yicha avtomatik sozlash (concurrent_fragment_downloads)
+DL_PROFILE_LEARN = (os.getenv("DL_PROFILE_LEARN") or "0").strip() in ("1", "true", "yes")
+
+# Circuit breaker: tarmoq (platforma + proxy/cookie) ketma-ket shuncha marta bloklasa (403/429/bot-check),
+# BREAKER_OPEN_SECONDS davomida so‘rovlar darhol rad etiladi; keyin bitta sinov so‘rovi (half-open).
+BREAKER_THRESHOLD = int((os.getenv("BREAKER_THRESHOLD") or "3").strip() or "3")
+BREAKER_OPEN_SECONDS = int((os.getenv("BREAKER_OPEN_SECONDS") or "120").strip() or "120")
+BREAKER_MAX_OPEN_SECONDS = int((os.getenv("BREAKER_MAX_OPEN_SECONDS") or "1800").strip() or "1800")
+
+# Yuklashdan oldin hajmni rejalash: tanlangan format limitdan (min(DL_MAX_MB, TG_MAX_UPLOAD_MB)) katta bo‘lsa,
+# sig‘adigan eng yaxshi pastroq sifat avtomatik tanlanadi. 0 — eski xulq (faqat yuklab bo‘lgandan keyin tekshirish).
+VIDEO_SIZE_FALLBACK = (os.getenv("VIDEO_SIZE_FALLBACK") or "1").strip() not in ("0", "false", "no")
+# Hajmi noma'lum formatlar uchun nechta Content-Length (HEAD) so‘rovi yuborish mumkin
+VIDEO_SIZE_PROBES = int((os.getenv("VIDEO_SIZE_PROBES") or "4").strip() or "4")
+# Hech bir format sig‘masa: "reject" (default) — rad etamiz; "reencode" — eng kichigini yuklab, limitga sig‘adigan bitreytda qayta kodlaymiz
+OVERSIZE_MODE = (os.getenv("OVERSIZE_MODE") or "reject").strip().lower()
+
 # YouTube видеолар учун Telegram file_id кеш (RAM). Шу орқали такрорий сўровларда 1 секундда юборилади.
 YOUTUBE_FILEID_CACHE: Dict[str, tuple[str, float]] = {}
 YOUTUBE_FILEID_CACHE_MAX = 5000
@@ -126,9 +206,100 @@ YOUTUBE_FILEID_CACHE_MAX = 5000
 FILEID_CACHE: Dict[str, tuple[str, float]] = {}
 FILEID_CACHE_MAX = 15000
 
-# Download concurrency (RAM/CPU ni tejash uchun): default 2 ta parallel download/merge
+# Download concurrency (RAM/CPU ni tejash uchun): boshlang‘ich qiymat 2 ta parallel download/merge.
+# DL_ADAPTIVE=1 (default) bo‘lsa, slotlar soni [DL_MIN_CONCURRENCY, DL_MAX_CONCURRENCY] oralig‘ida
+# o‘tkazuvchanlik, CPU load, bo‘sh RAM va 429 xatolarga qarab avtomatik o‘zgaradi (AIMD).
 DL_CONCURRENCY = int((os.getenv("DL_CONCURRENCY") or "2").strip() or "2")
-DOWNLOAD_SEM = asyncio.Semaphore(max(1, DL_CONCURRENCY))
+# Telegram'ga bir vaqtda yuklanadigan fayllar soni (download slotlaridan alohida bosqich)
+UL_CONCURRENCY = int((os.getenv("UL_CONCURRENCY") or "3").strip() or "3")
+UPLOAD_SEM = asyncio.Semaphore(max(1, UL_CONCURRENCY))
+# Upload xatolari: vaqtinchalik (tarmoq/timeout/flood) xatolar UL_RETRIES marta exponential backoff + jitter bilan
+# qayta uriniladi (UL_BACKOFF_BASE * 2^n, UL_BACKOFF_MAX gacha). RetryAfter — Telegram aytgan vaqt kutiladi
+# (UL_RETRY_AFTER_MAX dan uzun bo‘lsa kutmaymiz). Baribir yuborilmasa fayl UPLOAD_RETRY_TTL soniya saqlanadi.
+UL_RETRIES = int((os.getenv("UL_RETRIES") or "4").strip() or "4")
+UL_BACKOFF_BASE = float((os.getenv("UL_BACKOFF_BASE") or "2").strip() or "2")
+UL_BACKOFF_MAX = float((os.getenv("UL_BACKOFF_MAX") or "60").strip() or "60")
+UL_RETRY_AFTER_MAX = int((os.getenv("UL_RETRY_AFTER_MAX") or "300").strip() or "300")
+UPLOAD_RETRY_TTL = int((os.getenv("UPLOAD_RETRY_TTL") or "1800").strip() or "1800")
+UPLOAD_RETRY_MAX_GB = float((os.getenv("UPLOAD_RETRY_MAX_GB") or "2").strip() or "2")
+# Telegram HTTP klientlari alohida pool'larda: getUpdates / tezkor chaqiruvlar (answerCallbackQuery, deleteMessage...) /
+# media upload. Uzoq upload'lar ulanishlarni band qilsa ham tugma javoblari navbat kutmaydi.
+TG_CONNECT_TIMEOUT = float((os.getenv("TG_CONNECT_TIMEOUT") or "30").strip() or "30")
+TG_CONTROL_POOL = int((os.getenv("TG_CONTROL_POOL") or "32").strip() or "32")
+TG_CONTROL_TIMEOUT = float((os.getenv("TG_CONTROL_TIMEOUT") or "30").strip() or "30")
+TG_UPLOAD_POOL = int((os.getenv("TG_UPLOAD_POOL") or str(max(1, UL_CONCURRENCY) + 2)).strip() or "5")
+TG_UPLOAD_TIMEOUT = float((os.getenv("TG_UPLOAD_TIMEOUT") or "900").strip() or "900")
+TG_UPDATES_TIMEOUT = float((os.getenv("TG_UPDATES_TIMEOUT") or "30").strip() or "30")
+# HTTP/2 (getUpdates va tezkor chaqiruvlar uchun; bitta ulanishda multiplex). `pip install httpx[http2]` kerak.
+# Upload'lar doim HTTP/1.1 — har biri o‘z ulanishida, bir-birining oqimini to‘smaydi.
+TG_HTTP2 = (os.getenv("TG_HTTP2") or "0").strip() in ("1", "true", "yes")
+# Update'lar parallel qayta ishlanadi (bir vaqtda ko‘pi bilan UPDATE_CONCURRENCY ta), lekin bitta chat ichida
+# kelgan tartibda — foydalanuvchining linki va tugma bosishi almashib ketmaydi. 1 — eski, ketma-ket rejim.
+UPDATE_CONCURRENCY = int((os.getenv("UPDATE_CONCURRENCY") or "32").strip() or "32")
+# Chiquvchi Bot API chaqiruvlari uchun umumiy limiter (Telegram flood limitlari): sekundiga TG_RATE_GLOBAL ta,
+# bitta shaxsiy chatga TG_RATE_CHAT/s (TG_RATE_CHAT_BURST gacha ketma-ket), guruhga TG_RATE_GROUP_PER_MIN/daqiqa.
+# Tugma javoblari birinchi, broadcast oxirida. Limit har bir jarayon uchun — front + N worker bo‘lsa kamaytiring.
+# TG_RATE_GLOBAL=0 — limiter o‘chiriladi.
+TG_RATE_GLOBAL = float((os.getenv("TG_RATE_GLOBAL") or "30").strip() or "30")
+TG_RATE_CHAT = float((os.getenv("TG_RATE_CHAT") or "1").strip() or "1")
+TG_RATE_CHAT_BURST = int((os.getenv("TG_RATE_CHAT_BURST") or "3").strip() or "3")
+TG_RATE_GROUP_PER_MIN = float((os.getenv("TG_RATE_GROUP_PER_MIN") or "20").strip() or "20")
+TG_RATE_RETRIES = int((os.getenv("TG_RATE_RETRIES") or "3").strip() or "3")
+# Qayta ishga tushgandan keyin to‘planib qolgan update'lar: BACKLOG_MAX_AGE soniyadan eski xabarlar uzr bilan
+# tashlanadi, bir chatdagi bir xil linklar bittaga qisqartiriladi, tugma bosishlari birinchi bajariladi.
+BACKLOG_TRIAGE = (os.getenv("BACKLOG_TRIAGE") or "1").strip() not in ("0", "false", "no")
+BACKLOG_MAX_AGE = int((os.getenv("BACKLOG_MAX_AGE") or "600").strip() or "600")
+BACKLOG_MAX = int((os.getenv("BACKLOG_MAX") or "5000").strip() or "5000")
+# yt-dlp / ffmpeg / gallery-dl ishlari alohida (o‘ldirsa bo‘ladigan) jarayonda, har bosqichga muddat bilan.
+# Osilib qolgan fragment yoki tugamaydigan JS challenge slot va thread'ni abadiy band qilmaydi.
+# KILLABLE_WORKERS=0 — eski rejim (executor thread, muddatsiz).
+KILLABLE_WORKERS = (os.getenv("KILLABLE_WORKERS") or "1").strip() not in ("0", "false", "no")
+JOB_EXTRACT_TIMEOUT = int((os.getenv("JOB_EXTRACT_TIMEOUT") or "120").strip() or "120")
+JOB_DOWNLOAD_TIMEOUT = int((os.getenv("JOB_DOWNLOAD_TIMEOUT") or "1800").strip() or "1800")
+JOB_FFMPEG_TIMEOUT = int((os.getenv("JOB_FFMPEG_TIMEOUT") or "1800").strip() or "1800")
+# Local Bot API volume'ga hardlink/ko‘chirish (tarmoq disk osilib qolsa — oddiy HTTP upload)
+JOB_LOCAL_API_TIMEOUT = int((os.getenv("JOB_LOCAL_API_TIMEOUT") or "300").strip() or "300")
+DL_ADAPTIVE = (os.getenv("DL_ADAPTIVE") or "1").strip() not in ("0", "false", "no")
+DL_MIN_CONCURRENCY = int((os.getenv("DL_MIN_CONCURRENCY") or "1").strip() or "1")
+DL_MAX_CONCURRENCY = int((os.getenv("DL_MAX_CONCURRENCY") or str(max(8, DL_CONCURRENCY))).strip() or "8")
+DL_ADAPT_INTERVAL = int((os.getenv("DL_ADAPT_INTERVAL") or "30").strip() or "30")
+# 1 daqiqalik loadavg / CPU soni shundan oshsa — slotlarni kamaytiramiz
+DL_ADAPT_MAX_LOAD = float((os.getenv("DL_ADAPT_MAX_LOAD") or "1.5").strip() or "1.5")
+# Bo‘sh RAM (cgroup limiti hisobga olinadi) shundan kam bo‘lsa — slotlarni kamaytiramiz
+DL_ADAPT_MIN_MEM_MB = int((os.getenv("DL_ADAPT_MIN_MEM_MB") or "300").strip() or "300")
+
+# Lokal disk media kesh (ixtiyoriy): tayyor fayllarni DATA_DIR/media_cache'da saqlaydi (LRU, bayt bo‘yicha).
+# 0 — o‘chirilgan. Masalan: MEDIA_CACHE_MAX_GB=5
+MEDIA_CACHE_MAX_GB = float((os.getenv("MEDIA_CACHE_MAX_GB") or "0").strip() or "0")
+MEDIA_CACHE_DIR = Path((os.getenv("MEDIA_CACHE_DIR") or str(DATA_DIR / "media_cache"))).resolve()
+
+# Video yetkazish: "strict" (default) — H.264/AAC bo‘lmagan hamma narsani transcode qiladi (VP9/AV1/HEVC/Opus
+# mp4 ichida ham ko‘p Telegram klientlarida ijro etilmaydi); "copy" — kodeklar mp4'ga sig‘sa faqat remux
+# (stream copy), aks holda transcode — CPU tejaydi, lekin ba'zi klientlarda video ochilmasligi mumkin.
+VIDEO_COMPAT = (os.getenv("VIDEO_COMPAT") or "strict").strip().lower()
+VIDEO_TRANSCODE_PRESET = (os.getenv("VIDEO_TRANSCODE_PRESET") or "veryfast").strip()
+VIDEO_TRANSCODE_CRF = int((os.getenv("VIDEO_TRANSCODE_CRF") or "23").strip() or "23")
+VIDEO_TRANSCODE_THREADS = int((os.getenv("VIDEO_TRANSCODE_THREADS") or "2").strip() or "2")
+# Audio yetkazish: "mp3" (default) — har doim MP3; "auto" — m4a/AAC va mp3 manbani qayta kodlamasdan yuboradi
+# (Telegram sendAudio ikkalasini ham o‘ynaydi), faqat opus/vorbis va h.k. MP3 ga kodlanadi.
+AUDIO_DELIVERY = (os.getenv("AUDIO_DELIVERY") or "mp3").strip().lower()
+AUDIO_MP3_BITRATE = (os.getenv("AUDIO_MP3_BITRATE") or "192k").strip()
+
+# Bir vaqtda ishlaydigan og‘ir ffmpeg (transcode/encode) jarayonlari soni
+FFMPEG_CONCURRENCY = int((os.getenv("FFMPEG_CONCURRENCY") or "1").strip() or "1")
+FFMPEG_SEM = asyncio.Semaphore(max(1, FFMPEG_CONCURRENCY))
+
+# Horizontal scaling: bitta front (update qabul qiladi) + N ta worker (Postgres job navbati orqali).
+BOT_ROLE = (os.getenv("BOT_ROLE") or "all").strip().lower()
+if BOT_ROLE not in ("all", "front", "worker"):
+    BOT_ROLE = "all"
+WORKER_ID = (os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}").strip()
+JOB_POLL_SECONDS = float((os.getenv("JOB_POLL_SECONDS") or "1").strip() or "1")
+# Worker yiqilsa, "running" job shu vaqtdan keyin boshqa workerga qaytariladi (heartbeat bilan yangilanadi)
+JOB_LEASE_SECONDS = int((os.getenv("JOB_LEASE_SECONDS") or "300").strip() or "300")
+# worker DB'dan ❌ bilan bekor qilingan job'larni shu oraliqda tekshiradi
+JOB_CANCEL_POLL_SECONDS = float((os.getenv("JOB_CANCEL_POLL_SECONDS") or "2").strip() or "2")
+JOB_MAX_ATTEMPTS = int((os.getenv("JOB_MAX_ATTEMPTS") or "3").strip() or "3")
 
 # file_id cache TTL (kun). Default: 180 kun (~6 oy)
 FILEID_TTL_DAYS = int((os.getenv("FILEID_TTL_DAYS") or "180").strip() or "180")
@@ -276,6 +447,14 @@ TEXT = {
         LANG_UZ: "Formatni tanlang (YouTube):",
         LANG_RU: "Выберите формат (YouTube):",
     },
+    "err_job_timeout": {
+        LANG_UZ: "⏱ {stage} juda uzoq cho‘zildi ({minutes} daqiqadan ko‘p) va to‘xtatildi. Keyinroq qayta urinib ko‘ring yoki boshqa format tanlang.",
+        LANG_RU: "⏱ {stage} длилось слишком долго (более {minutes} мин.) и было остановлено. Попробуйте позже или выберите другой формат.",
+    },
+    "backlog_expired": {
+        LANG_UZ: "⚠️ Bot qisqa vaqt ishlamay qoldi — {n} ta eski so‘rovingiz bajarilmadi. Iltimos, link yoki buyruqni qayta yuboring.",
+        LANG_RU: "⚠️ Бот ненадолго был недоступен — {n} старых запросов не выполнено. Пожалуйста, отправьте ссылку или команду ещё раз.",
+    },
     "btn_expired": {
         LANG_UZ: "❌ Bu tugma eskirib qolgan. Iltimos linkni qayta yuboring.",
         LANG_RU: "❌ Эта кнопка устарела. Пожалуйста, отправьте ссылку ещё раз.",
@@ -284,6 +463,22 @@ TEXT = {
         LANG_UZ: "❌ Bu havola qo‘llab-quvvatlanmaydi. Faqat YouTube, TikTok, Instagram, Facebook va OK.ru havolalarini yuboring.",
         LANG_RU: "❌ Эта ссылка не поддерживается. Отправляйте только ссылки YouTube, TikTok, Instagram, Facebook и OK.ru.",
     },
+    "btn_cancel": {
+        LANG_UZ: "❌ Bekor qilish",
+        LANG_RU: "❌ Отменить",
+    },
+    "job_cancelled": {
+        LANG_UZ: "❌ Yuklash bekor qilindi.",
+        LANG_RU: "❌ Загрузка отменена.",
+    },
+    "cancel_not_allowed": {
+        LANG_UZ: "Faqat so‘rov egasi bekor qila oladi.",
+        LANG_RU: "Отменить может только автор запроса.",
+    },
+    "cancel_too_late": {
+        LANG_UZ: "Bu yuklash allaqachon tugagan.",
+        LANG_RU: "Эта загрузка уже завершена.",
+    },
     "downloading_answer": {
         LANG_UZ: "⏳ Yuklab olinmoqda...",
         LANG_RU: "⏳ Скачиваю...",
@@ -296,6 +491,22 @@ TEXT = {
         LANG_UZ: "❌ Formatlarni olishda xatolik: {err}",
         LANG_RU: "❌ Ошибка при получении форматов: {err}",
     },
+    "err_platform_paused": {
+        LANG_UZ: "⚠️ {platform} hozircha serverimizga javob bermayapti (blok/limit). Taxminan {minutes} daqiqadan keyin qayta urinib ko‘ring.",
+        LANG_RU: "⚠️ {platform} сейчас не отвечает нашему серверу (блок/лимит). Попробуйте примерно через {minutes} мин.",
+    },
+    "err_disk_busy": {
+        LANG_UZ: "⏳ Server hozir band (disk joyi yetmayapti). Birozdan keyin qayta urinib ko‘ring.",
+        LANG_RU: "⏳ Сервер сейчас занят (не хватает места на диске). Попробуйте чуть позже.",
+    },
+    "err_upload_failed": {
+        LANG_UZ: "⚠️ Faylni Telegram'ga yuborib bo‘lmadi (tarmoq xatosi). Fayl {minutes} daqiqa saqlanadi — shu daqiqalarda qayta so‘rasangiz, qayta yuklanmasdan darhol yuboriladi.",
+        LANG_RU: "⚠️ Не удалось отправить файл в Telegram (сетевая ошибка). Файл сохранён на {minutes} мин. — если запросите его снова за это время, он отправится сразу, без повторного скачивания.",
+    },
+    "quality_fallback": {
+        LANG_UZ: "⏳ Tanlangan format limitdan katta ({max}MB) — {h}p (~{size}MB) yuklanmoqda...",
+        LANG_RU: "⏳ Выбранный формат больше лимита ({max}MB) — скачиваю {h}p (~{size}MB)...",
+    },
     "yt_too_big": {
         LANG_UZ: "⚠️ Bu format juda katta: {size}MB. Maksimal ruxsat etilgan: {max}MB. Iltimos, boshqa format tanlang.",
         LANG_RU: "⚠️ Этот формат слишком большой: {size}MB. Максимально разрешено: {max}MB. Пожалуйста, выберите другой формат.",
@@ -519,6 +730,42 @@ class UserStore:
             """
         )
         await self.pool.execute("CREATE INDEX IF NOT EXISTS bot_chats_last_seen_idx ON bot_chats(last_seen);")
+        # Umumiy (barcha replika/workerlar uchun) file_id va callback keshi
+        await self.pool.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bot_fileid_cache (
+              key        TEXT PRIMARY KEY,
+              file_id    TEXT NOT NULL,
+              expires_at TIMESTAMPTZ NOT NULL
+            );
+            """
+        )
+        await self.pool.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bot_callbacks (
+              token      TEXT PRIMARY KEY,
+              payload    JSONB NOT NULL,
+              expires_at TIMESTAMPTZ NOT NULL
+            );
+            """
+        )
+        await self.pool.execute("CREATE INDEX IF NOT EXISTS bot_callbacks_expires_idx ON bot_callbacks(expires_at);")
+        # Download job navbati (front -> worker). Olish: FOR UPDATE SKIP LOCKED
+        await self.pool.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bot_jobs (
+              id          BIGSERIAL PRIMARY KEY,
+              payload     JSONB NOT NULL,
+              status      TEXT NOT NULL DEFAULT 'queued',
+              attempts    INT NOT NULL DEFAULT 0,
+              worker      TEXT,
+              created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+              locked_at   TIMESTAMPTZ,
+              finished_at TIMESTAMPTZ
+            );
+            """
+        )
+        await self.pool.execute("CREATE INDEX IF NOT EXISTS bot_jobs_queued_idx ON bot_jobs(id) WHERE status = 'queued';")
         log.info("DB tayyor: bot_users jadvali tekshirildi/yaratildi.")
 
     async def close(self) -> None:
@@ -623,6 +870,199 @@ class UserStore:
         else:
             _add_group_json(cid)
 
+    # ---- shared file_id cache ----
+
+    async def get_fileid(self, key: str) -> Optional[str]:
+        if not self.pool or not key:
+            return None
+        try:
+            row = await self.pool.fetchrow(
+                "SELECT file_id FROM bot_fileid_cache WHERE key=$1 AND expires_at > NOW()", key
+            )
+            return (row["file_id"] if row else None)  # type: ignore[index]
+        except Exception:
+            return None
+
+    async def put_fileid(self, key: str, file_id: str, ttl_seconds: int) -> None:
+        if not self.pool or not key or not file_id:
+            return
+        try:
+            await self.pool.execute(
+                """
+                INSERT INTO bot_fileid_cache (key, file_id, expires_at)
+                VALUES ($1, $2, NOW() + make_interval(secs => $3))
+                ON CONFLICT (key) DO UPDATE SET
+                  file_id    = EXCLUDED.file_id,
+                  expires_at = EXCLUDED.expires_at;
+                """,
+                key,
+                file_id,
+                float(ttl_seconds),
+            )
+        except Exception:
+            pass
+
+    async def delete_fileid(self, key: str) -> None:
+        if not self.pool or not key:
+            return
+        try:
+            await self.pool.execute("DELETE FROM bot_fileid_cache WHERE key=$1", key)
+        except Exception:
+            pass
+
+    # ---- shared callback store (faqat imzolanmagan "dl|" tokenlar) ----
+
+    async def put_callback(self, token: str, payload: Dict[str, Any], ttl_seconds: float) -> None:
+        if not self.pool:
+            return
+        try:
+            await self.pool.execute(
+                """
+                INSERT INTO bot_callbacks (token, payload, expires_at)
+                VALUES ($1, $2::jsonb, NOW() + make_interval(secs => $3))
+                ON CONFLICT (token) DO UPDATE SET
+                  payload    = EXCLUDED.payload,
+                  expires_at = EXCLUDED.expires_at;
+                """,
+                token,
+                json.dumps(payload, ensure_ascii=False),
+                float(ttl_seconds),
+            )
+        except Exception:
+            pass
+
+    async def get_callback(self, token: str) -> Optional[Dict[str, Any]]:
+        if not self.pool:
+            return None
+        try:
+            row = await self.pool.fetchrow(
+                "SELECT payload FROM bot_callbacks WHERE token=$1 AND expires_at > NOW()", token
+            )
+        except Exception:
+            return None
+        if not row:
+            return None
+        try:
+            data = json.loads(row["payload"])  # type: ignore[index]
+        except Exception:
+            return None
+        return data if isinstance(data, dict) else None
+
+    # ---- job queue (front -> workers) ----
+
+    async def enqueue_job(self, payload: Dict[str, Any]) -> Optional[int]:
+        if not self.pool:
+            return None
+        try:
+            row = await self.pool.fetchrow(
+                "INSERT INTO bot_jobs (payload) VALUES ($1::jsonb) RETURNING id",
+                json.dumps(payload, ensure_ascii=False),
+            )
+            return int(row["id"]) if row else None  # type: ignore[index]
+        except Exception as e:
+            log.warning("Job navbatga qo‘yilmadi: %s", e)
+            return None
+
+    async def claim_job(self, worker: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Take the oldest queued job (FOR UPDATE SKIP LOCKED — workers never block each other)."""
+        if not self.pool:
+            return None
+        row = await self.pool.fetchrow(
+            """
+            UPDATE bot_jobs SET status='running', worker=$1, locked_at=NOW(), attempts=attempts+1
+            WHERE id = (
+              SELECT id FROM bot_jobs WHERE status='queued'
+              ORDER BY id
+              FOR UPDATE SKIP LOCKED
+              LIMIT 1
+            )
+            RETURNING id, payload;
+            """,
+            worker,
+        )
+        if not row:
+            return None
+        try:
+            payload = json.loads(row["payload"])  # type: ignore[index]
+        except Exception:
+            payload = {}
+        return int(row["id"]), (payload if isinstance(payload, dict) else {})  # type: ignore[index]
+
+    async def heartbeat_job(self, job_id: int) -> None:
+        if not self.pool:
+            return
+        try:
+            await self.pool.execute("UPDATE bot_jobs SET locked_at=NOW() WHERE id=$1 AND status='running'", job_id)
+        except Exception:
+            pass
+
+    async def finish_job(self, job_id: int, ok: bool) -> None:
+        if not self.pool:
+            return
+        try:
+            await self.pool.execute(
+                "UPDATE bot_jobs SET status=$2, finished_at=NOW() WHERE id=$1 AND status <> 'cancelled'",
+                job_id,
+                "done" if ok else "failed",
+            )
+        except Exception:
+            pass
+
+    async def cancel_job(self, cancel_id: str, requester_id: Optional[int]) -> bool:
+        """Mark a queued/running job cancelled (requester_id=None — admin, any owner)."""
+        if not self.pool or not cancel_id:
+            return False
+        try:
+            row = await self.pool.fetchrow(
+                """
+                UPDATE bot_jobs SET status='cancelled', finished_at=NOW()
+                WHERE payload->>'cancel_id' = $1 AND status IN ('queued','running')
+                  AND ($2::bigint IS NULL OR payload->>'requester_id' = $2::bigint::text)
+                RETURNING id;
+                """,
+                cancel_id,
+                requester_id,
+            )
+            return row is not None
+        except Exception as e:
+            log.warning("Job bekor qilinmadi: %s", e)
+            return False
+
+    async def cancelled_job_ids(self, job_ids: List[int]) -> List[int]:
+        if not self.pool or not job_ids:
+            return []
+        try:
+            rows = await self.pool.fetch(
+                "SELECT id FROM bot_jobs WHERE id = ANY($1::bigint[]) AND status='cancelled'", job_ids
+            )
+            return [int(r["id"]) for r in rows]
+        except Exception:
+            return []
+
+    async def requeue_stale_jobs(self, lease_seconds: int, max_attempts: int) -> int:
+        """Return crashed workers' jobs to the queue; also drop old finished jobs and expired callbacks."""
+        if not self.pool:
+            return 0
+        try:
+            res = await self.pool.execute(
+                """
+                UPDATE bot_jobs SET status = CASE WHEN attempts >= $2 THEN 'failed' ELSE 'queued' END,
+                                    worker = NULL
+                WHERE status='running' AND locked_at < NOW() - make_interval(secs => $1);
+                """,
+                float(lease_seconds),
+                int(max_attempts),
+            )
+            await self.pool.execute(
+                "DELETE FROM bot_jobs WHERE status IN ('done','failed','cancelled') AND finished_at < NOW() - INTERVAL '1 day'"
+            )
+            await self.pool.execute("DELETE FROM bot_callbacks WHERE expires_at < NOW()")
+            await self.pool.execute("DELETE FROM bot_fileid_cache WHERE expires_at < NOW()")
+            return int(str(res).split()[-1]) if res else 0
+        except Exception as e:
+            log.warning("Job navbatini tozalashda xato: %s", e)
+            return 0
+
     async def get_groups(self) -> List[int]:
         """Return known group/supergroup chat_ids (best-effort)."""
         if self.pool:
@@ -638,6 +1078,25 @@ class UserStore:
 STORE = UserStore()
 
 
+async def _fileid_lookup(cache: Dict[str, tuple[str, float]], key: str, max_items: int) -> Optional[str]:
+    """RAM cache first, then the shared DB cache (filled by other replicas/workers)."""
+    fid = _cache_get_fileid(cache, key)
+    if fid:
+        return fid
+    fid = await STORE.get_fileid(key)
+    if fid:
+        _cache_put_fileid(cache, key, fid, max_items)
+    return fid
+
+async def _fileid_remember(cache: Dict[str, tuple[str, float]], key: str, file_id: str, max_items: int) -> None:
+    _cache_put_fileid(cache, key, file_id, max_items)
+    await STORE.put_fileid(key, file_id, FILEID_TTL_SECONDS)
+
+async def _fileid_forget(cache: Dict[str, tuple[str, float]], key: str) -> None:
+    cache.pop(key, None)
+    await STORE.delete_fileid(key)
+
+
 async def get_user_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     """Lang priority: context.user_data -> DB/JSON -> default uz"""
     uid = update.effective_user.id if update.effective_user else None
@@ -715,6 +1174,20 @@ def is_okru(url: str) -> bool:
 def is_supported_url(url: str) -> bool:
     return is_youtube(url) or is_tiktok(url) or is_instagram(url) or is_facebook(url) or is_okru(url)
 
+def platform_of(url: str) -> str:
+    """Short platform key for per-platform tuning/stats: youtube|tiktok|instagram|facebook|okru|other."""
+    if is_youtube(url):
+        return "youtube"
+    if is_tiktok(url):
+        return "tiktok"
+    if is_instagram(url):
+        return "instagram"
+    if is_facebook(url):
+        return "facebook"
+    if is_okru(url):
+        return "okru"
+    return "other"
+
 def _normalize_url_for_cache(url: str) -> str:
     """Cache uchun URL ni maksimal barqarorlashtirish (canonical key).
 
@@ -756,6 +1229,10 @@ def _normalize_url_for_cache(url: str) -> str:
 
         # -------- TikTok canonical --------
         if "tiktok.com" in netloc:
+            # /@user/video/<id> -> /@_/video/<id> (yt-dlp o‘zi ham shu ko‘rinishni ishlatadi)
+            m = re.search(r"/video/(\d+)", path)
+            if m:
+                return f"https://www.tiktok.com/@_/video/{m.group(1)}"
             # keep only path (drop query), this already normalizes most variants
             return urlunsplit((scheme, netloc, path, "", ""))
 
@@ -1028,6 +1505,35 @@ def _is_real_youtube_video_format(f: Dict[str, Any]) -> bool:
 
     return True
 
+_AUDIO_ONLY_EXTS = ("m4a", "mp3", "aac", "opus", "ogg", "oga", "wav", "flac", "weba")
+
+
+def _is_plannable_video_format(f: Dict[str, Any]) -> bool:
+    """Platform-neutral video candidate for the size planner.
+
+    Many non-YouTube extractors leave `vcodec` (and sometimes `height`) unset, so unlike
+    _is_real_youtube_video_format an unknown codec is fine: keep anything with a height or
+    a vcodec other than "none"; drop audio-only and storyboard/image formats.
+    """
+    vcodec = f.get("vcodec")
+    if vcodec == "none":
+        return False
+    fid = str(f.get("format_id") or "").lower()
+    fmt = str(f.get("format") or "").lower()
+    note = str(f.get("format_note") or "").lower()
+    ext = str(f.get("ext") or "").lower()
+    if fid.startswith("sb") or "storyboard" in fmt or "storyboard" in note:
+        return False
+    if ext in ("mhtml", "jpg", "jpeg", "png", "webp"):
+        return False
+    if _yt_height(f) > 0:
+        return True
+    # na kodek, na balandlik: audio-only belgilarini tekshiramiz
+    if ext in _AUDIO_ONLY_EXTS or "audio only" in fmt or str(f.get("resolution") or "").lower() == "audio only":
+        return False
+    return True
+
+
 def _yt_debug_dump_formats(info: Dict[str, Any]) -> None:
     """Verbose formats diagnostics when YTDLP_DEBUG_FORMATS=1.
 
@@ -1195,46 +1701,395 @@ def _pick_best_thumbnail_url(info: Dict[str, Any]) -> Optional[str]:
     return best.get("url")
 
 
-def _cache_put(payload: Dict[str, Any]) -> str:
-    token = secrets.token_urlsafe(8)[:10]
-    if len(CALLBACK_CACHE) >= CALLBACK_CACHE_MAX:
-        for k in list(CALLBACK_CACHE.keys())[: CALLBACK_CACHE_MAX // 2]:
-            CALLBACK_CACHE.pop(k, None)
-    CALLBACK_CACHE[token] = payload
-    return token
+# ---------------------------- Callback payload store ----------------------------
+
+class _CbRequest:
+    """One link sent by a user. Shared by every button of its menu (URL/origin are stored once)."""
+
+    __slots__ = ("url", "origin_chat_id", "origin_message_id", "lang")
+
+    def __init__(self, url: str, origin_chat_id: Optional[int], origin_message_id: Optional[int], lang: str) -> None:
+        self.url = url
+        self.origin_chat_id = origin_chat_id
+        self.origin_message_id = origin_message_id
+        self.lang = lang
+
+
+class _CbButton:
+    """One inline button: a reference to its request plus the per-button choice."""
+
+    __slots__ = ("req", "kind", "format_id", "has_audio", "yt_key", "total_bytes", "expires")
+
+    def __init__(
+        self,
+        req: _CbRequest,
+        kind: str,
+        format_id: Optional[str],
+        has_audio: Optional[bool],
+        yt_key: Optional[str],
+        total_bytes: int,
+        expires: float,
+    ) -> None:
+        self.req = req
+        self.kind = kind
+        self.format_id = format_id
+        self.has_audio = has_audio
+        self.yt_key = yt_key
+        self.total_bytes = total_bytes
+        self.expires = expires
+
+
+class CallbackStore:
+    """Token -> button payload with true LRU + sliding TTL eviction.
+
+    Every successful lookup moves the token to the MRU end and extends its TTL, so
+    menus people are actively using never get evicted before stale ones.
+    Since TTL is the same for every entry, the LRU head is always the entry that
+    expires first — eviction only ever has to look at the head.
+    """
+
+    def __init__(self, max_items: int, ttl_seconds: float) -> None:
+        self.max_items = max(1, int(max_items))
+        self.ttl_seconds = max(1.0, float(ttl_seconds))
+        self._items: "OrderedDict[str, _CbButton]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def new_request(self, url: str, origin_chat_id: Optional[int], origin_message_id: Optional[int], lang: str) -> _CbRequest:
+        return _CbRequest(sys.intern(url), origin_chat_id, origin_message_id, lang)
+
+    def put(
+        self,
+        req: _CbRequest,
+        kind: str,
+        format_id: Optional[str] = None,
+        has_audio: Optional[bool] = None,
+        yt_key: Optional[str] = None,
+        total_bytes: int = 0,
+    ) -> str:
+        token = secrets.token_urlsafe(8)[:10]
+        while token in self._items:
+            token = secrets.token_urlsafe(8)[:10]
+        self._items[token] = _CbButton(
+            req, kind, format_id, has_audio, yt_key, int(total_bytes or 0), _now_ts() + self.ttl_seconds
+        )
+        self._evict()
+        return token
+
+    def get(self, token: str) -> Optional[_CbButton]:
+        btn = self._items.get(token)
+        if btn is None:
+            self.misses += 1
+            return None
+        now = _now_ts()
+        if btn.expires <= now:
+            self._items.pop(token, None)
+            self.evicted_ttl += 1
+            self.misses += 1
+            return None
+        btn.expires = now + self.ttl_seconds
+        self._items.move_to_end(token)
+        self.hits += 1
+        return btn
+
+    def _evict(self) -> int:
+        removed = 0
+        now = _now_ts()
+        while self._items:
+            token, btn = next(iter(self._items.items()))
+            if btn.expires <= now:
+                self.evicted_ttl += 1
+            elif len(self._items) > self.max_items:
+                self.evicted_lru += 1
+            else:
+                break
+            self._items.popitem(last=False)
+            removed += 1
+        return removed
+
+    def prune(self) -> int:
+        """Drop expired entries (and overflow). Returns removed count."""
+        return self._evict()
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        reqs: Dict[int, _CbRequest] = {}
+        approx = sys.getsizeof(self._items)
+        for token, btn in self._items.items():
+            approx += sys.getsizeof(token) + sys.getsizeof(btn)
+            if btn.format_id:
+                approx += sys.getsizeof(btn.format_id)
+            if btn.yt_key:
+                approx += sys.getsizeof(btn.yt_key)
+            reqs[id(btn.req)] = btn.req
+        for req in reqs.values():
+            approx += sys.getsizeof(req) + sys.getsizeof(req.url)
+        return {
+            "buttons": len(self._items),
+            "requests": len(reqs),
+            "max": self.max_items,
+            "ttl_h": round(self.ttl_seconds / 3600, 1),
+            "approx_bytes": approx,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+        }
+
+
+CALLBACK_CACHE = CallbackStore(CALLBACK_CACHE_MAX, CALLBACK_TTL_SECONDS)
+
+
+def _cache_new_request(url: str, origin_chat_id: Optional[int], origin_message_id: Optional[int], lang: str) -> _CbRequest:
+    return CALLBACK_CACHE.new_request(url, origin_chat_id, origin_message_id, lang)
+
+def _cache_put(req: _CbRequest, kind: str, **fields: Any) -> str:
+    return CALLBACK_CACHE.put(req, kind, **fields)
 
 def _cache_get(token: str) -> Optional[Dict[str, Any]]:
-    return CALLBACK_CACHE.get(token)
+    btn = CALLBACK_CACHE.get(token)
+    if btn is None:
+        return None
+    req = btn.req
+    return {
+        "url": req.url,
+        "kind": btn.kind,
+        "format_id": btn.format_id,
+        "has_audio": btn.has_audio,
+        "yt_key": btn.yt_key,
+        "total_bytes": btn.total_bytes,
+        "origin_chat_id": req.origin_chat_id,
+        "origin_message_id": req.origin_message_id,
+        "lang": req.lang,
+    }
+
+
+# ---------------------------- Signed (stateless) callback tokens ----------------------------
+#
+# callback_data = "ds|" + base64url(header | fmt_len | format_id | media_id | hmac[:8])
+# Bu tokenlar jarayon xotirasiga bog‘liq emas: restartdan keyin ham, boshqa replikada ham ishlaydi.
+# Sig‘masa (uzun ID/format yoki noma'lum platforma) — CALLBACK_CACHE'ga ("dl|<token>") tushamiz.
+
+CALLBACK_DATA_MAX = 64
+_SIGNED_VERSION = 1
+_SIGNED_HDR = struct.Struct(">BBBBHI")  # version, platform, kind, flags, height, size_kb
+_SIGNED_MAC_LEN = 8
+
+# platform code -> canonical URL prefix (media_id is appended as-is)
+_MEDIA_URL_PREFIX: Dict[int, str] = {
+    1: "https://www.youtube.com/watch?v=",
+    2: "https://www.tiktok.com/@_/video/",
+    3: "https://www.instagram.com/",
+    4: "https://www.facebook.com/",
+    5: "https://fb.watch/",
+    6: "https://ok.ru/",
+}
+
+_KIND_CODES: Dict[str, int] = {"video": 1, "audio": 2, "tt_photo_audio": 3}
+_KIND_BY_CODE: Dict[int, str] = {v: k for k, v in _KIND_CODES.items()}
+
+
+def _canonical_media_ref(url: str) -> Optional[Tuple[int, str]]:
+    """Return (platform_code, media_id) so that prefix + media_id rebuilds a working URL."""
+    canon = _normalize_url_for_cache(url)
+    if not canon:
+        return None
+    for code in (1, 2, 5):
+        prefix = _MEDIA_URL_PREFIX[code]
+        if canon.startswith(prefix) and len(canon) > len(prefix):
+            return (code, canon[len(prefix):])
+    try:
+        parts = urlsplit(canon)
+    except Exception:
+        return None
+    netloc = (parts.netloc or "").lower()
+    seg = [x for x in (parts.path or "").split("/") if x]
+    if "instagram.com" in netloc or "instagr.am" in netloc:
+        if len(seg) == 2 and seg[0] in ("reel", "p", "tv"):
+            return (3, f"{seg[0]}/{seg[1]}")
+        return None
+    if "facebook.com" in netloc or "fb.com" in netloc:
+        if seg == ["watch"] and parts.query.startswith("v="):
+            return (4, f"watch?{parts.query}")
+        if len(seg) == 2 and seg[0] == "reel":
+            return (4, f"reel/{seg[1]}")
+        return None
+    if "ok.ru" in netloc or "odnoklassniki.ru" in netloc:
+        if len(seg) == 2 and seg[0] in ("video", "live"):
+            return (6, f"{seg[0]}/{seg[1]}")
+        return None
+    return None
+
+
+def _b64url_encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _b64url_decode(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+def _signed_token_encode(
+    url: str,
+    kind: str,
+    format_id: Optional[str] = None,
+    has_audio: Optional[bool] = None,
+    yt_key: Optional[str] = None,
+    total_bytes: int = 0,
+) -> Optional[str]:
+    """Pack the essential payload into a signed token. Returns None when it does not fit."""
+    kcode = _KIND_CODES.get(kind)
+    ref = _canonical_media_ref(url)
+    if not kcode or not ref:
+        return None
+    platform, media_id = ref
+
+    height = 0
+    if yt_key:
+        # yt_key: "yt:<id>:<h>p" — faqat YouTube uchun, id media_id bilan bir xil bo‘lishi shart
+        m = re.fullmatch(r"yt:([^:]+):(\d+)p", yt_key)
+        if not m or platform != 1 or m.group(1) != media_id:
+            return None
+        height = min(int(m.group(2)), 0xFFFF)
+
+    flags = 0
+    if has_audio is not None:
+        flags |= 1
+        if has_audio:
+            flags |= 2
+    if yt_key:
+        flags |= 4
+
+    fmt = (format_id or "").encode("utf-8")
+    mid = media_id.encode("utf-8")
+    if len(fmt) > 255:
+        return None
+    size_kb = min(max(0, int(total_bytes or 0)) // 1024, 0xFFFFFFFF)
+    body = _SIGNED_HDR.pack(_SIGNED_VERSION, platform, kcode, flags, height, size_kb) + bytes([len(fmt)]) + fmt + mid
+    mac = hmac.new(CALLBACK_SECRET, body, hashlib.sha256).digest()[:_SIGNED_MAC_LEN]
+    token = _b64url_encode(body + mac)
+    if len("ds|") + len(token) > CALLBACK_DATA_MAX:
+        return None
+    return token
+
+def _signed_token_decode(token: str) -> Optional[Dict[str, Any]]:
+    """Verify and unpack a signed token. Origin chat/message and lang are NOT inside — caller fills them."""
+    try:
+        raw = _b64url_decode(token)
+    except Exception:
+        return None
+    if len(raw) < _SIGNED_HDR.size + 1 + _SIGNED_MAC_LEN:
+        return None
+    body, mac = raw[:-_SIGNED_MAC_LEN], raw[-_SIGNED_MAC_LEN:]
+    expected = hmac.new(CALLBACK_SECRET, body, hashlib.sha256).digest()[:_SIGNED_MAC_LEN]
+    if not hmac.compare_digest(mac, expected):
+        return None
+    try:
+        ver, platform, kcode, flags, height, size_kb = _SIGNED_HDR.unpack_from(body, 0)
+        off = _SIGNED_HDR.size
+        flen = body[off]
+        off += 1
+        fmt = body[off:off + flen].decode("utf-8")
+        media_id = body[off + flen:].decode("utf-8")
+    except Exception:
+        return None
+    prefix = _MEDIA_URL_PREFIX.get(platform)
+    kind = _KIND_BY_CODE.get(kcode)
+    if ver != _SIGNED_VERSION or not prefix or not kind or not media_id:
+        return None
+    return {
+        "url": prefix + media_id,
+        "kind": kind,
+        "format_id": fmt or None,
+        "has_audio": (bool(flags & 2) if flags & 1 else None),
+        "yt_key": (f"yt:{media_id}:{height}p" if flags & 4 else None),
+        "total_bytes": int(size_kb) * 1024,
+    }
+
+# fon rejimidagi put_callback yozuvlari: event loop task'larga faqat zaif havola saqlaydi
+_CALLBACK_WRITES: set[asyncio.Task] = set()
+
+def _make_dl_callback(req: _CbRequest, kind: str, **fields: Any) -> str:
+    """callback_data for a download button: signed token when it fits, shared store otherwise."""
+    token = _signed_token_encode(req.url, kind, **fields)
+    if token:
+        return f"ds|{token}"
+    token = _cache_put(req, kind, **fields)
+    if STORE.pool:
+        # boshqa replikalar ham bu tugmani tanishi uchun DB'ga ham yozamiz (fon rejimida)
+        payload = _cache_get(token)
+        if payload:
+            t = asyncio.create_task(STORE.put_callback(token, payload, CALLBACK_CACHE.ttl_seconds))
+            _CALLBACK_WRITES.add(t)
+            t.add_done_callback(_CALLBACK_WRITES.discard)
+    return f"dl|{token}"
+
+
+def _classify_ydl_error(e: BaseException) -> str:
+    """Error class of a yt-dlp/download failure.
+
+    botcheck | forbidden | rate_limited  — origin is blocking us (these feed the circuit breakers)
+    format_unavailable | unsupported | filename_too_long | breaker_open | timeout | other
+    """
+    if isinstance(e, OriginUnavailable):
+        return "breaker_open"
+    if isinstance(e, JobTimeout):
+        return "timeout"
+    s_low = str(e).lower()
+    if "sign in to confirm you’re not a bot" in s_low or "confirm you’re not a bot" in s_low:
+        return "botcheck"
+    if "http error 403" in s_low or "403 forbidden" in s_low:
+        return "forbidden"
+    if "http error 429" in s_low or "too many requests" in s_low:
+        return "rate_limited"
+    if "requested format is not available" in s_low or "use --list-formats" in s_low:
+        return "format_unavailable"
+    if "unsupported url" in s_low:
+        return "unsupported"
+    if "filename too long" in s_low:
+        return "filename_too_long"
+    return "other"
 
 
 def _friendly_ydl_error(e: Exception, lang: str) -> str:
     """Minimal, user-friendly error text for logs from yt-dlp / download."""
     s = str(e)
-    s_low = s.lower()
+    kind = _classify_ydl_error(e)
+
+    if kind == "breaker_open":
+        return _t(lang, "err_platform_paused", platform=e.platform_title, minutes=max(1, int(e.retry_after / 60 + 0.999)))
+    if kind == "timeout":
+        stage = _STAGE_TITLES.get(lang, _STAGE_TITLES[LANG_UZ]).get(e.stage, e.stage)
+        return _t(lang, "err_job_timeout", stage=stage, minutes=max(1, int(e.seconds / 60)))
 
     # YouTube bot-check patterns
-    if "sign in to confirm you’re not a bot" in s_low or "confirm you’re not a bot" in s_low:
+    if kind == "botcheck":
         # Cookies bor-yo‘qligini taxmin qilamiz
         if (os.getenv("YT_COOKIES_FILE") or os.getenv("YT_COOKIES_URL") or os.getenv("YT_COOKIES_TEXT")):
             return _t(lang, "yt_botcheck_even_with_cookies")
         return _t(lang, "yt_need_cookies")
 
     # 403 Forbidden (ko‘pincha YouTube cloud/IP blok)
-    if "http error 403" in s_low or "403 forbidden" in s_low:
+    if kind == "forbidden":
         return _t(lang, "yt_403")
 
     # 429 Too Many Requests (rate limit)
-    if "http error 429" in s_low or "too many requests" in s_low:
+    if kind == "rate_limited":
         return _t(lang, "err_rate_limited")
 
     # Requested format not available
-    if "requested format is not available" in s_low or "use --list-formats" in s_low:
+    if kind == "format_unavailable":
         return _t(lang, "err_format_unavailable")
 
-    if "unsupported url" in s_low:
+    if kind == "unsupported":
         return s
 
-    if "filename too long" in s_low:
+    if kind == "filename_too_long":
         return _t(lang, "err_filename_too_long")
 
     # Default: qisqa qilib qaytaramiz
@@ -1245,47 +2100,336 @@ def _friendly_ydl_error(e: Exception, lang: str) -> str:
 
 
 
-# ---------------------------- yt-dlp cookies helpers ----------------------------
+# ---------------------------- Killable stage workers ----------------------------
+class JobTimeout(Exception):
+    """A job stage ran past its deadline; its worker process (and children) were killed."""
 
-_COOKIEFILE_PATH: Optional[str] = None
-_COOKIE_LOGGED: bool = False
+    def __init__(self, stage: str, seconds: float) -> None:
+        super().__init__(f"{stage} timed out after {int(seconds)}s")
+        self.stage = stage
+        self.seconds = seconds
 
-def _ensure_cookiefile(workdir: Optional[str] = None) -> Optional[str]:
-    """Prepare a **writable** cookies.txt for yt-dlp and return its path.
+    def __reduce__(self):
+        return (type(self), (self.stage, self.seconds))
 
-    Important: do NOT reuse the same temp cookies path across concurrent requests.
-    yt-dlp may update cookies on exit, and parallel runs can corrupt a shared file.
-    So we create a fresh temp file per call.
 
-    Sources (priority order):
-      - YT_COOKIES_URL: direct https URL to cookies.txt (raw text)
-      - YT_COOKIES_TEXT: cookies.txt content as multiline env (recommended if you don't want files)
-      - YT_COOKIES_FILE: path to cookies.txt (e.g. /etc/secrets/cookies.txt or /app/cookies_youtube.txt)
+_STAGE_TIMEOUTS = {
+    "extract": JOB_EXTRACT_TIMEOUT,
+    "download": JOB_DOWNLOAD_TIMEOUT,
+    "ffmpeg": JOB_FFMPEG_TIMEOUT,
+    "local_api": JOB_LOCAL_API_TIMEOUT,
+}
+_STAGE_TITLES = {
+    LANG_UZ: {"extract": "Ma’lumot olish", "download": "Yuklab olish", "ffmpeg": "Video/audio tayyorlash"},
+    LANG_RU: {"extract": "Получение данных", "download": "Скачивание", "ffmpeg": "Обработка видео/аудио"},
+}
+_MP_CTX: Any = None
 
-    Notes:
-      - yt-dlp expects the cookies file in Netscape format and UTF-8 text.
-      - If the source is not UTF-8 (e.g., Windows-1251), we transparently re-encode to UTF-8.
-    """
-    def _dst_path() -> str:
-        base_dir = workdir if workdir else tempfile.gettempdir()
-        os.makedirs(base_dir, exist_ok=True)
-        return os.path.join(base_dir, f"yt_cookies_{uuid.uuid4().hex}.txt")
 
-    def _warn_if_suspicious(path: str) -> None:
+def _mp_context():
+    """forkserver (POSIX): workers fork from a clean, single-threaded server that already imported
+    this module and yt-dlp, so a stage starts in milliseconds; spawn elsewhere."""
+    global _MP_CTX
+    if _MP_CTX is None:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            _MP_CTX = multiprocessing.get_context("forkserver")
+            _MP_CTX.set_forkserver_preload([__name__])
+        else:
+            _MP_CTX = multiprocessing.get_context("spawn")
+    return _MP_CTX
+
+
+def _portable_exc(e: BaseException) -> BaseException:
+    """An exception that survives the pipe: itself, a message-only copy of the same type, or RuntimeError."""
+    for cand in (lambda: e, lambda: type(e)(str(e))):
         try:
-            sz = os.path.getsize(path)
-            if sz <= 0:
-                log.warning("YT cookies file is empty: %s", path)
-                return
-            with open(path, "rb") as f:
-                head = f.read(256)
-            head_txt = head.decode("utf-8", errors="ignore").strip()
-            if head_txt and ("Netscape" not in head_txt) and ("# HTTP Cookie File" not in head_txt):
-                log.warning("YT cookies file may be in a non-Netscape format: %s", path)
+            x = cand()
+            pickle.loads(pickle.dumps(x))
+            return x
         except Exception:
-            pass
+            continue
+    return RuntimeError(f"{type(e).__name__}: {e}")
 
-    def _write_utf8_text(dst: str, content: str) -> None:
+
+def _stage_child(conn, fn, args, state: Dict[str, Any]) -> None:
+    # yangi process group: killpg bilan yt-dlp'ning ffmpeg/aria bolalari ham birga o‘ladi
+    try:
+        os.setsid()
+    except Exception:
+        pass
+    PROFILE_TUNER.level.update(state.get("profile_levels") or {})
+    try:
+        out = ("ok", fn(*args))
+    except BaseException as e:
+        out = ("err", _portable_exc(e))
+    try:
+        conn.send(out)
+    except Exception as e:
+        conn.send(("err", RuntimeError(f"{getattr(fn, '__name__', fn)}: natijani uzatib bo‘lmadi: {e}")))
+    finally:
+        conn.close()
+
+
+def _kill_stage_process(p) -> None:
+    # avval worker'ning o‘zi: setsid'dan oldin bo‘lsa ham boshqa bola yarata olmaydi; keyin butun guruh
+    try:
+        p.kill()
+    except Exception:
+        pass
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except Exception:
+        pass
+
+
+async def _run_stage(stage: str, fn, *args):
+    """Run blocking fn(*args) in a killable worker process with the stage deadline.
+
+    Raises JobTimeout past the deadline. On timeout or task cancellation the worker's whole
+    process group is SIGKILLed and reaped before returning, so the caller can delete the work
+    dir right away. fn and args must be picklable module-level objects.
+    """
+    loop = asyncio.get_running_loop()
+    if not KILLABLE_WORKERS:
+        return await loop.run_in_executor(None, fn, *args)
+    timeout = _STAGE_TIMEOUTS.get(stage) or None
+    ctx = _mp_context()
+    r, w = ctx.Pipe(duplex=False)
+    p = ctx.Process(
+        target=_stage_child,
+        args=(w, fn, args, {"profile_levels": dict(PROFILE_TUNER.level)}),
+        name=f"dlbot-{stage}",
+        daemon=True,
+    )
+    starting = loop.run_in_executor(None, p.start)
+    try:
+        await asyncio.shield(starting)
+    except BaseException:
+        w.close()
+        r.close()
+        # bekor qilish p.start() paytida (yoki tugashi bilan) keldi: jarayon baribir ishga tushgan — o‘ldiramiz
+        if not starting.done():
+            await asyncio.wait([starting])
+        if not starting.cancelled() and starting.exception() is None:
+            _kill_stage_process(p)
+            await loop.run_in_executor(None, p.join, 10)
+        raise
+    w.close()
+    ready = loop.create_future()
+    loop.add_reader(r.fileno(), lambda: ready.done() or ready.set_result(None))
+    try:
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            log.warning("%s bosqichi %ss muddatdan oshdi — worker o‘ldirildi: %s", stage, timeout, getattr(fn, "__name__", fn))
+            raise JobTimeout(stage, timeout or 0) from None
+        loop.remove_reader(r.fileno())
+        try:
+            status, value = await loop.run_in_executor(None, r.recv)
+        except EOFError:
+            await loop.run_in_executor(None, p.join, 5)
+            raise RuntimeError(f"{stage}: worker jarayoni kutilmaganda to‘xtadi (exit code {p.exitcode})") from None
+    finally:
+        loop.remove_reader(r.fileno())
+        if p.is_alive():
+            _kill_stage_process(p)
+        await asyncio.shield(loop.run_in_executor(None, p.join, 10))
+        r.close()
+    if status == "err":
+        raise value
+    return value
+
+
+# ---------------------------- Origin circuit breakers ----------------------------
+
+_BREAKER_KINDS = ("botcheck", "forbidden", "rate_limited")
+# origin'ning aniq javobi (blok emas) — breaker'ni yopadi; qolgan xatolar (DNS, reset, timeout) neytral
+_ORIGIN_ANSWER_KINDS = ("format_unavailable", "unsupported")
+_PLATFORM_TITLES = {
+    "youtube": "YouTube",
+    "tiktok": "TikTok",
+    "instagram": "Instagram",
+    "facebook": "Facebook",
+    "okru": "OK.ru",
+    "other": "Sayt",
+}
+
+
+class OriginUnavailable(Exception):
+    """Fail-fast: the platform's breaker is open."""
+
+    def __init__(self, platform: str, retry_after: float) -> None:
+        super().__init__(f"{platform}: circuit open, retry in {int(retry_after)}s")
+        self.platform = platform
+        self.platform_title = _PLATFORM_TITLES.get(platform, platform)
+        self.retry_after = max(0.0, retry_after)
+
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive blocking errors -> half-open (one probe) -> closed/open.
+
+    Each failed probe doubles the open period (up to BREAKER_MAX_OPEN_SECONDS).
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.open_seconds = max(1, BREAKER_OPEN_SECONDS)
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self.last_kind = ""
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if _now_ts() < self.open_until:
+                return False
+            self.state = "half_open"
+            self.probe_in_flight = False
+        # half_open: faqat bitta sinov so‘rovi
+        if self.probe_in_flight:
+            return False
+        self.probe_in_flight = True
+        log.info("Breaker %s: half-open, sinov so‘rovi", self.name)
+        return True
+
+    def retry_after(self) -> float:
+        if self.state == "open":
+            return max(0.0, self.open_until - _now_ts())
+        return float(self.open_seconds) if self.state == "half_open" else 0.0
+
+    def success(self) -> None:
+        if self.state != "closed":
+            log.info("Breaker %s: closed (origin yana ishlayapti)", self.name)
+        self.state = "closed"
+        self.failures = 0
+        self.open_seconds = max(1, BREAKER_OPEN_SECONDS)
+        self.probe_in_flight = False
+
+    def failure(self, kind: str) -> None:
+        self.last_kind = kind
+        if self.state == "half_open":
+            self.open_seconds = min(max(1, BREAKER_MAX_OPEN_SECONDS), self.open_seconds * 2)
+            self._open()
+            return
+        self.failures += 1
+        if self.state == "closed" and self.failures >= max(1, BREAKER_THRESHOLD):
+            self._open()
+
+    def neutral(self) -> None:
+        """Outcome says nothing about the origin (e.g. our own size limit): just free the probe."""
+        if self.state == "half_open":
+            self.probe_in_flight = False
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.probe_in_flight = False
+        self.open_until = _now_ts() + self.open_seconds
+        log.warning("Breaker %s: OPEN %ds (%s)", self.name, self.open_seconds, self.last_kind)
+
+    def describe(self) -> str:
+        extra = f" {int(self.retry_after())}s" if self.state != "closed" else ""
+        return f"{self.name}: {self.state}{extra} fails={self.failures} last={self.last_kind or '-'}"
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def _origin_identity(platform: str) -> str:
+    """Which egress/credentials the origin sees us with: proxy + (YouTube) cookies."""
+    proxy = _normalize_proxy((os.getenv("YTDLP_PROXY") or "").strip()) or ""
+    ident = hashlib.sha1(proxy.encode("utf-8")).hexdigest()[:8] if proxy else "direct"
+    if platform == "youtube" and (
+        os.getenv("YT_COOKIES_FILE") or os.getenv("YT_COOKIES_URL") or os.getenv("YT_COOKIES_TEXT") or os.getenv("YT_COOKIES_B64")
+    ):
+        ident += "+cookies"
+    return ident
+
+
+def _breaker_for(url: str) -> Tuple[str, CircuitBreaker]:
+    platform = platform_of(url)
+    key = f"{platform}|{_origin_identity(platform)}"
+    br = BREAKERS.get(key)
+    if br is None:
+        br = BREAKERS[key] = CircuitBreaker(key)
+    return platform, br
+
+
+async def _origin_call(url: str, fn, *args):
+    """Run a blocking yt-dlp call for `url` in a killable stage worker behind its platform breaker."""
+    platform, br = _breaker_for(url)
+    if not br.allow():
+        raise OriginUnavailable(platform, br.retry_after())
+    try:
+        result = await _run_stage("extract" if fn is _extract_info else "download", fn, *args)
+    except asyncio.CancelledError:
+        # ❌ / worker to‘xtashi: half-open probe'ni bo‘shatamiz, aks holda breaker abadiy yopilmaydi
+        br.neutral()
+        raise
+    except DownloadCancelled:
+        br.neutral()
+        raise
+    except (MediaTooLarge, JobTimeout):
+        br.neutral()
+        raise
+    except Exception as e:
+        kind = _classify_ydl_error(e)
+        if kind in _BREAKER_KINDS:
+            br.failure(kind)
+        elif kind in _ORIGIN_ANSWER_KINDS:
+            # origin javob berdi (format yo‘q va h.k.) — blok emas
+            br.success()
+        else:
+            # "other": DNS, ulanish uzilishi, socket timeout — origin javobi emas, probe'ni faqat bo‘shatamiz
+            br.neutral()
+        raise
+    br.success()
+    return result
+
+
+# ---------------------------- yt-dlp cookies helpers ----------------------------
+
+_COOKIEFILE_PATH: Optional[str] = None
+_COOKIE_LOGGED: bool = False
+
+def _ensure_cookiefile(workdir: Optional[str] = None) -> Optional[str]:
+    """Prepare a **writable** cookies.txt for yt-dlp and return its path.
+
+    Important: do NOT reuse the same temp cookies path across concurrent requests.
+    yt-dlp may update cookies on exit, and parallel runs can corrupt a shared file.
+    So we create a fresh temp file per call.
+
+    Sources (priority order):
+      - YT_COOKIES_URL: direct https URL to cookies.txt (raw text)
+      - YT_COOKIES_TEXT: cookies.txt content as multiline env (recommended if you don't want files)
+      - YT_COOKIES_FILE: path to cookies.txt (e.g. /etc/secrets/cookies.txt or /app/cookies_youtube.txt)
+
+    Notes:
+      - yt-dlp expects the cookies file in Netscape format and UTF-8 text.
+      - If the source is not UTF-8 (e.g., Windows-1251), we transparently re-encode to UTF-8.
+    """
+    def _dst_path() -> str:
+        base_dir = workdir if workdir else tempfile.gettempdir()
+        os.makedirs(base_dir, exist_ok=True)
+        return os.path.join(base_dir, f"yt_cookies_{uuid.uuid4().hex}.txt")
+
+    def _warn_if_suspicious(path: str) -> None:
+        try:
+            sz = os.path.getsize(path)
+            if sz <= 0:
+                log.warning("YT cookies file is empty: %s", path)
+                return
+            with open(path, "rb") as f:
+                head = f.read(256)
+            head_txt = head.decode("utf-8", errors="ignore").strip()
+            if head_txt and ("Netscape" not in head_txt) and ("# HTTP Cookie File" not in head_txt):
+                log.warning("YT cookies file may be in a non-Netscape format: %s", path)
+        except Exception:
+            pass
+
+    def _write_utf8_text(dst: str, content: str) -> None:
         # Normalize newlines and ensure UTF-8 text on disk
         content = content.replace("\r\n", "\n").replace("\r", "\n")
         with open(dst, "w", encoding="utf-8", newline="\n") as f:
@@ -1441,7 +2585,118 @@ def _parse_js_runtimes_env(value: str) -> Dict[str, Dict[str, Any]]:
     return out
 
 
-def build_ydl_base(outtmpl: str, workdir: Optional[str] = None) -> Dict[str, Any]:
+# ---------------------------- yt-dlp download profiles ----------------------------
+
+# Har bir tarmoq CDN'i boshqacha: YouTube DASH 10MB'dan katta range'larni sekinlashtiradi, lekin parallel
+# fragmentlarni yaxshi ko‘taradi; TikTok/Instagram CDN'i parallel/range so‘rovlarni tez throttling qiladi,
+# fayllar esa kichik progressive mp4. http_chunk_size=0 — bitta oddiy GET.
+_DL_PROFILES: Dict[str, Dict[str, int]] = {
+    "youtube": {"concurrent_fragment_downloads": 16, "buffersize": 2 * 1024 * 1024, "http_chunk_size": 10 * 1024 * 1024},
+    "tiktok": {"concurrent_fragment_downloads": 2, "buffersize": 256 * 1024, "http_chunk_size": 0},
+    "instagram": {"concurrent_fragment_downloads": 4, "buffersize": 512 * 1024, "http_chunk_size": 0},
+    "facebook": {"concurrent_fragment_downloads": 4, "buffersize": 1024 * 1024, "http_chunk_size": 0},
+    "okru": {"concurrent_fragment_downloads": 6, "buffersize": 1024 * 1024, "http_chunk_size": 10 * 1024 * 1024},
+    "other": {"concurrent_fragment_downloads": 8, "buffersize": 1024 * 1024, "http_chunk_size": 10 * 1024 * 1024},
+}
+
+
+class _ProfileTuner:
+    """Per-platform concurrent_fragment_downloads hill-climb (DL_PROFILE_LEARN=1).
+
+    Throughput (bytes/s of real downloads, measured by the caller) is kept as an EWMA per
+    (platform, fragments). Once the current level has enough samples it moves to a measured
+    neighbour level (x2 or /2) that is >5% faster, or tries an unmeasured one; otherwise it stays.
+    """
+
+    MIN_SAMPLES = 4
+    MAX_FRAGMENTS = 32
+
+    def __init__(self) -> None:
+        self.level: Dict[str, int] = {}
+        self.ewma: Dict[Tuple[str, int], float] = {}
+        self.samples: Dict[Tuple[str, int], int] = {}
+        self._lock = threading.Lock()
+
+    def fragments(self, platform: str) -> int:
+        base = _DL_PROFILES.get(platform, _DL_PROFILES["other"])["concurrent_fragment_downloads"]
+        return self.level.get(platform, base)
+
+    def observe(self, platform: str, fragments: int, nbytes: int, seconds: float) -> None:
+        if nbytes <= 0 or seconds <= 0.5:
+            return
+        tput = nbytes / seconds
+        with self._lock:
+            k = (platform, fragments)
+            prev = self.ewma.get(k)
+            self.ewma[k] = tput if prev is None else (0.7 * prev + 0.3 * tput)
+            self.samples[k] = self.samples.get(k, 0) + 1
+            if not DL_PROFILE_LEARN or fragments != self.fragments(platform):
+                return
+            if self.samples[k] < self.MIN_SAMPLES:
+                return
+            up = min(self.MAX_FRAGMENTS, fragments * 2)
+            down = max(1, fragments // 2)
+            cur = self.ewma[k]
+            measured = [c for c in (up, down) if c != fragments and self.samples.get((platform, c), 0) >= self.MIN_SAMPLES]
+            better = [c for c in measured if self.ewma[(platform, c)] > cur * 1.05]
+            if better:
+                self._switch(platform, fragments, max(better, key=lambda c: self.ewma[(platform, c)]), "faster")
+            else:
+                # qo‘shni darajani hali o‘lchamagan bo‘lsak — sinab ko‘ramiz, aks holda shu yerda qolamiz
+                for cand in (up, down):
+                    if cand != fragments and cand not in measured:
+                        self._switch(platform, fragments, cand, "explore")
+                        break
+
+    def _switch(self, platform: str, old: int, new: int, why: str) -> None:
+        self.level[platform] = new
+        log.info("DL profile %s: fragments %d -> %d (%s, %.1fMB/s)",
+                 platform, old, new, why, self.ewma.get((platform, old), 0.0) / 1048576)
+
+    def stats(self) -> str:
+        with self._lock:
+            parts = []
+            for (plat, frag), v in sorted(self.ewma.items()):
+                mark = "*" if self.fragments(plat) == frag else ""
+                parts.append(f"{plat}@{frag}{mark}={v / 1048576:.1f}MB/s(n={self.samples.get((plat, frag), 0)})")
+            return " ".join(parts) or "-"
+
+
+PROFILE_TUNER = _ProfileTuner()
+
+
+def _file_size(path: Optional[Path]) -> int:
+    try:
+        return path.stat().st_size if path else 0
+    except Exception:
+        return 0
+
+
+def _observe_download(url: str, fragments: int, nbytes: int, seconds: float) -> None:
+    """Feed a finished origin download to the profile tuner and the adaptive download limiter.
+
+    Only called right after _origin_call: cache and upload-retry hits are not throughput.
+    """
+    DOWNLOAD_SEM.record(nbytes)
+    try:
+        PROFILE_TUNER.observe(platform_of(url), fragments, nbytes, seconds)
+    except Exception:
+        pass
+
+
+def _apply_dl_profile(opts: Dict[str, Any], url: Optional[str]) -> None:
+    platform = platform_of(url) if url else "other"
+    prof = _DL_PROFILES.get(platform, _DL_PROFILES["other"])
+    opts["concurrent_fragment_downloads"] = PROFILE_TUNER.fragments(platform)
+    opts["buffersize"] = prof["buffersize"]
+    if prof["http_chunk_size"] > 0:
+        opts["http_chunk_size"] = prof["http_chunk_size"]
+    else:
+        opts.pop("http_chunk_size", None)
+
+
+def build_ydl_base(outtmpl: str, workdir: Optional[str] = None, url: Optional[str] = None) -> Dict[str, Any]:
+    """Common yt-dlp options. `url` selects the per-platform download profile (fragments/chunks)."""
     opts = {
         "outtmpl": outtmpl,
         "noplaylist": True,
@@ -1458,6 +2713,7 @@ def build_ydl_base(outtmpl: str, workdir: Optional[str] = None) -> Dict[str, Any
         "buffersize": 1024 * 1024,
         "http_chunk_size": 10 * 1024 * 1024,
     }
+    _apply_dl_profile(opts, url)
 
     # Env overrides (Railway/Render)
     try:
@@ -1603,7 +2859,7 @@ def build_ydl_base(outtmpl: str, workdir: Optional[str] = None) -> Dict[str, Any
 def _extract_info(url: str) -> Dict[str, Any]:
     # Formatlarni ko‘rsatish uchun to‘liq "process=True" kerak bo‘ladi,
     # aks holda ba'zan faqat audio ko‘rinib qoladi.
-    ydl_opts = build_ydl_base(outtmpl="%(title)s.%(ext)s", workdir=tempfile.gettempdir())
+    ydl_opts = build_ydl_base(outtmpl="%(title)s.%(ext)s", workdir=tempfile.gettempdir(), url=url)
     ydl_opts["ignore_no_formats_error"] = True
     ydl_opts["skip_download"] = True
     # Format ro'yxatini olishda "web" client ko'proq formatlarni qaytaradi.
@@ -1623,7 +2879,8 @@ def _extract_info(url: str) -> Dict[str, Any]:
             info = ydl.extract_info(url, download=False)
             if os.getenv("YTDLP_DEBUG_FORMATS", "0") == "1":
                 _yt_debug_dump_formats(info)
-            return info
+            # stage worker'dan pipe orqali qaytadi: LazyList/partial (fragments) pickle bo‘lmaydi
+            return YoutubeDL.sanitize_info(info)
     except Exception as e:
         msg = str(e)
         if "Impersonate target" in msg and "not available" in msg:
@@ -1631,7 +2888,7 @@ def _extract_info(url: str) -> Dict[str, Any]:
             ydl_opts.pop("impersonate", None)
             log.warning("Impersonate o‘chirildi (mavjud emas): %s", msg)
             with YoutubeDL(ydl_opts) as ydl:
-                return ydl.extract_info(url, download=False)
+                return YoutubeDL.sanitize_info(ydl.extract_info(url, download=False))
         raise
 
 
@@ -1729,7 +2986,211 @@ def _select_youtube_formats(info: Dict[str, Any]) -> List[Dict[str, Any]]:
 
 
 
-def _download_video(url: str, format_id: Optional[str], workdir: str, has_audio: Optional[bool] = None) -> Path:
+class MediaResult:
+    """A finished file plus what we know about it (yt-dlp info, refined by ffprobe)."""
+
+    __slots__ = (
+        "path", "size", "vcodec", "acodec", "duration", "width", "height", "thumbnail_url", "thumbnail", "audio_src",
+        "fallback",
+    )
+
+    def __init__(
+        self,
+        path: Path,
+        vcodec: Optional[str] = None,
+        acodec: Optional[str] = None,
+        duration: float = 0.0,
+        width: int = 0,
+        height: int = 0,
+        thumbnail_url: Optional[str] = None,
+        audio_src: Optional[Path] = None,
+    ) -> None:
+        self.path = path
+        try:
+            self.size = path.stat().st_size
+        except Exception:
+            self.size = 0
+        self.vcodec = vcodec
+        self.acodec = acodec
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.thumbnail_url = thumbnail_url
+        self.thumbnail: Optional[Path] = None  # lokal JPEG (<=320px), send_video uchun
+        self.audio_src = audio_src
+        # size planner so‘ralgan formatdan pastrog‘ini berdi — so‘ralgan format kaliti bilan keshlanmaydi
+        self.fallback = False
+
+    @classmethod
+    def from_info(cls, path: Path, info: Dict[str, Any]) -> "MediaResult":
+        rd = (info.get("requested_downloads") or [info])[-1]
+
+        def _codec(v: Any) -> Optional[str]:
+            v = str(v or "")
+            return v if v and v != "none" else None
+
+        try:
+            duration = float(rd.get("duration") or info.get("duration") or 0.0)
+        except Exception:
+            duration = 0.0
+        return cls(
+            path,
+            vcodec=_codec(rd.get("vcodec")),
+            acodec=_codec(rd.get("acodec")),
+            duration=duration,
+            width=int(rd.get("width") or 0),
+            height=int(rd.get("height") or 0),
+            thumbnail_url=_pick_best_thumbnail_url(info),
+        )
+
+    def apply_probe(self, probe: Dict[str, Any]) -> "MediaResult":
+        """Overwrite metadata with what ffprobe actually saw in the file."""
+        if not probe:
+            return self
+        self.vcodec = probe.get("vcodec") or None
+        self.acodec = probe.get("acodec") or None
+        self.duration = float(probe.get("duration") or self.duration or 0.0)
+        self.width = int(probe.get("width") or self.width or 0)
+        self.height = int(probe.get("height") or self.height or 0)
+        return self
+
+    def moved_to(self, path: Path) -> "MediaResult":
+        self.path = path
+        try:
+            self.size = path.stat().st_size
+        except Exception:
+            self.size = 0
+        return self
+
+
+class DownloadTooLarge(DownloadCancelled):
+    """Raised from a progress hook once downloaded + expected bytes exceed the limit."""
+
+    def __init__(self, size: int, limit: int) -> None:
+        super().__init__(f"download too large: {size} > {limit} bytes")
+        self.size = int(size or 0)
+        self.limit = int(limit or 0)
+
+    def __reduce__(self):
+        # stage worker jarayonidan pipe orqali qaytadi
+        return (type(self), (self.size, self.limit))
+
+
+class _ByteGuard:
+    """yt-dlp progress hook: per-file max(downloaded, expected), summed over all files of the job.
+
+    Fragment estimates (HLS/DASH) are noisy at the start, so they only count from the 3rd fragment;
+    exact totals and actually downloaded bytes count immediately.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.files: Dict[str, int] = {}
+
+    def __call__(self, d: Dict[str, Any]) -> None:
+        if self.limit <= 0 or d.get("status") not in ("downloading", "finished"):
+            return
+        name = str(d.get("filename") or d.get("tmpfilename") or "")
+        done = int(d.get("downloaded_bytes") or 0)
+        expected = int(d.get("total_bytes") or 0)
+        if not expected and int(d.get("fragment_index") or 0) >= 3:
+            expected = int(d.get("total_bytes_estimate") or 0)
+        self.files[name] = max(self.files.get(name, 0), done, expected)
+        size = sum(self.files.values())
+        if size > self.limit:
+            raise DownloadTooLarge(size, self.limit)
+
+    def cleanup(self) -> None:
+        """Remove partial files/fragments of an aborted download right away (not only with the temp dir)."""
+        for name in self.files:
+            if not name:
+                continue
+            p = Path(name)
+            for f in [p, *p.parent.glob(glob.escape(p.name) + ".part*"), *p.parent.glob(glob.escape(p.name) + ".ytdl")]:
+                try:
+                    f.unlink()
+                except Exception:
+                    pass
+
+
+def _ydl_download(
+    url: str,
+    opts: Dict[str, Any],
+    info: Optional[Dict[str, Any]] = None,
+    max_bytes: Optional[int] = None,
+) -> Tuple[Path, Dict[str, Any]]:
+    """Run a yt-dlp download and return (final file, info).
+
+    The final path comes from yt-dlp itself (postprocessor_hooks -> requested_downloads),
+    never from scanning the work directory. Downloads are aborted with DownloadTooLarge as soon
+    as they are known to exceed `max_bytes` (default: DL_MAX_MB); partial files stay in the
+    job's temp dir and go away with it.
+    """
+    final: Dict[str, str] = {}
+    if max_bytes is None:
+        max_bytes = DL_MAX_MB * 1024 * 1024 if DL_MAX_MB > 0 else 0
+
+    def _pp_hook(d: Dict[str, Any]) -> None:
+        # The last finished postprocessor (MoveFiles) reports the file's final location
+        if d.get("status") == "finished":
+            fp = (d.get("info_dict") or {}).get("filepath")
+            if fp:
+                final["path"] = fp
+
+    opts = dict(opts)
+    opts["postprocessor_hooks"] = [*(opts.get("postprocessor_hooks") or []), _pp_hook]
+    guard = _ByteGuard(max_bytes)
+    if max_bytes > 0:
+        # yt-dlp'ning max_filesize'i faylni jimgina o‘tkazib yuboradi (hajmni aytmaydi). Guard esa birinchi
+        # progress chaqiruvidayoq Content-Length'ni ko‘radi va haqiqiy hajm bilan to‘xtatadi.
+        opts.pop("max_filesize", None)
+        opts["progress_hooks"] = [*(opts.get("progress_hooks") or []), guard]
+
+    def _run(o: Dict[str, Any], pre: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        with YoutubeDL(o) as ydl:
+            if pre is not None:
+                # --load-info-json bilan bir xil yo‘l: format tanlash qayta ishlaydi, sahifa qayta olinmaydi
+                return ydl.process_ie_result(YoutubeDL.sanitize_info(pre, remove_private_keys=True), download=True)
+            return ydl.extract_info(url, download=True)
+
+    try:
+        info = _run(opts, info)
+    except DownloadCancelled:
+        guard.cleanup()
+        raise
+    except Exception as e:
+        msg = str(e)
+        if "Impersonate target" in msg and "not available" in msg:
+            opts.pop("impersonate", None)
+            log.warning("Impersonate o‘chirildi (mavjud emas): %s", msg)
+            info = _run(opts, info)
+        elif info is not None:
+            log.warning("Oldindan olingan info bilan yuklab bo‘lmadi, URL orqali qayta: %s", msg)
+            info = _run(opts, None)
+        else:
+            raise
+
+    candidates = [final.get("path")] + [r.get("filepath") for r in reversed(info.get("requested_downloads") or [])]
+    for fp in candidates:
+        if not fp:
+            continue
+        p = Path(fp)
+        try:
+            if p.is_file() and p.stat().st_size > 0:
+                return p, info
+        except Exception:
+            continue
+    raise RuntimeError("Download finished but file not found")
+
+
+def _download_video(
+    url: str,
+    format_id: Optional[str],
+    workdir: str,
+    has_audio: Optional[bool] = None,
+    keep_audio: bool = False,
+    info: Optional[Dict[str, Any]] = None,
+) -> MediaResult:
     """yt-dlp орқали видеони юклаб олиш.
 
     format_id:
@@ -1741,45 +3202,47 @@ def _download_video(url: str, format_id: Optional[str], workdir: str, has_audio:
       - True  => format_id'нинг ўзида аудио бор (progressive)
       - False => формат видео-онли (аудиосиз)
       - None  => номаълум (safe fallback)
-    """
-    outtmpl = os.path.join(workdir, "%(title).200s.%(ext)s")
-
-    def _run_with_opts(opts: Dict[str, Any]) -> Path:
-        """Run yt-dlp download and return a non-empty file path from workdir."""
-        with YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-
-            candidates: List[Path] = []
-            try:
-                fp = ydl.prepare_filename(info)
-                candidates.append(Path(fp))
-            except Exception:
-                pass
 
-            req = info.get("requested_downloads") or info.get("requested_formats") or []
-            for r in req:
-                p = r.get("filepath") or r.get("filename")
-                if p:
-                    candidates.append(Path(p))
+    keep_audio:
+      - True => video+audio merge бўлса, bestaudio қисмини ҳам сақлаймиз (result.audio_src, кейинги MP3 сўровлар учун)
 
-            files = [p for p in Path(workdir).iterdir() if p.is_file()]
-            media = [p for p in files if p.suffix.lower() in (".mp4", ".mkv", ".webm", ".mov", ".m4a")]
-            if media:
-                candidates.insert(0, max(media, key=lambda p: p.stat().st_size))
+    info:
+      - size planner олдиндан олган extract_info натижаси (саҳифа қайта юкланмайди)
+    """
+    outtmpl = os.path.join(workdir, "%(title).200s.%(ext)s")
 
-            for p in candidates:
-                try:
-                    if p.exists() and p.stat().st_size > 0:
-                        return p
-                except Exception:
+    def _kept_audio_part(info: Dict[str, Any], final: Path) -> Optional[Path]:
+        """With keepvideo=True the merged inputs stay on disk: keep the audio one, drop the rest."""
+        audio: Optional[Path] = None
+        for rd in (info.get("requested_downloads") or [info]):
+            for f in (rd.get("requested_formats") or []):
+                fp = f.get("filepath")
+                if not fp:
+                    continue
+                p = Path(fp)
+                if p == final or not p.exists():
                     continue
-        raise RuntimeError("Download finished but file not found")
+                if f.get("vcodec") in (None, "none") and f.get("acodec") not in (None, "none") and audio is None:
+                    audio = p
+                else:
+                    try:
+                        p.unlink()
+                    except Exception:
+                        pass
+        return audio
 
-    ydl_opts = build_ydl_base(outtmpl=outtmpl, workdir=workdir)
-    ydl_opts.update({
-        "merge_output_format": "mp4",
-        "postprocessors": [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}],
-    })
+    def _run_with_opts(opts: Dict[str, Any]) -> MediaResult:
+        path, got = _ydl_download(url, opts, info)
+        res = MediaResult.from_info(path, got)
+        if opts.get("keepvideo"):
+            res.audio_src = _kept_audio_part(got, path)
+        return res
+
+    # Re-encode yo‘q: merge stream copy bilan mp4 ga. Kodek mosligi keyin _finalize_video'da hal qilinadi.
+    ydl_opts = build_ydl_base(outtmpl=outtmpl, workdir=workdir, url=url)
+    ydl_opts["merge_output_format"] = "mp4"
+    if keep_audio and is_youtube(url) and has_audio is not True:
+        ydl_opts["keepvideo"] = True
 
     # 1) Height-cap pseudo: h:720
     if format_id and str(format_id).startswith("h:"):
@@ -1787,7 +3250,13 @@ def _download_video(url: str, format_id: Optional[str], workdir: str, has_audio:
             h = int(str(format_id).split(":", 1)[1])
         except Exception:
             h = 720
-        ydl_opts["format"] = (f"bestvideo*[height<={h}][ext=mp4]+bestaudio[ext=m4a]/"f"bestvideo*[height<={h}]+bestaudio/"f"best[height<={h}][ext=mp4]/best[height<={h}]")
+        # H.264/AAC (Telegram'da hamma joyda o‘ynaydi) birinchi, keyin mp4/m4a, keyin istalgani
+        ydl_opts["format"] = (
+            f"bestvideo*[height<={h}][vcodec^=avc1]+bestaudio[acodec^=mp4a]/"
+            f"bestvideo*[height<={h}][ext=mp4]+bestaudio[ext=m4a]/"
+            f"bestvideo*[height<={h}]+bestaudio/"
+            f"best[height<={h}][ext=mp4]/best[height<={h}]"
+        )
         return _run_with_opts(ydl_opts)
 
     # 2) Exact itag
@@ -1799,102 +3268,1111 @@ def _download_video(url: str, format_id: Optional[str], workdir: str, has_audio:
         else:
             # Video-only stream: keep the selected video stream and add the best audio.
             # Again, no silent fallback to another video quality.
-            ydl_opts["format"] = f"{fid}+bestaudio[ext=m4a]/{fid}+bestaudio"
+            # Oxirgi variant — shu formatning o‘zi: ko‘p saytlarda alohida audio yo‘q va acodec noma'lum
+            ydl_opts["format"] = f"{fid}+bestaudio[acodec^=mp4a]/{fid}+bestaudio[ext=m4a]/{fid}+bestaudio/{fid}"
         return _run_with_opts(ydl_opts)
 
-    # 3) Ultimate fallback
-    ydl_opts["format"] = "bestvideo*+bestaudio/best"
+    # 3) Ultimate fallback (Telegram-compatible codecs first)
+    ydl_opts["format"] = (
+        "bestvideo*[vcodec^=avc1]+bestaudio[acodec^=mp4a]/"
+        "best[ext=mp4][vcodec^=avc1]/"
+        "bestvideo*+bestaudio/best"
+    )
     return _run_with_opts(ydl_opts)
 
 
-def _download_audio(url: str, workdir: str) -> Path:
+def _download_audio(url: str, workdir: str) -> MediaResult:
+    """Download the best audio stream as-is (one fetch, no re-encode).
+
+    Conversion to the delivery format happens separately in _audio_for_delivery, so a failed
+    encode never costs a second download.
+    """
     outtmpl = os.path.join(workdir, "%(id)s.%(ext)s")
 
-    ydl_opts = build_ydl_base(outtmpl=outtmpl, workdir=workdir)
-    ydl_opts["format"] = "bestaudio/best"
-    ydl_opts["postprocessors"] = [{
-        "key": "FFmpegExtractAudio",
-        "preferredcodec": "mp3",
-        "preferredquality": "192",
-    }]
-    try:
-        try:
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.extract_info(url, download=True)
-        except Exception as e:
-            msg = str(e)
-            if "Impersonate target" in msg and "not available" in msg:
-                ydl_opts.pop("impersonate", None)
-                log.warning("Impersonate o‘chirildi (mavjud emas): %s", msg)
-                with YoutubeDL(ydl_opts) as ydl:
-                    ydl.extract_info(url, download=True)
-            else:
-                raise
-        mp3s = sorted(Path(workdir).glob("*.mp3"), key=lambda x: x.stat().st_mtime, reverse=True)
-        if mp3s:
-            return mp3s[0]
-    except Exception as e:
-        log.warning("MP3 konvertatsiya muvaffaqiyatsiz (ffmpeg yo'q bo'lishi mumkin). Fallback audio: %s", e)
+    ydl_opts = build_ydl_base(outtmpl=outtmpl, workdir=workdir, url=url)
+    ydl_opts["format"] = "bestaudio[ext=m4a]/bestaudio/best"
+    path, info = _ydl_download(url, ydl_opts)
+    return MediaResult.from_info(path, info)
+
+
+# ---------------------------- Media post-processing (ffprobe/ffmpeg) ----------------------------
+
+# Telegram'ning barcha klientlarida inline o‘ynaydigan kombinatsiya
+_TG_VIDEO_CODECS = ("h264",)
+_TG_AUDIO_CODECS = ("aac", "mp3")
+# MP4 konteyneriga stream copy bilan sig‘adigan kodeklar
+_MP4_VIDEO_CODECS = ("h264", "hevc", "vp9", "av1", "mpeg4")
+_MP4_AUDIO_CODECS = ("aac", "mp3", "opus", "ac3", "eac3", "alac", "flac")
+
 
-    ydl_opts2 = build_ydl_base(outtmpl=outtmpl, workdir=workdir)
-    ydl_opts2["format"] = "bestaudio/best"
+def _ffprobe(path: Path) -> Dict[str, Any]:
+    """Container/codec/geometry of a media file. Empty dict if ffprobe is missing or fails."""
+    ffprobe = shutil.which("ffprobe")
+    if not ffprobe:
+        return {}
     try:
-        with YoutubeDL(ydl_opts2) as ydl:
-            info = ydl.extract_info(url, download=True)
+        r = subprocess.run(
+            [ffprobe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", str(path)],
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        data = json.loads(r.stdout or "{}")
     except Exception as e:
-        msg = str(e)
-        if "Impersonate target" in msg and "not available" in msg:
-            ydl_opts2.pop("impersonate", None)
-            log.warning("Impersonate o‘chirildi (mavjud emas): %s", msg)
-            with YoutubeDL(ydl_opts2) as ydl:
-                info = ydl.extract_info(url, download=True)
-        else:
-            raise
-        fp = ydl.prepare_filename(info)
-        p = Path(fp)
-        if p.exists():
-            return p
-        files = sorted(Path(workdir).glob("*"), key=lambda x: x.stat().st_mtime, reverse=True)
-        if not files:
-            raise RuntimeError("Audio fayl topilmadi")
-        return files[0]
+        log.warning("ffprobe xato (%s): %s", path.name, e)
+        return {}
+    out: Dict[str, Any] = {"format_name": str((data.get("format") or {}).get("format_name") or "")}
+    try:
+        out["duration"] = float((data.get("format") or {}).get("duration") or 0.0)
+    except Exception:
+        out["duration"] = 0.0
+    for st in data.get("streams") or []:
+        ctype = st.get("codec_type")
+        if ctype == "video" and "vcodec" not in out:
+            # cover art (mjpeg/png attached_pic) video hisoblanmaydi
+            if (st.get("disposition") or {}).get("attached_pic"):
+                continue
+            out["vcodec"] = str(st.get("codec_name") or "")
+            out["width"] = int(st.get("width") or 0)
+            out["height"] = int(st.get("height") or 0)
+        elif ctype == "audio" and "acodec" not in out:
+            out["acodec"] = str(st.get("codec_name") or "")
+    return out
 
 
-# ---------------------------- Bot Handlers ----------------------------
+def _plan_video_delivery(path: Path, probe: Dict[str, Any]) -> str:
+    """Decide how to deliver: "as_is" | "remux" (stream copy into mp4) | "transcode" (last resort)."""
+    if not probe:
+        # kodeklar noma'lum: mp4 bo‘lmasa hech bo‘lmasa remux qilib ko‘ramiz
+        return "as_is" if path.suffix.lower() == ".mp4" else "remux"
+    vcodec = probe.get("vcodec") or ""
+    acodec = probe.get("acodec") or ""
+    is_mp4 = path.suffix.lower() == ".mp4" and "mp4" in (probe.get("format_name") or "")
 
-def is_admin(user_id: Optional[int]) -> bool:
-    return bool(user_id) and (user_id in ADMIN_IDS)
+    tg_ok = (vcodec in _TG_VIDEO_CODECS) and (not acodec or acodec in _TG_AUDIO_CODECS)
+    if VIDEO_COMPAT == "strict":
+        if tg_ok:
+            return "as_is" if is_mp4 else "remux"
+        return "transcode"
 
-def start_text_by_lang(lang: str) -> str:
-    return START_TEXT_RU if lang == LANG_RU else START_TEXT_UZ
+    mp4_ok = (not vcodec or vcodec in _MP4_VIDEO_CODECS) and (not acodec or acodec in _MP4_AUDIO_CODECS)
+    if mp4_ok:
+        return "as_is" if is_mp4 else "remux"
+    return "transcode"
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.effective_user or not update.message:
-        return
 
-    # start bosganlarni DBga yozib boramiz
-    await STORE.touch_user(update.effective_user)
+def _ffmpeg_run(args: List[str], timeout: int) -> None:
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        raise RuntimeError("ffmpeg topilmadi")
+    subprocess.run([ffmpeg, "-y", "-hide_banner", "-loglevel", "error", *args], check=True, capture_output=True, timeout=timeout)
 
-    # Avval saqlangan til bo'lsa — shuni ishlatamiz, bo'lmasa default uz
-    lang = await STORE.get_lang(update.effective_user.id)
-    context.user_data["lang"] = lang
 
-    kb = [[
-        InlineKeyboardButton(_t(LANG_UZ, "btn_uz"), callback_data="lang|uz"),
-        InlineKeyboardButton(_t(LANG_RU, "btn_ru"), callback_data="lang|ru"),
-    ]]
+def _mp4_moov_after_mdat(path: Path) -> bool:
+    """True if a top-level mdat atom comes before moov, i.e. playback can't start until the whole file arrives."""
+    try:
+        with open(path, "rb") as f:
+            end = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos + 8 <= end:
+                f.seek(pos)
+                hdr = f.read(16)
+                size, typ = struct.unpack(">I4s", hdr[:8])
+                if size == 1:
+                    # 64-bit "largesize"
+                    if len(hdr) < 16:
+                        return False
+                    size = struct.unpack(">Q", hdr[8:16])[0]
+                elif size == 0:
+                    size = end - pos
+                if size < 8:
+                    return False
+                if typ == b"moov":
+                    return False
+                if typ == b"mdat":
+                    return True
+                pos += size
+    except Exception:
+        return False
+    return False
 
-    await update.message.reply_text(
-        start_text_by_lang(lang),
-        parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True,
-        reply_markup=InlineKeyboardMarkup(kb),
+
+def _remux_mp4(src: Path, dst: Path) -> Path:
+    _ffmpeg_run(
+        ["-i", str(src), "-map", "0:v:0?", "-map", "0:a:0?", "-c", "copy", "-movflags", "+faststart", str(dst)],
+        timeout=600,
+    )
+    return dst
+
+
+def _transcode_mp4(src: Path, dst: Path, probe: Dict[str, Any]) -> Path:
+    acodec = probe.get("acodec") or ""
+    audio_args = ["-c:a", "copy"] if acodec in _TG_AUDIO_CODECS else ["-c:a", "aac", "-b:a", "160k"]
+    _ffmpeg_run(
+        [
+            "-i", str(src),
+            "-map", "0:v:0?", "-map", "0:a:0?",
+            "-c:v", "libx264", "-preset", VIDEO_TRANSCODE_PRESET, "-crf", str(VIDEO_TRANSCODE_CRF),
+            "-pix_fmt", "yuv420p", "-threads", str(max(1, VIDEO_TRANSCODE_THREADS)),
+            *audio_args,
+            "-movflags", "+faststart",
+            str(dst),
+        ],
+        timeout=3600,
     )
+    return dst
 
-async def on_lang_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    if not q or not q.from_user:
-        return
+
+def _plan_finalize(res: MediaResult) -> Tuple[MediaResult, str, Dict[str, Any]]:
+    """Probe the downloaded file and pick the cheapest operation that makes it deliverable.
+
+    Returns (res with probe fields applied, plan, probe); plan "as_is" needs no ffmpeg at all.
+    """
+    path = res.path
+    probe = _ffprobe(path)
+    res.apply_probe(probe)
+    plan = _plan_video_delivery(path, probe)
+    log.info(
+        "Video plan: %s (v=%s a=%s %sx%s container=%s)",
+        plan, res.vcodec, res.acodec, res.width, res.height, path.suffix.lower(),
+    )
+    if plan == "as_is" and path.suffix.lower() == ".mp4" and _mp4_moov_after_mdat(path):
+        # moov oxirida: stream copy bilan oldinga ko‘chiramiz (faststart)
+        plan = "faststart"
+        log.info("Video plan: faststart (moov after mdat)")
+    return res, plan, probe
+
+
+def _finalize_video(res: MediaResult, plan: str, probe: Dict[str, Any], workdir: str) -> MediaResult:
+    """Carry out a _plan_finalize plan (remux/faststart/transcode) into an mp4 next to the source."""
+    path = res.path
+    if plan == "as_is":
+        return res
+    dst = Path(workdir) / f"{path.stem}.{plan}.mp4"
+    try:
+        if plan == "transcode":
+            out = _transcode_mp4(path, dst, probe)
+        else:
+            out = _remux_mp4(path, dst)
+    except Exception as e:
+        log.warning("Video %s muvaffaqiyatsiz, asl fayl yuboriladi: %s", plan, e)
+        return res
+    try:
+        path.unlink()
+    except Exception:
+        pass
+    final = path.with_suffix(".mp4")
+    try:
+        os.replace(out, final)
+    except Exception:
+        final = out
+    if plan == "transcode":
+        res.vcodec = "h264"
+    return res.moved_to(final)
+
+
+def _make_video_thumbnail(res: MediaResult, workdir: str) -> Optional[Path]:
+    """JPEG thumbnail within Telegram's 320x320 limit: a frame from the file, else the yt-dlp thumbnail URL."""
+    dst = Path(workdir) / f"{res.path.stem}.thumb.jpg"
+    scale = ["-vf", "scale=320:320:force_original_aspect_ratio=decrease", "-frames:v", "1", "-q:v", "5"]
+    seek = min(1.0, res.duration / 2) if res.duration else 0.0
+    try:
+        _ffmpeg_run(["-ss", f"{seek:.2f}", "-i", str(res.path), *scale, str(dst)], timeout=60)
+        if dst.exists() and 0 < dst.stat().st_size <= 200 * 1024:
+            return dst
+    except Exception as e:
+        log.info("Kadrdan thumbnail olinmadi: %s", e)
+    if not res.thumbnail_url:
+        return None
+    src = Path(workdir) / f"{res.path.stem}.thumb.src"
+    try:
+        req = urllib.request.Request(res.thumbnail_url, headers={"User-Agent": "Mozilla/5.0"})
+        with urllib.request.urlopen(req, timeout=15) as resp:
+            src.write_bytes(resp.read(5 * 1024 * 1024))
+        _ffmpeg_run(["-i", str(src), *scale, str(dst)], timeout=60)
+        if dst.exists() and 0 < dst.stat().st_size <= 200 * 1024:
+            return dst
+    except Exception as e:
+        log.info("Thumbnail URL'dan olinmadi: %s", e)
+    return None
+
+
+def _probe_result(path: Path) -> MediaResult:
+    """MediaResult for a file we did not download just now (e.g. a media cache hit)."""
+    return MediaResult(path).apply_probe(_ffprobe(path))
+
+
+# ---------------------------- Size-aware format planner ----------------------------
+
+class MediaTooLarge(Exception):
+    """Nothing deliverable fits the size limit. `size` is the best known size in bytes."""
+
+    def __init__(self, size: int, limit: int) -> None:
+        super().__init__(f"media too large: {size} > {limit} bytes")
+        self.size = int(size or 0)
+        self.limit = int(limit or 0)
+
+    def __reduce__(self):
+        # stage worker jarayonidan pipe orqali qaytadi
+        return (type(self), (self.size, self.limit))
+
+
+def _video_fit_limit_bytes(url: str) -> int:
+    """Largest file we can both download and upload (0 = no limit)."""
+    limits = [DL_MAX_MB, TG_MAX_UPLOAD_MB]
+    if is_youtube(url):
+        limits.append(YT_MAX_MB)
+    limits = [x for x in limits if x > 0]
+    return min(limits) * 1024 * 1024 if limits else 0
+
+
+def _head_content_length(f: Dict[str, Any]) -> int:
+    """Content-Length of a plain http(s) format URL; 0 if unknown (HLS/DASH, no header, error)."""
+    fmt_url = f.get("url")
+    if not fmt_url or str(f.get("protocol") or "") not in ("http", "https"):
+        return 0
+    headers = dict(f.get("http_headers") or {})
+    headers.setdefault("User-Agent", "Mozilla/5.0")
+    try:
+        req = urllib.request.Request(fmt_url, headers=headers, method="HEAD")
+        with urllib.request.urlopen(req, timeout=8) as resp:
+            return int(resp.headers.get("Content-Length") or 0)
+    except Exception:
+        return 0
+
+
+def _format_has_audio(f: Dict[str, Any]) -> Optional[bool]:
+    """True/False from acodec; None when the extractor did not say."""
+    acodec = f.get("acodec")
+    if acodec is None:
+        return None
+    return acodec != "none"
+
+
+def _plan_video_fit(
+    info: Dict[str, Any],
+    format_id: Optional[str],
+    has_audio: Optional[bool],
+    limit: int,
+) -> Tuple[Optional[str], Optional[bool], int, bool]:
+    """Pick the best format that fits `limit` before downloading anything.
+
+    Returns (format_id, has_audio, estimated_bytes, reencode). The requested format is kept
+    when it fits or its size is unknown; otherwise the best lower quality with a known size
+    under the limit is chosen. If nothing fits: MediaTooLarge, or (OVERSIZE_MODE=reencode)
+    the smallest format plus reencode=True.
+    """
+    formats = [f for f in (info.get("formats") or []) if _is_plannable_video_format(f)]
+    if not formats or limit <= 0:
+        return format_id, has_audio, 0, False
+
+    fid = str(format_id or "")
+    if fid.startswith("h:"):
+        try:
+            wanted = _best_video_format_under_height(info, int(fid.split(":", 1)[1]))
+        except Exception:
+            wanted = None
+    elif fid:
+        wanted = next((f for f in formats if str(f.get("format_id")) == fid), None)
+    else:
+        wanted = max(formats, key=lambda f: (_yt_height(f), float(f.get("tbr") or 0)))
+    if not wanted:
+        return format_id, has_audio, 0, False
+
+    sizes: Dict[str, int] = {}
+    probes_left = [max(0, VIDEO_SIZE_PROBES)]
+
+    def size_of(f: Dict[str, Any]) -> int:
+        k = str(f.get("format_id"))
+        if k in sizes:
+            return sizes[k]
+        sz = _video_total_size_bytes_strict(info, f)
+        if sz <= 0 and probes_left[0] > 0 and str(f.get("protocol") or "") in ("http", "https"):
+            probes_left[0] -= 1
+            sz = _head_content_length(f)
+            if sz > 0 and f.get("acodec") in (None, "none"):
+                sz += _best_audio_size_bytes(info)
+        sizes[k] = sz
+        return sz
+
+    wanted_size = size_of(wanted)
+    if wanted_size <= 0 or wanted_size <= limit:
+        return format_id, has_audio, wanted_size, False
+
+    wanted_h = _yt_height(wanted)
+    lower = sorted(
+        (f for f in formats if f is not wanted and _yt_height(f) <= wanted_h),
+        key=lambda f: (_yt_height(f), float(f.get("tbr") or 0)),
+        reverse=True,
+    )
+    for f in lower:
+        sz = size_of(f)
+        if 0 < sz <= limit:
+            log.info("Size plan: %s (%dMB) -> %s (%dMB), limit %dMB",
+                     wanted.get("format_id"), wanted_size >> 20, f.get("format_id"), sz >> 20, limit >> 20)
+            return str(f.get("format_id")), _format_has_audio(f), sz, False
+
+    if OVERSIZE_MODE == "reencode":
+        known = [(sz, f) for f in [wanted, *lower] if (sz := size_of(f)) > 0]
+        smallest_sz, smallest = min(known, key=lambda x: x[0])
+        if DL_MAX_MB <= 0 or smallest_sz <= DL_MAX_MB * 1024 * 1024:
+            return str(smallest.get("format_id")), _format_has_audio(smallest), smallest_sz, True
+    raise MediaTooLarge(wanted_size, limit)
+
+
+def _reencode_to_fit(res: MediaResult, workdir: str, limit: int) -> MediaResult:
+    """Re-encode to an average bitrate that lands under `limit` (OVERSIZE_MODE=reencode)."""
+    if res.duration <= 0:
+        raise MediaTooLarge(res.size, limit)
+    audio_kbps = 96
+    # konteyner/bitreyt tebranishi uchun ~8% zaxira
+    total_kbps = int(limit * 8 * 0.92 / res.duration / 1000)
+    video_kbps = total_kbps - audio_kbps
+    if video_kbps < 150:
+        raise MediaTooLarge(res.size, limit)
+    max_h = 360 if video_kbps < 500 else 480 if video_kbps < 1000 else 720 if video_kbps < 2500 else 1080
+    dst = Path(workdir) / f"{res.path.stem}.fit.mp4"
+    _ffmpeg_run(
+        [
+            "-i", str(res.path),
+            "-map", "0:v:0?", "-map", "0:a:0?",
+            "-vf", f"scale=-2:'min(ih,{max_h})'",
+            "-c:v", "libx264", "-preset", VIDEO_TRANSCODE_PRESET,
+            "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+            "-pix_fmt", "yuv420p", "-threads", str(max(1, VIDEO_TRANSCODE_THREADS)),
+            "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+            "-movflags", "+faststart",
+            str(dst),
+        ],
+        timeout=3600,
+    )
+    if dst.stat().st_size > limit:
+        raise MediaTooLarge(dst.stat().st_size, limit)
+    try:
+        res.path.unlink()
+    except Exception:
+        pass
+    out = res.moved_to(dst).apply_probe(_ffprobe(dst))
+    out.vcodec = out.vcodec or "h264"
+    return out
+
+
+# ---------------------------- Adaptive download concurrency ----------------------------
+
+def _mem_available_bytes() -> int:
+    """Available memory, respecting a cgroup v2 limit (containers). 0 if unknown."""
+    avail = 0
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    avail = int(line.split()[1]) * 1024
+                    break
+    except Exception:
+        pass
+    try:
+        limit_raw = Path("/sys/fs/cgroup/memory.max").read_text().strip()
+        if limit_raw != "max":
+            used = int(Path("/sys/fs/cgroup/memory.current").read_text().strip())
+            cg_avail = max(0, int(limit_raw) - used)
+            avail = min(avail, cg_avail) if avail else cg_avail
+    except Exception:
+        pass
+    return avail
+
+
+def _load_per_cpu() -> float:
+    try:
+        return os.getloadavg()[0] / max(1, os.cpu_count() or 1)
+    except Exception:
+        return 0.0
+
+
+class AdaptiveLimiter:
+    """`async with` slot limiter whose limit moves within [lo, hi] (AIMD).
+
+    Every `interval` seconds (evaluated lazily on enter/exit):
+      - pressure (loadavg per CPU, low available memory, any 429 from origins) -> halve the limit;
+      - all slots busy and the last +1 actually raised aggregate throughput -> +1;
+      - all slots busy but the last +1 didn't help (>=5% more bytes/s) -> step back -1.
+    `set_fixed(n)` pins the limit (admin /dlslots), `set_fixed(None)` returns to adaptive mode.
+    """
+
+    def __init__(self, initial: int, lo: int, hi: int, adaptive: bool) -> None:
+        self.lo = max(1, lo)
+        self.hi = max(self.lo, hi)
+        self.limit = min(self.hi, max(self.lo, initial))
+        self.adaptive = adaptive
+        self.active = 0
+        self._waiters: List[asyncio.Future] = []
+        self._window_start = _now_ts()
+        self._bytes = 0
+        self._peak = 0
+        self._rate_limited = 0
+        self._prev_tput = 0.0
+        self._last_step = 0
+        self.last_reason = "init"
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        self._maybe_adjust()
+        while self.active >= self.limit:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # job bekor qilindi — bizga berilgan uyg‘onishni keyingi kutayotganga o‘tkazamiz
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+                self._wake()
+                raise
+            finally:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+        self.active += 1
+        self._peak = max(self._peak, self.active)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.active -= 1
+        if exc is not None and _classify_ydl_error(exc) == "rate_limited":
+            self._rate_limited += 1
+        self._maybe_adjust()
+        self._wake()
+
+    def _wake(self) -> None:
+        free = self.limit - self.active
+        for fut in list(self._waiters):
+            if free <= 0:
+                break
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+    def record(self, nbytes: int, rate_limited: bool = False) -> None:
+        """Bytes actually fetched by a job (throughput signal)."""
+        self._bytes += max(0, int(nbytes or 0))
+        if rate_limited:
+            self._rate_limited += 1
+
+    def set_fixed(self, n: Optional[int]) -> None:
+        if n is None:
+            self.adaptive = True
+            self.last_reason = "admin: auto"
+        else:
+            self.adaptive = False
+            self.limit = max(1, n)
+            self.last_reason = "admin: fixed"
+        self._wake()
+
+    def _maybe_adjust(self) -> None:
+        now = _now_ts()
+        elapsed = now - self._window_start
+        if elapsed < max(5, DL_ADAPT_INTERVAL):
+            return
+        tput = self._bytes / elapsed if elapsed > 0 else 0.0
+        saturated = self._peak >= self.limit or bool(self._waiters)
+        old = self.limit
+
+        if self.adaptive:
+            load = _load_per_cpu()
+            mem = _mem_available_bytes()
+            if self._rate_limited:
+                self.limit = max(self.lo, self.limit // 2)
+                self.last_reason = f"429 x{self._rate_limited}"
+            elif load > DL_ADAPT_MAX_LOAD:
+                self.limit = max(self.lo, self.limit // 2)
+                self.last_reason = f"load {load:.2f}/cpu"
+            elif mem and mem < DL_ADAPT_MIN_MEM_MB * 1024 * 1024:
+                self.limit = max(self.lo, self.limit // 2)
+                self.last_reason = f"mem {mem >> 20}MB"
+            elif saturated:
+                if self._last_step > 0 and self._prev_tput > 0 and tput < self._prev_tput * 1.05:
+                    self.limit = max(self.lo, self.limit - 1)
+                    self.last_reason = "no throughput gain"
+                else:
+                    self.limit = min(self.hi, self.limit + 1)
+                    self.last_reason = "saturated"
+            if self.limit != old:
+                log.info("Download slots: %d -> %d (%s, %.1fMB/s)", old, self.limit, self.last_reason, tput / 1048576)
+        self._last_step = self.limit - old
+        self._prev_tput = tput
+        self._window_start = now
+        self._bytes = 0
+        self._peak = self.active
+        self._rate_limited = 0
+        if self.limit > old:
+            self._wake()
+
+    def stats(self) -> str:
+        mode = "auto" if self.adaptive else "fixed"
+        return (
+            f"slots={self.limit} ({mode}, {self.lo}..{self.hi}) active={self.active} waiting={len(self._waiters)}\n"
+            f"last: {self.last_reason}, throughput={self._prev_tput / 1048576:.1f}MB/s\n"
+            f"load/cpu={_load_per_cpu():.2f} mem_avail={_mem_available_bytes() >> 20}MB"
+        )
+
+
+DOWNLOAD_SEM = AdaptiveLimiter(DL_CONCURRENCY, DL_MIN_CONCURRENCY, DL_MAX_CONCURRENCY, DL_ADAPTIVE)
+
+
+# ---------------------------- Work dir disk admission ----------------------------
+
+class DiskSpaceBusy(Exception):
+    """Not enough free space in WORK_ROOT for this job (even after waiting)."""
+
+
+class DiskAdmission:
+    """Reserve estimated temp-disk bytes per job against free space under `root`.
+
+    Jobs that don't fit wait (polling, so space freed by other processes on the same disk
+    counts too). Reservations are counted in full even while the files are still growing —
+    deliberately conservative.
+    """
+
+    def __init__(self, root: Path, min_free_bytes: int) -> None:
+        self.root = root
+        self.min_free = max(0, min_free_bytes)
+        self.reserved = 0
+        self.waiting = 0
+
+    def free_bytes(self) -> int:
+        try:
+            return shutil.disk_usage(self.root).free
+        except Exception:
+            return 0
+
+    def _fits(self, need: int) -> bool:
+        return self.free_bytes() - self.reserved - need >= self.min_free
+
+    async def acquire(self, est_bytes: int, factor: float) -> int:
+        """Wait until `est_bytes * factor` fits, reserve it and return the reserved amount (for release())."""
+        need = int(max(1, est_bytes) * max(1.0, factor))
+        deadline = _now_ts() + max(0, DISK_WAIT_SECONDS)
+        logged = False
+        self.waiting += 1
+        try:
+            while not self._fits(need):
+                # Hech kim joy band qilmagan bo‘lsa, kutishdan foyda yo‘q
+                if self.reserved <= 0 or _now_ts() >= deadline:
+                    raise DiskSpaceBusy(f"need {need >> 20}MB, free {self.free_bytes() >> 20}MB, reserved {self.reserved >> 20}MB")
+                if not logged:
+                    log.info("Disk admission: %dMB kerak, bo‘sh %dMB (band %dMB) — kutamiz",
+                             need >> 20, self.free_bytes() >> 20, self.reserved >> 20)
+                    logged = True
+                await asyncio.sleep(2)
+        finally:
+            self.waiting -= 1
+        self.reserved += need
+        return need
+
+    def release(self, amount: int) -> None:
+        if amount > 0:
+            self.reserved = max(0, self.reserved - amount)
+
+    def stats(self) -> str:
+        return (
+            f"root={self.root} free={self.free_bytes() >> 20}MB "
+            f"reserved={self.reserved >> 20}MB waiting={self.waiting}"
+        )
+
+
+DISK_ADMISSION = DiskAdmission(WORK_ROOT, DISK_MIN_FREE_MB * 1024 * 1024)
+
+
+def _sweep_stale_workdirs(root: Path, max_age_seconds: int = 1800) -> int:
+    """Remove dlbot_* dirs left behind by crashed processes (nothing inside touched recently)."""
+    removed = 0
+    now = _now_ts()
+    for d in root.glob("dlbot_*"):
+        try:
+            if not d.is_dir():
+                continue
+            newest = d.stat().st_mtime
+            for f in d.rglob("*"):
+                try:
+                    newest = max(newest, f.stat().st_mtime)
+                except Exception:
+                    pass
+            if now - newest < max_age_seconds:
+                continue
+            shutil.rmtree(d, ignore_errors=True)
+            removed += 1
+        except Exception:
+            continue
+    if removed:
+        log.info("Eski work papkalar o‘chirildi: %d ta (%s)", removed, root)
+    return removed
+
+
+def _disk_est_bytes(total_bytes: int) -> int:
+    """Job size estimate: menu size if known, else the byte guard's worst case (DL_MAX_MB)."""
+    if total_bytes > 0:
+        return total_bytes
+    return (DL_MAX_MB if DL_MAX_MB > 0 else 200) * 1024 * 1024
+
+
+def _disk_est_audio_bytes(total_bytes: int) -> int:
+    """Audio job size estimate: menu size if known, else DISK_AUDIO_EST_MB (~30 min of 128k audio by default)."""
+    if total_bytes > 0:
+        return total_bytes
+    return max(1, DISK_AUDIO_EST_MB) * 1024 * 1024
+
+
+# ---------------------------- Local disk media cache ----------------------------
+
+class MediaDiskCache:
+    """Size-bounded on-disk LRU (by bytes) of finished media files.
+
+    Layout: <root>/<sha1(key)>/<original file name> + meta.json ({"key", "group", "tag"}).
+    group = canonical URL, tag = what the file is ("video", "audio", "audio_src"), so
+    other kinds of the same link can be derived locally instead of re-fetching.
+    The entry directory mtime is the LRU clock, so order survives restarts.
+    With ttl_seconds > 0 entries not used for that long are dropped (short-lived retry area).
+    Methods are blocking (file IO) — call them via run_in_executor.
+    """
+
+    META_NAME = "meta.json"
+
+    def __init__(self, root: Path, max_bytes: int, ttl_seconds: int = 0) -> None:
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = max(0, int(ttl_seconds))
+        self._lock = threading.Lock()
+        # digest -> (file path, size, group, tag)
+        self._index: "OrderedDict[str, Tuple[Path, int, str, str]]" = OrderedDict()
+        self._total = 0
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            log.warning("Media cache papkasi yaratilmadi (%s): %s", self.root, e)
+            self.max_bytes = 0
+            return
+        entries: List[Tuple[float, str, Path, int, str, str]] = []
+        for d in self.root.iterdir():
+            if not d.is_dir():
+                continue
+            if d.name.startswith("."):
+                # chala qolgan (crash) yozuvlar
+                shutil.rmtree(d, ignore_errors=True)
+                continue
+            try:
+                if self._expired(d):
+                    raise ValueError("expired")
+                meta = json.loads((d / self.META_NAME).read_text(encoding="utf-8"))
+                files = [x for x in d.iterdir() if x.is_file() and x.name != self.META_NAME]
+                if not files:
+                    raise ValueError("empty")
+                fp = files[0]
+                entries.append((
+                    d.stat().st_mtime, d.name, fp, fp.stat().st_size,
+                    str(meta.get("group") or ""), str(meta.get("tag") or ""),
+                ))
+            except Exception:
+                shutil.rmtree(d, ignore_errors=True)
+        entries.sort()
+        for _, dg, fp, size, group, tag in entries:
+            self._index[dg] = (fp, size, group, tag)
+            self._total += size
+        self._evict_locked()
+        log.info("Media cache: %d ta fayl, %s (max %s)", len(self._index), human_mb(self._total) or "0MB", human_mb(self.max_bytes))
+
+    def _expired(self, d: Path) -> bool:
+        if not self.ttl_seconds:
+            return False
+        try:
+            return _now_ts() - d.stat().st_mtime > self.ttl_seconds
+        except Exception:
+            return True
+
+    def _drop_locked(self, dg: str) -> None:
+        ent = self._index.pop(dg, None)
+        if ent:
+            self._total -= ent[1]
+        shutil.rmtree(self.root / dg, ignore_errors=True)
+
+    def _evict_locked(self) -> None:
+        while self._index and self._total > self.max_bytes:
+            dg, (fp, size, _, _) = self._index.popitem(last=False)
+            self._total -= size
+            shutil.rmtree(self.root / dg, ignore_errors=True)
+        # LRU tartibida: eng eskisi birinchi, muddati o‘tmaganiga yetganda to‘xtaymiz
+        while self.ttl_seconds and self._index:
+            dg = next(iter(self._index))
+            if not self._expired(self.root / dg):
+                break
+            self._drop_locked(dg)
+
+    def _touch_locked(self, dg: str) -> None:
+        self._index.move_to_end(dg)
+        try:
+            os.utime(self.root / dg, None)
+        except Exception:
+            pass
+
+    def _checkout_locked(self, dg: str, workdir: str) -> Optional[Path]:
+        ent = self._index.get(dg)
+        if not ent or not ent[0].exists() or self._expired(self.root / dg):
+            if ent:
+                self._drop_locked(dg)
+            return None
+        self._touch_locked(dg)
+        src = ent[0]
+        dst = Path(workdir) / src.name
+        try:
+            os.link(src, dst)
+        except Exception:
+            try:
+                shutil.copy2(src, dst)
+            except Exception as e:
+                log.warning("Media cache checkout xato: %s", e)
+                return None
+        return dst
+
+    def checkout(self, key: str, workdir: str) -> Optional[Path]:
+        """Return a private copy (hardlink when possible) of the cached file inside workdir."""
+        if not self.enabled or not key:
+            return None
+        with self._lock:
+            self._load()
+            return self._checkout_locked(self._digest(key), workdir)
+
+    def checkout_group(self, group: str, tag: str, workdir: str) -> Optional[Path]:
+        """Like checkout(), but for the most recently used entry of this link (group) with the given tag."""
+        if not self.enabled or not group:
+            return None
+        with self._lock:
+            self._load()
+            for dg in reversed(list(self._index.keys())):
+                _, _, g, t = self._index[dg]
+                if g == group and t == tag:
+                    return self._checkout_locked(dg, workdir)
+        return None
+
+    def put(self, key: str, src: Path, group: str = "", tag: str = "") -> bool:
+        if not self.enabled or not key:
+            return False
+        try:
+            size = src.stat().st_size
+        except Exception:
+            return False
+        if size <= 0 or size > self.max_bytes:
+            return False
+        dg = self._digest(key)
+        with self._lock:
+            self._load()
+            if not self.enabled:
+                return False
+        tmp = self.root / f".{dg}.{uuid.uuid4().hex[:8]}"
+        try:
+            tmp.mkdir(parents=True)
+            dst = tmp / src.name
+            try:
+                os.link(src, dst)
+            except Exception:
+                shutil.copy2(src, dst)
+            (tmp / self.META_NAME).write_text(
+                json.dumps({"key": key, "group": group, "tag": tag}, ensure_ascii=False), encoding="utf-8"
+            )
+            with self._lock:
+                old = self._index.pop(dg, None)
+                if old:
+                    self._total -= old[1]
+                shutil.rmtree(self.root / dg, ignore_errors=True)
+                os.replace(tmp, self.root / dg)
+                self._index[dg] = (self.root / dg / src.name, size, group, tag)
+                self._total += size
+                self._evict_locked()
+            return True
+        except Exception as e:
+            log.warning("Media cache put xato: %s", e)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+
+    def prune(self) -> None:
+        """Drop expired / over-budget entries (the TTL is otherwise only checked on access)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._load()
+            self._evict_locked()
+
+    def discard(self, key: str) -> None:
+        if not self.enabled or not key:
+            return
+        with self._lock:
+            self._load()
+            self._drop_locked(self._digest(key))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"files": len(self._index), "bytes": self._total, "max_bytes": self.max_bytes}
+
+
+MEDIA_CACHE = MediaDiskCache(MEDIA_CACHE_DIR, int(MEDIA_CACHE_MAX_GB * 1024 * 1024 * 1024))
+# Telegram'ga yuborilmay qolgan fayllar (tarmoq xatosi): qisqa muddat saqlanadi, qayta so‘ralganda origin'ga bormaymiz.
+# WORK_ROOT ichida (dlbot_* sweep'iga tushmaydi); egallagan joyi DISK_ADMISSION'ning bo‘sh joy o‘lchovida ko‘rinadi.
+UPLOAD_RETRY = MediaDiskCache(WORK_ROOT / "upload_retry", int(UPLOAD_RETRY_MAX_GB * 1024 * 1024 * 1024), UPLOAD_RETRY_TTL)
+
+
+async def _upload_retry_checkout(key: str, workdir: str) -> Optional[Path]:
+    """A file that was downloaded earlier but never reached Telegram (see _upload_keeping_file)."""
+    if not UPLOAD_RETRY.enabled:
+        return None
+    hit = await asyncio.get_running_loop().run_in_executor(None, UPLOAD_RETRY.checkout, key, workdir)
+    if hit:
+        log.info("Upload retry: saqlangan fayl ishlatildi (qayta yuklanmadi): %s", key)
+    return hit
+
+async def _media_cache_store(key: str, url: str, path: Optional[Path], tag: str) -> None:
+    if not MEDIA_CACHE.enabled or not path:
+        return
+    try:
+        size_mb = path.stat().st_size / (1024 * 1024)
+    except Exception:
+        size_mb = 0.0
+    # limitdan katta fayllar baribir yuborilmaydi — keshlamaymiz
+    if size_mb > 0 and not (DL_MAX_MB > 0 and size_mb > DL_MAX_MB):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, MEDIA_CACHE.put, key, path, _normalize_url_for_cache(url), tag)
+
+
+def _audio_source_codecs(src: Path) -> Tuple[str, bool]:
+    """(acodec, has_video) of a downloaded/cached source."""
+    probe = _ffprobe(src)
+    if not probe:
+        # ffprobe yo‘q: kengaytma bo‘yicha taxmin
+        ext = src.suffix.lower()
+        return {".m4a": "aac", ".aac": "aac", ".mp3": "mp3"}.get(ext, ""), ext in (".mp4", ".mkv", ".webm", ".mov")
+    return probe.get("acodec") or "", bool(probe.get("vcodec"))
+
+
+def _audio_sent_as_is(acodec: str, has_video: bool) -> bool:
+    return not has_video and (acodec == "mp3" or (AUDIO_DELIVERY == "auto" and acodec == "aac"))
+
+
+def _audio_for_delivery(src: Path, workdir: str, codecs: Optional[Tuple[str, bool]] = None) -> Path:
+    """Turn a downloaded/cached source (audio stream or full video) into the file we send.
+
+    AUDIO_DELIVERY=auto: AAC/MP3 audio is sent as-is (from a video it is stream-copied to .m4a).
+    Otherwise (or for opus/vorbis/...) it is encoded to MP3. If encoding fails, an audio-only
+    source is returned unchanged — we never re-download because of a postprocessing error.
+    `codecs` is a ready _audio_source_codecs result (skips the probe).
+    """
+    acodec, has_video = codecs or _audio_source_codecs(src)
+
+    # "title.f140.m4a" -> "title"
+    stem = re.sub(r"\.f[0-9A-Za-z_-]+$", "", src.stem) or "audio"
+
+    if _audio_sent_as_is(acodec, has_video):
+        return src
+
+    if AUDIO_DELIVERY == "auto" and has_video and acodec == "aac":
+        out = Path(workdir) / f"{stem}.m4a"
+        try:
+            _ffmpeg_run(["-i", str(src), "-vn", "-c:a", "copy", str(out)], timeout=600)
+            return out
+        except Exception as e:
+            log.warning("AAC stream copy muvaffaqiyatsiz, MP3 ga o‘tamiz: %s", e)
+
+    out = Path(workdir) / f"{stem}.mp3"
+    if out == src:
+        out = Path(workdir) / f"{stem}.audio.mp3"
+    try:
+        _ffmpeg_run(["-i", str(src), "-vn", "-acodec", "libmp3lame", "-b:a", AUDIO_MP3_BITRATE, str(out)], timeout=900)
+        if out.exists() and out.stat().st_size > 0:
+            return out
+        raise RuntimeError("MP3 bo‘sh chiqdi")
+    except Exception as e:
+        if not has_video:
+            log.warning("MP3 konvertatsiya muvaffaqiyatsiz (ffmpeg yo'q bo'lishi mumkin). Asl audio yuboriladi: %s", e)
+            return src
+        raise
+
+async def _deliverable_audio(src: Path, workdir: str) -> Path:
+    """_audio_for_delivery with the probe outside FFMPEG_SEM: a slot is taken only when ffmpeg runs."""
+    codecs = await _run_stage("ffmpeg", _audio_source_codecs, src)
+    if _audio_sent_as_is(*codecs):
+        return src
+    async with FFMPEG_SEM:
+        return await _run_stage("ffmpeg", _audio_for_delivery, src, workdir, codecs)
+
+
+async def _fetch_audio(key: str, url: str, workdir: str, fn, *args) -> Path:
+    """Audio: exact cache hit -> derive from this link's cached bestaudio/video -> download once.
+
+    The downloaded source is cached as "audio_src" next to the produced delivery file,
+    so a different delivery later (or a video->audio pair) never hits the origin again.
+    """
+    loop = asyncio.get_running_loop()
+    if MEDIA_CACHE.enabled:
+        hit = await loop.run_in_executor(None, MEDIA_CACHE.checkout, key, workdir)
+        if hit:
+            log.info("Media cache hit: %s", key)
+            return hit
+        group = _normalize_url_for_cache(url)
+        for tag in ("audio_src", "video"):
+            src = await loop.run_in_executor(None, MEDIA_CACHE.checkout_group, group, tag, workdir)
+            if not src:
+                continue
+            try:
+                out = await _deliverable_audio(src, workdir)
+            except Exception as e:
+                log.warning("Lokal %s fayldan audio ajratib bo‘lmadi: %s", tag, e)
+                continue
+            log.info("Audio lokal %s fayldan olindi (origin'dan qayta yuklanmadi): %s", tag, group)
+            await _media_cache_store(key, url, out, "audio")
+            return out
+    kept = await _upload_retry_checkout(key, workdir)
+    if kept:
+        return kept
+
+    fragments = PROFILE_TUNER.fragments(platform_of(url))
+    t0 = time.monotonic()
+    src = await _origin_call(url, fn, *args)
+    if isinstance(src, MediaResult):
+        src = src.path
+    _observe_download(url, fragments, _file_size(src), time.monotonic() - t0)
+    if fn is _download_audio:
+        await _media_cache_store(_make_fileid_cache_key(url, "audio_src"), url, src, "audio_src")
+    out = await _deliverable_audio(src, workdir)
+    await _media_cache_store(key, url, out, "audio")
+    return out
+
+
+async def _fetch_video(
+    key: str,
+    url: str,
+    workdir: str,
+    format_id: Optional[str],
+    has_audio: Optional[bool],
+    total_bytes: int = 0,
+    notify=None,
+) -> MediaResult:
+    """Video: cache hit or download. A bestaudio stream kept from a merge is cached for later audio requests.
+
+    Before downloading, the size planner may switch to a lower quality that fits the limit
+    (`notify(h, size_mb, max_mb)` is awaited when it does). Raises MediaTooLarge if nothing fits.
+    """
+    loop = asyncio.get_running_loop()
+    if MEDIA_CACHE.enabled:
+        hit = await loop.run_in_executor(None, MEDIA_CACHE.checkout, key, workdir)
+        if hit:
+            log.info("Media cache hit: %s", key)
+            res = await _run_stage("ffmpeg", _probe_result, hit)
+            res.thumbnail = await _run_stage("ffmpeg", _make_video_thumbnail, res, workdir)
+            return res
+    kept = await _upload_retry_checkout(key, workdir)
+    if kept:
+        res = await _run_stage("ffmpeg", _probe_result, kept)
+        res.thumbnail = await _run_stage("ffmpeg", _make_video_thumbnail, res, workdir)
+        return res
+    limit = _video_fit_limit_bytes(url)
+    info: Optional[Dict[str, Any]] = None
+    reencode = False
+    requested_fid = format_id
+    # YouTube: menyu hajmni allaqachon bilgan — sig‘sa qayta extract qilmaymiz.
+    # Boshqa tarmoqlar: info bir marta olinadi va yuklashda qayta ishlatiladi.
+    if VIDEO_SIZE_FALLBACK and limit > 0 and (not is_youtube(url) or total_bytes > limit):
+        try:
+            info = await _origin_call(url, _extract_info, url)
+        except OriginUnavailable:
+            raise
+        except Exception as e:
+            log.warning("Size plan: extract_info xato, rejasiz yuklaymiz: %s", e)
+        if info:
+            # HEAD so‘rovlari origin'ga — extract muddati bilan
+            new_fid, new_has_audio, est, reencode = await _run_stage(
+                "extract", _plan_video_fit, info, format_id, has_audio, limit
+            )
+            if new_fid != format_id and notify:
+                chosen = next((f for f in info.get("formats") or [] if str(f.get("format_id")) == new_fid), {})
+                try:
+                    await notify(_yt_height(chosen), int(est / (1024 * 1024) + 0.999), limit // (1024 * 1024))
+                except Exception:
+                    pass
+            format_id, has_audio = new_fid, new_has_audio
+            if is_youtube(url):
+                # YouTube: extract va yuklash har xil player_client bilan — info'ni qayta ishlatmaymiz
+                info = None
+    fragments = PROFILE_TUNER.fragments(platform_of(url))
+    t0 = time.monotonic()
+    res = await _origin_call(url, _download_video, url, format_id, workdir, has_audio, MEDIA_CACHE.enabled, info)
+    _observe_download(url, fragments, res.size + (_file_size(res.audio_src) if res.audio_src else 0), time.monotonic() - t0)
+    # remux/transcode — CPU og‘ir bo‘lishi mumkin, shuning uchun umumiy ffmpeg slotlari orqali;
+    # probe arzon — slot faqat ffmpeg haqiqatan ishlaganda olinadi (as_is fayl navbatda turmaydi)
+    res, plan, probe = await _run_stage("ffmpeg", _plan_finalize, res)
+    if plan != "as_is":
+        async with FFMPEG_SEM:
+            res = await _run_stage("ffmpeg", _finalize_video, res, plan, probe, workdir)
+    if reencode and limit > 0 and res.size > limit:
+        async with FFMPEG_SEM:
+            res = await _run_stage("ffmpeg", _reencode_to_fit, res, workdir, limit)
+        res.fallback = True
+    if format_id != requested_fid:
+        res.fallback = True
+    if res.fallback:
+        # pastroq sifat: `key` so‘ralgan formatniki — keshlasak, keyingi so‘rov ham shu faylni oladi
+        log.info("Size fallback natijasi keshlanmaydi: %s", key)
+    else:
+        await _media_cache_store(key, url, res.path, "video")
+        if res.audio_src:
+            await _media_cache_store(_make_fileid_cache_key(url, "audio_src"), url, res.audio_src, "audio_src")
+    # bitta kadr — arzon, ffmpeg slotini band qilmaymiz (uzun transcode ortida qolib ketmasin)
+    res.thumbnail = await _run_stage("ffmpeg", _make_video_thumbnail, res, workdir)
+    return res
+
+
+# ---------------------------- Bot Handlers ----------------------------
+
+def is_admin(user_id: Optional[int]) -> bool:
+    return bool(user_id) and (user_id in ADMIN_IDS)
+
+def start_text_by_lang(lang: str) -> str:
+    return START_TEXT_RU if lang == LANG_RU else START_TEXT_UZ
+
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_user or not update.message:
+        return
+
+    # start bosganlarni DBga yozib boramiz
+    await STORE.touch_user(update.effective_user)
+
+    # Avval saqlangan til bo'lsa — shuni ishlatamiz, bo'lmasa default uz
+    lang = await STORE.get_lang(update.effective_user.id)
+    context.user_data["lang"] = lang
+
+    kb = [[
+        InlineKeyboardButton(_t(LANG_UZ, "btn_uz"), callback_data="lang|uz"),
+        InlineKeyboardButton(_t(LANG_RU, "btn_ru"), callback_data="lang|ru"),
+    ]]
+
+    await update.message.reply_text(
+        start_text_by_lang(lang),
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=True,
+        reply_markup=InlineKeyboardMarkup(kb),
+    )
+
+async def on_lang_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    if not q or not q.from_user:
+        return
 
     data = q.data or ""
     parts = data.split("|", maxsplit=1)
@@ -1967,9 +4445,55 @@ async def cmd_cacheprune(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     removed = 0
     removed += _prune_fileid_cache(FILEID_CACHE, max_items=FILEID_CACHE_MAX)
     removed += _prune_fileid_cache(YOUTUBE_FILEID_CACHE, max_items=YOUTUBE_FILEID_CACHE_MAX)
+    removed += CALLBACK_CACHE.prune()
     if update.message:
         await update.message.reply_text(f"✅ Cache prune: {removed} ta o‘chirildi.")
 
+async def cmd_cachestats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    uid = update.effective_user.id if update.effective_user else None
+    if uid not in ADMIN_IDS:
+        if update.message:
+            await update.message.reply_text("❌ Admin emas.")
+        return
+    st = CALLBACK_CACHE.stats()
+    lines = [
+        "📊 Callback cache:",
+        f"buttons={st['buttons']}/{st['max']} requests={st['requests']} ttl={st['ttl_h']}h",
+        f"~{human_mb(st['approx_bytes']) or '0MB'} hits={st['hits']} misses={st['misses']}",
+        f"evicted: lru={st['evicted_lru']} ttl={st['evicted_ttl']}",
+        f"file_id cache: {len(FILEID_CACHE)}/{FILEID_CACHE_MAX}, yt={len(YOUTUBE_FILEID_CACHE)}/{YOUTUBE_FILEID_CACHE_MAX}",
+    ]
+    if MEDIA_CACHE.enabled:
+        ms = MEDIA_CACHE.stats()
+        lines.append(f"media cache: {ms['files']} ta, {human_mb(ms['bytes']) or '0MB'} / {human_mb(ms['max_bytes'])}")
+    lines.append(f"work disk: {DISK_ADMISSION.stats()}")
+    if update.message:
+        await update.message.reply_text("\n".join(lines))
+
+async def cmd_dlslots(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/dlslots — holat; /dlslots 4 — qat'iy 4 slot; /dlslots auto — avtomatik rejim."""
+    uid = update.effective_user.id if update.effective_user else None
+    if uid not in ADMIN_IDS:
+        if update.message:
+            await update.message.reply_text("❌ Admin emas.")
+        return
+    arg = (context.args[0].strip().lower() if context.args else "")
+    if arg == "auto":
+        DOWNLOAD_SEM.set_fixed(None)
+    elif arg.isdigit() and int(arg) > 0:
+        DOWNLOAD_SEM.set_fixed(int(arg))
+    elif arg:
+        if update.message:
+            await update.message.reply_text("Foydalanish: /dlslots [N|auto]")
+        return
+    if update.message:
+        await update.message.reply_text(
+            "⚙️ Download slots:\n" + DOWNLOAD_SEM.stats()
+            + "\n\n📶 Profiles:\n" + PROFILE_TUNER.stats()
+            + "\n\n🔌 Breakers:\n" + ("\n".join(b.describe() for b in BREAKERS.values()) or "-")
+            + ("\n\n📨 Outbound: " + RATE_LIMITER.stats() if RATE_LIMITER is not None else "")
+        )
+
 async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message:
         return
@@ -1994,7 +4518,7 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text(_t(lang, "bc_started", n=len(users)))
     for u in users:
         try:
-            await context.bot.send_message(chat_id=u, text=msg, disable_web_page_preview=True)
+            await context.bot.send_message(chat_id=u, text=msg, disable_web_page_preview=True, **_rl_bulk())
             sent += 1
         except Exception:
             failed += 1
@@ -2021,7 +4545,7 @@ async def cmd_broadcastpost(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text(_t(lang, "bcpost_started", n=len(users)))
     for u in users:
         try:
-            await context.bot.copy_message(chat_id=u, from_chat_id=src.chat_id, message_id=src.message_id)
+            await context.bot.copy_message(chat_id=u, from_chat_id=src.chat_id, message_id=src.message_id, **_rl_bulk())
             sent += 1
         except Exception:
             failed += 1
@@ -2052,7 +4576,7 @@ async def cmd_broadcastgroup(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text(_t(lang, "bcgroup_started", n=len(groups)))
     for cid in groups:
         try:
-            await context.bot.send_message(chat_id=cid, text=msg, disable_web_page_preview=True)
+            await context.bot.send_message(chat_id=cid, text=msg, disable_web_page_preview=True, **_rl_bulk())
             sent += 1
         except Exception:
             failed += 1
@@ -2080,7 +4604,7 @@ async def cmd_broadcastpostgroup(update: Update, context: ContextTypes.DEFAULT_T
     await update.message.reply_text(_t(lang, "bcpostgroup_started", n=len(groups)))
     for cid in groups:
         try:
-            await context.bot.copy_message(chat_id=cid, from_chat_id=src.chat_id, message_id=src.message_id)
+            await context.bot.copy_message(chat_id=cid, from_chat_id=src.chat_id, message_id=src.message_id, **_rl_bulk())
             sent += 1
         except Exception:
             failed += 1
@@ -2135,31 +4659,27 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     else:
         # TikTok photo-post (/photo/) — bu turda faqat audio (MP3) taklif qilamiz
         if is_tiktok_photo(url_eff):
-            token_p = _cache_put({
-                "url": url_eff, "kind": "tt_photo_audio", "format_id": None,
-                "origin_chat_id": origin_chat_id, "origin_message_id": origin_message_id,
-                "lang": lang,
-            })
-            kb = [[InlineKeyboardButton(_t(lang, "btn_mp3"), callback_data=f"dl|{token_p}")]]
-            await update.message.reply_text(_t(lang, "tt_photo_audio_only"), reply_markup=InlineKeyboardMarkup(kb))
+            req = _cache_new_request(url_eff, origin_chat_id, origin_message_id, lang)
+            kb = [[InlineKeyboardButton(_t(lang, "btn_mp3"), callback_data=_make_dl_callback(req, "tt_photo_audio"))]]
+            await update.message.reply_text(
+                _t(lang, "tt_photo_audio_only"),
+                reply_markup=InlineKeyboardMarkup(kb),
+                reply_to_message_id=origin_message_id,
+            )
             return
 
         url_for_dl = url_eff if is_tiktok(url) else url
 
         kb = []
-        t_v = _cache_put({
-            "url": url_for_dl, "kind": "video", "format_id": None,
-            "origin_chat_id": origin_chat_id, "origin_message_id": origin_message_id,
-            "lang": lang,
-        })
-        t_a = _cache_put({
-            "url": url_for_dl, "kind": "audio", "format_id": None,
-            "origin_chat_id": origin_chat_id, "origin_message_id": origin_message_id,
-            "lang": lang,
-        })
-        kb.append([InlineKeyboardButton(_t(lang, "btn_video"), callback_data=f"dl|{t_v}")])
-        kb.append([InlineKeyboardButton(_t(lang, "btn_audio"), callback_data=f"dl|{t_a}")])
-        await update.message.reply_text(_t(lang, "choose"), reply_markup=InlineKeyboardMarkup(kb))
+        req = _cache_new_request(url_for_dl, origin_chat_id, origin_message_id, lang)
+        kb.append([InlineKeyboardButton(_t(lang, "btn_video"), callback_data=_make_dl_callback(req, "video"))])
+        kb.append([InlineKeyboardButton(_t(lang, "btn_audio"), callback_data=_make_dl_callback(req, "audio"))])
+        # Menyu doim link xabariga reply bo‘ladi: imzolangan tokenlarda origin shu reply'dan olinadi
+        await update.message.reply_text(
+            _t(lang, "choose"),
+            reply_markup=InlineKeyboardMarkup(kb),
+            reply_to_message_id=origin_message_id,
+        )
 
 
 async def _task_show_youtube_formats(
@@ -2171,9 +4691,8 @@ async def _task_show_youtube_formats(
     origin_message_id: int,
     lang: str,
 ) -> None:
-    loop = asyncio.get_running_loop()
     try:
-        info = await loop.run_in_executor(None, _extract_info, url)
+        info = await _origin_call(url, _extract_info, url)
         formats = _select_youtube_formats(info)
         try:
             raw_fmts = info.get("formats") or []
@@ -2190,6 +4709,7 @@ async def _task_show_youtube_formats(
                 # NOTE: only show real formats discovered by yt-dlp (no pseudo h:XXX options).
 
 # Buttonlar: real formatlar (mavjud bo‘lsa)
+        req = _cache_new_request(url, origin_chat_id, origin_message_id, lang)
         btns: List[InlineKeyboardButton] = []
         for f in sorted(formats, key=lambda x: int(x.get("_label_h") or x.get("_h") or x.get("height") or 0), reverse=True):
             fmt_id = str(f.get("format_id"))
@@ -2222,28 +4742,21 @@ async def _task_show_youtube_formats(
                 size = "~" + size
             label = f"{label_h}p - {size}" if size else f"{label_h}p"
 
-            token = _cache_put({
-                "url": url, "kind": "video", "format_id": fmt_id,
-                "has_audio": has_audio,
-                "yt_key": yt_key,
-                "total_bytes": int(total_bytes) if total_bytes else 0,
-                "total_bytes": int(total_bytes) if total_bytes else 0,
-                "origin_chat_id": origin_chat_id, "origin_message_id": origin_message_id,
-                "lang": lang,
-            })
-            btns.append(InlineKeyboardButton(label, callback_data=f"dl|{token}"))
+            cb_data = _make_dl_callback(
+                req, "video",
+                format_id=fmt_id,
+                has_audio=has_audio,
+                yt_key=yt_key,
+                total_bytes=int(total_bytes) if total_bytes else 0,
+            )
+            btns.append(InlineKeyboardButton(label, callback_data=cb_data))
 
         # 2-column layout (rasmdagidek)
         kb: List[List[InlineKeyboardButton]] = []
         for i in range(0, len(btns), 2):
             kb.append(btns[i:i+2])
 
-        token_a = _cache_put({
-            "url": url, "kind": "audio", "format_id": None,
-            "origin_chat_id": origin_chat_id, "origin_message_id": origin_message_id,
-            "lang": lang,
-        })
-        kb.append([InlineKeyboardButton("🎵 MP3", callback_data=f"dl|{token_a}")])
+        kb.append([InlineKeyboardButton("🎵 MP3", callback_data=_make_dl_callback(req, "audio"))])
 
         # Placeholder "formatlar olinmoqda" xabarini o‘chirib, oblojka (thumbnail) bilan yuboramiz
         try:
@@ -2318,11 +4831,20 @@ async def on_download_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
         pass
 
     data = q.data or ""
-    if not data.startswith("dl|"):
+    if not data.startswith(("dl|", "ds|")):
         return
 
     token = data.split("|", maxsplit=1)[1]
-    payload = _cache_get(token)
+    if data.startswith("ds|"):
+        payload = _signed_token_decode(token)
+        if payload:
+            # Origin: menyu xabari link xabariga reply qilingan (guruhda ham, private'da ham)
+            origin_msg = getattr(q.message, "reply_to_message", None) if q.message else None
+            payload["origin_chat_id"] = q.message.chat_id if q.message else None
+            payload["origin_message_id"] = origin_msg.message_id if origin_msg else None
+            payload["lang"] = lang
+    else:
+        payload = _cache_get(token) or await STORE.get_callback(token)
     if not payload:
         try:
             # Eski tugma
@@ -2341,8 +4863,9 @@ async def on_download_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
     lang = payload.get("lang") or lang
 
     # YouTube format hajm cheklovi (default: 150MB). Katta bo'lsa — yuklamaymiz va format menyusini o'chirmaymiz.
-    if kind == "video":
-        total_bytes = int(payload.get("total_bytes") or 0)
+    # VIDEO_SIZE_FALLBACK yoqilgan bo‘lsa rad etmaymiz: yuklashdan oldin sig‘adigan sifat avtomatik tanlanadi.
+    total_bytes = int(payload.get("total_bytes") or 0) if kind == "video" else 0
+    if kind == "video" and not VIDEO_SIZE_FALLBACK:
         if total_bytes > 0 and total_bytes > (YT_MAX_MB * 1024 * 1024):
             size_mb = int((total_bytes + (1024 * 1024 - 1)) // (1024 * 1024))
             msg_text = _t(lang, "yt_too_big", size=size_mb, max=YT_MAX_MB)
@@ -2359,44 +4882,272 @@ async def on_download_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 pass
             return
 
-    # Format menyusini (tugmalar) xabarini avtomat o‘chirib yuboramiz
+    # Format menyusini (tugmalar) xabarini avtomat o‘chirib yuboramiz
+    try:
+        if q.message is not None:
+            await context.bot.delete_message(chat_id=q.message.chat_id, message_id=q.message.message_id)
+    except Exception:
+        pass
+
+    origin_chat_id = int(payload.get("origin_chat_id") or (q.message.chat_id if q.message else update.effective_chat.id))
+    origin_message_id = payload.get("origin_message_id")
+    reply_to_message_id = int(origin_message_id) if str(origin_message_id).isdigit() else None
+
+    # "⏳ ..." ogohlantirishni alohida yuboramiz ва yuklab bo‘lganda o‘chirib tashlaymiz.
+    # Unda ❌ tugmasi: job istalgan bosqichda bekor qilinadi (cx|<cancel_id>).
+    cancel_id = uuid.uuid4().hex[:16]
+    requester_id = q.from_user.id if q.from_user else None
+    status_chat_id: Optional[int] = None
+    status_message_id: Optional[int] = None
+    try:
+        m = await context.bot.send_message(
+            chat_id=origin_chat_id,
+            text=_t(lang, "downloading_wait"),
+            reply_to_message_id=reply_to_message_id,
+            reply_markup=_cancel_markup(lang, cancel_id),
+        )
+        status_chat_id = m.chat_id
+        status_message_id = m.message_id
+    except Exception:
+        pass
+
+    job: Dict[str, Any] = {
+        "chat_id": origin_chat_id,
+        "reply_to_message_id": reply_to_message_id,
+        "url": url,
+        "kind": kind,
+        "format_id": format_id,
+        "has_audio": has_audio,
+        "yt_key": yt_key,
+        "total_bytes": total_bytes,
+        "lang": lang,
+        "status_chat_id": status_chat_id,
+        "status_message_id": status_message_id,
+        "cancel_id": cancel_id,
+        "requester_id": requester_id,
+    }
+
+    # front rejimida — job'ni umumiy navbatga qo‘yamiz, workerlar bajaradi
+    if BOT_ROLE == "front" and STORE.pool:
+        job_id = await STORE.enqueue_job(job)
+        if job_id:
+            return
+
+    _register_job(cancel_id, requester_id, asyncio.create_task(_task_download_and_send(context=context, **job)))
+
+def _cancel_markup(lang: str, cancel_id: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+    if not cancel_id:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(_t(lang, "btn_cancel"), callback_data=f"cx|{cancel_id}")]])
+
+# shu jarayonda ishlayotgan job'lar: cancel_id -> (task, so‘rov egasi)
+_ACTIVE_JOBS: Dict[str, Tuple[asyncio.Task, Optional[int]]] = {}
+# ❌ bilan bekor qilingan cancel_id'lar: task shu bo‘yicha foydalanuvchi cancel'ini shutdown'dan ajratadi
+_USER_CANCELLED: set[str] = set()
+
+def _unregister_job(cancel_id: str) -> None:
+    _ACTIVE_JOBS.pop(cancel_id, None)
+    _USER_CANCELLED.discard(cancel_id)
+
+def _register_job(cancel_id: Optional[str], requester_id: Optional[int], task: asyncio.Task) -> None:
+    if not cancel_id:
+        return
+    _ACTIVE_JOBS[cancel_id] = (task, requester_id)
+    task.add_done_callback(lambda _task, k=cancel_id: _unregister_job(k))
+
+async def on_cancel_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """❌ on the status message: cancel the job at whatever stage it is in.
+
+    A local task is cancelled directly (stage workers are killed, slots and disk released by
+    the task's own cleanup); a queued/remote job is marked 'cancelled' in the DB and the worker
+    that holds it cancels it on its next poll. Only the requester or an admin may cancel.
+    """
+    q = update.callback_query
+    if not q or not q.data:
+        return
+    uid = q.from_user.id if q.from_user else None
+    lang = await STORE.get_lang(uid) if uid else LANG_UZ
+    cancel_id = q.data.split("|", 1)[1]
+
+    ent = _ACTIVE_JOBS.get(cancel_id)
+    if ent is not None:
+        task, owner = ent
+        if uid != owner and not is_admin(uid):
+            await q.answer(_t(lang, "cancel_not_allowed"), show_alert=True)
+            return
+        # status xabarini task o‘zining cancel yo‘lida tasdiqqa almashtiradi
+        _USER_CANCELLED.add(cancel_id)
+        task.cancel()
+        ok = True
+    else:
+        ok = await STORE.cancel_job(cancel_id, None if is_admin(uid) else uid)
+    if not ok:
+        await q.answer(_t(lang, "cancel_too_late"), show_alert=False)
+        return
+    log.info("Job bekor qilindi: %s (user %s)", cancel_id, uid)
+    await q.answer(_t(lang, "job_cancelled"), show_alert=False)
+    if ent is None:
+        try:
+            # navbatdagi job'ning task'i hali yo‘q — matnni shu yerda almashtiramiz
+            await q.edit_message_text(_t(lang, "job_cancelled"))
+        except Exception:
+            pass
+
+# ---------------------------- Upload retry policy ----------------------------
+class UploadNotDelivered(Exception):
+    """Upload gave up on transient errors; the file is kept in UPLOAD_RETRY for a re-request."""
+
+    def __init__(self, cause: BaseException) -> None:
+        super().__init__(f"upload failed: {cause}")
+        self.cause = cause
+
+
+def _upload_error_is_permanent(e: BaseException) -> bool:
+    """Errors a resend cannot fix: blocked/unknown chat, bad parameters, file over the API limit."""
+    # BadRequest va TimedOut — NetworkError'ning voris klasslari, shuning uchun avval ular tekshiriladi
+    if isinstance(e, (Forbidden, BadRequest, ChatMigrated, InvalidToken)):
+        return True
+    if isinstance(e, (RetryAfter, TimedOut)):
+        return False
+    if isinstance(e, NetworkError):
+        # 413 "Request Entity Too Large" PTB'da oddiy NetworkError bo‘lib keladi
+        msg = str(e).lower()
+        return "too large" in msg or "too big" in msg
+    # bizning xatolar (fayl yo‘q va h.k.) — qayta urinish foyda bermaydi
+    return True
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    # PTB 22: int yoki timedelta (PTB_TIMEDELTA)
+    return float(ra.total_seconds()) if hasattr(ra, "total_seconds") else float(ra)
+
+def _upload_backoff(attempt: int) -> float:
+    """Exponential step capped at UL_BACKOFF_MAX; half of it fixed, half random (jitter)."""
+    step = min(UL_BACKOFF_MAX, UL_BACKOFF_BASE * (2 ** attempt))
+    return step / 2 + random.uniform(0, step / 2)
+
+async def _upload_with_retry(what: str, send):
+    """Await send() until it succeeds, fails permanently or UL_RETRIES retries are used up.
+
+    send() is called afresh for every attempt, so the media source is reopened each time.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await send()
+        except Exception as e:
+            if _upload_error_is_permanent(e) or attempt >= max(0, UL_RETRIES):
+                raise
+            if isinstance(e, RetryAfter):
+                wait = _retry_after_seconds(e)
+                if wait > UL_RETRY_AFTER_MAX:
+                    raise
+                # flood limit tugaganda hamma kutayotgan upload'lar bir vaqtda urilmasin
+                wait += random.uniform(0.5, 2.0)
+            else:
+                wait = _upload_backoff(attempt)
+            attempt += 1
+            log.warning("%s upload xato (%s), %d-qayta urinish %.1fs dan keyin: %s", what, type(e).__name__, attempt, wait, e)
+            await asyncio.sleep(wait)
+
+async def _upload_keeping_file(key: str, url: str, path: Path, tag: str, send) -> Any:
+    """Await the send coroutine; on a transient failure keep the file for UPLOAD_RETRY_TTL.
+
+    The work dir is deleted when the job ends, so without this a retry of the same request
+    would download the whole file from the origin again. Raises UploadNotDelivered when kept.
+    """
+    loop = asyncio.get_running_loop()
     try:
-        if q.message is not None:
-            await context.bot.delete_message(chat_id=q.message.chat_id, message_id=q.message.message_id)
-    except Exception:
-        pass
+        msg = await send
+    except Exception as e:
+        if _upload_error_is_permanent(e) or not UPLOAD_RETRY.enabled:
+            raise
+        kept = await loop.run_in_executor(None, UPLOAD_RETRY.put, key, path, _normalize_url_for_cache(url), tag)
+        if not kept:
+            raise
+        log.warning("Upload muvaffaqiyatsiz, fayl %ds saqlanadi: %s", UPLOAD_RETRY_TTL, key)
+        raise UploadNotDelivered(e) from e
+    if UPLOAD_RETRY.enabled:
+        await loop.run_in_executor(None, UPLOAD_RETRY.discard, key)
+    return msg
 
-    origin_chat_id = int(payload.get("origin_chat_id") or (q.message.chat_id if q.message else update.effective_chat.id))
-    origin_message_id = payload.get("origin_message_id")
-    reply_to_message_id = int(origin_message_id) if str(origin_message_id).isdigit() else None
 
-    # "⏳ ..." ogohlantirishni alohida yuboramiz ва yuklab bo‘lganda o‘chirib tashlaymiz
-    status_chat_id: Optional[int] = None
-    status_message_id: Optional[int] = None
+def _stream_input(f, path: Path) -> InputFile:
+    """Upload body backed by the open file: httpx streams it in small chunks instead of
+    PTB reading the whole file into memory first (read_file_handle=False, PTB >= 21.5)."""
+    return InputFile(f, filename=path.name, read_file_handle=False)
+
+def _local_api_stage(path: Path) -> Optional[Tuple[Path, str, bool]]:
+    """Put a finished file into the shared Local Bot API volume.
+
+    Returns (shared_path, file:// URI as the server sees it, moved). Hardlink when the work dir
+    is on the same volume (instant, original kept), otherwise move. None if disabled or failed.
+    """
+    if not LOCAL_API_ZERO_COPY:
+        return None
     try:
-        m = await context.bot.send_message(
-            chat_id=origin_chat_id,
-            text=_t(lang, "downloading_wait"),
-            reply_to_message_id=reply_to_message_id,
-        )
-        status_chat_id = m.chat_id
-        status_message_id = m.message_id
-    except Exception:
-        pass
+        d = Path(LOCAL_BOT_API_FILES_DIR) / f"up_{uuid.uuid4().hex}"
+        d.mkdir(parents=True, exist_ok=True)
+        os.chmod(d, 0o755)
+        dst = d / path.name
+        moved = False
+        try:
+            os.link(path, dst)
+        except OSError:
+            shutil.move(str(path), str(dst))
+            moved = True
+        # bot-api server boshqa foydalanuvchi nomidan ishlashi mumkin
+        os.chmod(dst, 0o644)
+        server_path = Path(LOCAL_BOT_API_SERVER_DIR) / d.name / path.name
+        return dst, server_path.as_uri(), moved
+    except Exception as e:
+        log.warning("Local Bot API volume'ga qo‘yib bo‘lmadi, HTTP upload: %s", e)
+        return None
+
+def _local_api_unstage(staged: Tuple[Path, str, bool], path: Path, sent: bool) -> None:
+    dst, _, moved = staged
+    if moved and not sent:
+        # yuborilmadi — faylni joyiga qaytaramiz (keyingi urinishlar/kesh uchun)
+        try:
+            shutil.move(str(dst), str(path))
+        except Exception:
+            pass
+    shutil.rmtree(dst.parent, ignore_errors=True)
+
+class _MediaSource:
+    """What to pass as the media argument of send_*: a file:// URI in Local Bot API zero-copy mode,
+    otherwise a streamed InputFile (reopened for every attempt). Shared copy is removed on exit."""
 
-    asyncio.create_task(_task_download_and_send(
-        context=context,
-        chat_id=origin_chat_id,
-        reply_to_message_id=reply_to_message_id,
-        url=url,
-        kind=kind,
-        format_id=format_id,
-        has_audio=has_audio,
-        yt_key=yt_key,
-        lang=lang,
-        status_chat_id=status_chat_id,
-        status_message_id=status_message_id,
-    ))
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.staged: Optional[Tuple[Path, str, bool]] = None
+        self._f = None
+
+    async def __aenter__(self) -> "_MediaSource":
+        if not LOCAL_API_ZERO_COPY:
+            return self
+        try:
+            self.staged = await _run_stage("local_api", _local_api_stage, self.path)
+        except JobTimeout as e:
+            log.warning("Local Bot API volume %ss javob bermadi, HTTP upload: %s", e.seconds, self.path)
+            self.staged = None
+        return self
+
+    def input(self):
+        if self.staged:
+            return self.staged[1]
+        if self._f is not None:
+            self._f.close()
+        self._f = open(self.path, "rb")
+        return _stream_input(self._f, self.path)
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._f is not None:
+            self._f.close()
+        if self.staged:
+            await asyncio.get_running_loop().run_in_executor(
+                None, _local_api_unstage, self.staged, self.path, exc_type is None
+            )
 
 async def _send_audio_with_retry(
     context: ContextTypes.DEFAULT_TYPE,
@@ -2405,50 +5156,44 @@ async def _send_audio_with_retry(
     caption: str,
     reply_to_message_id: Optional[int],
 ) -> Optional[Message]:
-    last_exc: Optional[Exception] = None
-    for _ in range(2):
-        try:
-            with open(path, "rb") as f:
-                msg = await context.bot.send_audio(
-                    chat_id=chat_id,
-                    audio=f,
-                    caption=caption,
-                    reply_to_message_id=reply_to_message_id,
-                )
-            return msg
-        except TimedOut as e:
-            last_exc = e
-            await asyncio.sleep(2)
-    if last_exc:
-        raise last_exc
-    raise RuntimeError("send_audio failed")
+    async with _MediaSource(path) as src:
+        return await _upload_with_retry("audio", lambda: context.bot.send_audio(
+            chat_id=chat_id,
+            audio=src.input(),
+            caption=caption,
+            reply_to_message_id=reply_to_message_id,
+        ))
 
 async def _send_video_with_retry(
     context: ContextTypes.DEFAULT_TYPE,
     chat_id: int,
-    path: Path,
+    res: MediaResult,
     caption: str,
     reply_to_message_id: Optional[int],
 ):
-    """Видео юбориш (2 марта retry) ва Message'ни қайтариш (file_id кеш учун)."""
-    last_exc: Optional[Exception] = None
-    for _ in range(2):
+    """Видео юбориш (_upload_with_retry сиёсати билан) ва Message'ни қайтариш (file_id кеш учун).
+
+    duration/width/height ва thumbnail'ни ўзимиз берамиз — Telegram файлни қайта текширмайди,
+    превью ва нисбат клиентда дарҳол тўғри чиқади.
+    """
+    thumb: Optional[bytes] = None
+    if res.thumbnail:
         try:
-            with open(path, "rb") as f:
-                msg = await context.bot.send_video(
-                    chat_id=chat_id,
-                    video=f,
-                    supports_streaming=True,
-                    caption=caption,
-                    reply_to_message_id=reply_to_message_id,
-                )
-            return msg
-        except TimedOut as e:
-            last_exc = e
-            await asyncio.sleep(2)
-    if last_exc:
-        raise last_exc
-    raise RuntimeError("send_video failed")
+            thumb = res.thumbnail.read_bytes()
+        except Exception:
+            thumb = None
+    async with _MediaSource(res.path) as src:
+        return await _upload_with_retry("video", lambda: context.bot.send_video(
+            chat_id=chat_id,
+            video=src.input(),
+            supports_streaming=True,
+            duration=int(round(res.duration)) or None,
+            width=res.width or None,
+            height=res.height or None,
+            thumbnail=thumb,
+            caption=caption,
+            reply_to_message_id=reply_to_message_id,
+        ))
 
 async def _send_document_with_retry(
     context: ContextTypes.DEFAULT_TYPE,
@@ -2457,22 +5202,13 @@ async def _send_document_with_retry(
     caption: str,
     reply_to_message_id: Optional[int],
 ) -> None:
-    last_exc: Optional[Exception] = None
-    for _ in range(2):
-        try:
-            with open(path, "rb") as f:
-                await context.bot.send_document(
-                    chat_id=chat_id,
-                    document=f,
-                    caption=caption,
-                    reply_to_message_id=reply_to_message_id,
-                )
-            return
-        except TimedOut as e:
-            last_exc = e
-            await asyncio.sleep(2)
-    if last_exc:
-        raise last_exc
+    async with _MediaSource(path) as src:
+        await _upload_with_retry("document", lambda: context.bot.send_document(
+            chat_id=chat_id,
+            document=src.input(),
+            caption=caption,
+            reply_to_message_id=reply_to_message_id,
+        ))
 
 
 def _download_tiktok_photos_zip(url: str, workdir: str) -> Path:
@@ -2521,11 +5257,11 @@ def _download_tiktok_photo_audio(url: str, workdir: str) -> Path:
     video_variant = re.sub(r"/photo/([0-9]+)/?$", r"/video/\1", clean)
 
     try:
-        return _download_audio(video_variant, workdir)
+        return _download_audio(video_variant, workdir).path
     except Exception as e1:
         # ba'zi hollarda original URL ham ishlashi mumkin
         try:
-            return _download_audio(clean, workdir)
+            return _download_audio(clean, workdir).path
         except Exception:
             pass
 
@@ -2606,165 +5342,242 @@ async def _task_download_and_send(
     lang: str,
     status_chat_id: Optional[int] = None,
     status_message_id: Optional[int] = None,
-) -> None:
-    loop = asyncio.get_running_loop()
-    try:
-        async with DOWNLOAD_SEM:
-            with tempfile.TemporaryDirectory(prefix="dlbot_") as td:
-                caption = _t(lang, "caption_suffix")
-
-                if kind == "audio":
-                    # file_id кеш: шу URL аввал юборилган бўлса, қайта юклаб олмасдан юбориш
-                    key = _make_fileid_cache_key(url, kind)
-                    fid = _cache_get_fileid(FILEID_CACHE, key)
-                    if fid:
-                        try:
-                            await context.bot.send_audio(
-                                chat_id=chat_id,
-                                audio=fid,
-                                caption=caption,
-                                reply_to_message_id=reply_to_message_id,
-                            )
-                            return
-                        except Exception:
-                            FILEID_CACHE.pop(key, None)
+    total_bytes: int = 0,
+    cancel_id: Optional[str] = None,
+    requester_id: Optional[int] = None,
+) -> bool:
+    """Download (or reuse a cached file_id) and deliver; True only when the media reached the chat."""
 
-                    path: Path = await loop.run_in_executor(None, _download_audio, url, td)
+    async def _notify_fallback(h: int, size_mb: int, max_mb: int) -> None:
+        if status_chat_id and status_message_id:
+            await context.bot.edit_message_text(
+                chat_id=status_chat_id,
+                message_id=status_message_id,
+                text=_t(lang, "quality_fallback", h=h, size=size_mb, max=max_mb),
+                reply_markup=_cancel_markup(lang, cancel_id),
+            )
 
-                    # Bot ички лимити (RAM/traffic тежаш): 130MB (default) дан катта бўлса юбормаймиз
+    disk_held = 0
+    cancelled = False
+    shutting_down = False
+    try:
+        with tempfile.TemporaryDirectory(prefix="dlbot_", dir=WORK_ROOT) as td:
+            caption = _t(lang, "caption_suffix")
+
+            if kind == "audio":
+                # file_id кеш: шу URL аввал юборилган бўлса, қайта юклаб олмасдан юбориш
+                key = _make_fileid_cache_key(url, kind)
+                fid = await _fileid_lookup(FILEID_CACHE, key, FILEID_CACHE_MAX)
+                if fid:
                     try:
-                        size_mb = path.stat().st_size / (1024 * 1024)
-                    except Exception:
-                        size_mb = 0.0
-                    if DL_MAX_MB > 0 and size_mb > DL_MAX_MB:
-                        await context.bot.send_message(
+                        await context.bot.send_audio(
                             chat_id=chat_id,
-                            text=_t(lang, "yt_too_big", size=int(size_mb + 0.999), max=DL_MAX_MB),
+                            audio=fid,
+                            caption=caption,
                             reply_to_message_id=reply_to_message_id,
                         )
-                        return
-
-                    msg = await _send_audio_with_retry(context, chat_id, path, caption, reply_to_message_id)
-                    try:
-                        if msg and getattr(msg, "audio", None) is not None:
-                            _cache_put_fileid(FILEID_CACHE, key, msg.audio.file_id, FILEID_CACHE_MAX)
+                        return True
                     except Exception:
-                        pass
+                        await _fileid_forget(FILEID_CACHE, key)
 
-                elif kind == "tt_photo_audio":
-                    key = _make_fileid_cache_key(url, kind)
-                    fid = _cache_get_fileid(FILEID_CACHE, key)
-                    if fid:
-                        try:
-                            await context.bot.send_audio(
-                                chat_id=chat_id,
-                                audio=fid,
-                                caption=caption,
-                                reply_to_message_id=reply_to_message_id,
-                            )
-                            return
-                        except Exception:
-                            FILEID_CACHE.pop(key, None)
+                # manba + MP3: ~2 nusxa
+                disk_held = await DISK_ADMISSION.acquire(_disk_est_audio_bytes(total_bytes), 2)
+                async with DOWNLOAD_SEM:
+                    path: Path = await _fetch_audio(key, url, td, _download_audio, url, td)
 
-                    path = await loop.run_in_executor(None, _download_tiktok_photo_audio, url, td)
+                # Bot ички лимити (RAM/traffic тежаш): 130MB (default) дан катта бўлса юбормаймиз
+                try:
+                    size_mb = path.stat().st_size / (1024 * 1024)
+                except Exception:
+                    size_mb = 0.0
+                if DL_MAX_MB > 0 and size_mb > DL_MAX_MB:
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=_t(lang, "yt_too_big", size=int(size_mb + 0.999), max=DL_MAX_MB),
+                        reply_to_message_id=reply_to_message_id,
+                    )
+                    return False
+
+                # Upload alohida bosqich: download sloti bo‘shagan, keyingi job origin'dan yuklashni boshlaydi
+                async with UPLOAD_SEM:
+                    msg = await _upload_keeping_file(
+                        key, url, path, "audio",
+                        _send_audio_with_retry(context, chat_id, path, caption, reply_to_message_id),
+                    )
+                try:
+                    if msg and getattr(msg, "audio", None) is not None:
+                        await _fileid_remember(FILEID_CACHE, key, msg.audio.file_id, FILEID_CACHE_MAX)
+                except Exception:
+                    pass
 
+            elif kind == "tt_photo_audio":
+                key = _make_fileid_cache_key(url, kind)
+                fid = await _fileid_lookup(FILEID_CACHE, key, FILEID_CACHE_MAX)
+                if fid:
                     try:
-                        size_mb = path.stat().st_size / (1024 * 1024)
-                    except Exception:
-                        size_mb = 0.0
-                    if DL_MAX_MB > 0 and size_mb > DL_MAX_MB:
-                        await context.bot.send_message(
+                        await context.bot.send_audio(
                             chat_id=chat_id,
-                            text=_t(lang, "yt_too_big", size=int(size_mb + 0.999), max=DL_MAX_MB),
+                            audio=fid,
+                            caption=caption,
                             reply_to_message_id=reply_to_message_id,
                         )
-                        return
+                        return True
+                    except Exception:
+                        await _fileid_forget(FILEID_CACHE, key)
+
+                disk_held = await DISK_ADMISSION.acquire(_disk_est_audio_bytes(total_bytes), 2)
+                async with DOWNLOAD_SEM:
+                    path = await _fetch_audio(key, url, td, _download_tiktok_photo_audio, url, td)
+
+                try:
+                    size_mb = path.stat().st_size / (1024 * 1024)
+                except Exception:
+                    size_mb = 0.0
+                if DL_MAX_MB > 0 and size_mb > DL_MAX_MB:
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=_t(lang, "yt_too_big", size=int(size_mb + 0.999), max=DL_MAX_MB),
+                        reply_to_message_id=reply_to_message_id,
+                    )
+                    return False
+
+                async with UPLOAD_SEM:
+                    msg = await _upload_keeping_file(
+                        key, url, path, "audio",
+                        _send_audio_with_retry(context, chat_id, path, caption, reply_to_message_id),
+                    )
+                try:
+                    if msg and getattr(msg, "audio", None) is not None:
+                        await _fileid_remember(FILEID_CACHE, key, msg.audio.file_id, FILEID_CACHE_MAX)
+                except Exception:
+                    pass
 
-                    msg = await _send_audio_with_retry(context, chat_id, path, caption, reply_to_message_id)
+            else:
+                # 1) Universal file_id кеш (барча тармоқлар). Агар шу URL/формат аввал юборилган бўлса — дарҳол юборилади.
+                key = _make_fileid_cache_key(url, "video", format_id=format_id, yt_key=yt_key)
+                fid = await _fileid_lookup(FILEID_CACHE, key, FILEID_CACHE_MAX)
+                if fid:
                     try:
-                        if msg and getattr(msg, "audio", None) is not None:
-                            _cache_put_fileid(FILEID_CACHE, key, msg.audio.file_id, FILEID_CACHE_MAX)
+                        await context.bot.send_video(
+                            chat_id=chat_id,
+                            video=fid,
+                            supports_streaming=True,
+                            caption=caption,
+                            reply_to_message_id=reply_to_message_id,
+                        )
+                        return True
                     except Exception:
-                        pass
+                        await _fileid_forget(FILEID_CACHE, key)
 
-                else:
-                    # 1) Universal file_id кеш (барча тармоқлар). Агар шу URL/формат аввал юборилган бўлса — дарҳол юборилади.
-                    key = _make_fileid_cache_key(url, "video", format_id=format_id, yt_key=yt_key)
-                    fid = _cache_get_fileid(FILEID_CACHE, key)
-                    if fid:
+                if yt_key:
+                    fid_cached = await _fileid_lookup(YOUTUBE_FILEID_CACHE, yt_key, YOUTUBE_FILEID_CACHE_MAX)
+                    if fid_cached:
                         try:
                             await context.bot.send_video(
                                 chat_id=chat_id,
-                                video=fid,
+                                video=fid_cached,
                                 supports_streaming=True,
                                 caption=caption,
                                 reply_to_message_id=reply_to_message_id,
                             )
-                            return
+                            return True
                         except Exception:
-                            FILEID_CACHE.pop(key, None)
-
-                    if yt_key:
-                        fid_cached = _cache_get_fileid(YOUTUBE_FILEID_CACHE, yt_key)
-                        if fid_cached:
-                            try:
-                                await context.bot.send_video(
-                                    chat_id=chat_id,
-                                    video=fid_cached,
-                                    supports_streaming=True,
-                                    caption=caption,
-                                    reply_to_message_id=reply_to_message_id,
-                                )
-                                return
-                            except Exception:
-                                YOUTUBE_FILEID_CACHE.pop(yt_key, None)
-
-                    # 2) Юклаб оламиз
-                    path = await loop.run_in_executor(None, _download_video, url, format_id, td, has_audio)
-
-                    # 3) Upload лимити (api.telegram.org учун одатда ~50MB). Local Bot API server бўлса TG_MAX_UPLOAD_MB'ни катта қилиб қўйинг.
-                    try:
-                        size_mb = path.stat().st_size / (1024 * 1024)
-                    except Exception:
-                        size_mb = 0.0
+                            await _fileid_forget(YOUTUBE_FILEID_CACHE, yt_key)
 
-                    # Bot ички лимити: 130MB (default). Telegram лимити катта бўлса ҳам шу ерда тўхтатамиз.
-                    if DL_MAX_MB > 0 and size_mb > DL_MAX_MB:
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=_t(lang, "yt_too_big", size=int(size_mb + 0.999), max=DL_MAX_MB),
-                            reply_to_message_id=reply_to_message_id,
-                        )
-                        return
+                # 2) Юклаб оламиз (avval diskda joy band qilamiz)
+                disk_held = await DISK_ADMISSION.acquire(_disk_est_bytes(total_bytes), DISK_RESERVE_FACTOR)
+                async with DOWNLOAD_SEM:
+                    res = await _fetch_video(key, url, td, format_id, has_audio, total_bytes, _notify_fallback)
+                path = res.path
 
-                    if TG_MAX_UPLOAD_MB > 0 and size_mb > TG_MAX_UPLOAD_MB:
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=_t(
-                                lang,
-                                "err_generic",
-                                err=(
-                                    f"Файл ҳажми {size_mb:.1f}MB. Telegram Bot API upload чеклови туфайли юборилмади (лимит: {TG_MAX_UPLOAD_MB}MB). "
-                                    "Пастроқ формат танланг ёки Local Bot API server ишлатинг."
-                                ),
+                # 3) Upload лимити (api.telegram.org учун одатда ~50MB). Local Bot API server бўлса TG_MAX_UPLOAD_MB'ни катта қилиб қўйинг.
+                try:
+                    size_mb = path.stat().st_size / (1024 * 1024)
+                except Exception:
+                    size_mb = 0.0
+
+                # Bot ички лимити: 130MB (default). Telegram лимити катта бўлса ҳам шу ерда тўхтатамиз.
+                if DL_MAX_MB > 0 and size_mb > DL_MAX_MB:
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=_t(lang, "yt_too_big", size=int(size_mb + 0.999), max=DL_MAX_MB),
+                        reply_to_message_id=reply_to_message_id,
+                    )
+                    return False
+
+                if TG_MAX_UPLOAD_MB > 0 and size_mb > TG_MAX_UPLOAD_MB:
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=_t(
+                            lang,
+                            "err_generic",
+                            err=(
+                                f"Файл ҳажми {size_mb:.1f}MB. Telegram Bot API upload чеклови туфайли юборилмади (лимит: {TG_MAX_UPLOAD_MB}MB). "
+                                "Пастроқ формат танланг ёки Local Bot API server ишлатинг."
                             ),
-                            reply_to_message_id=reply_to_message_id,
-                        )
-                        return
-
-                    # 4) Юбориш ва file_id кешлаш
-                    msg = await _send_video_with_retry(context, chat_id, path, caption, reply_to_message_id)
+                        ),
+                        reply_to_message_id=reply_to_message_id,
+                    )
+                    return False
+
+                # 4) Юбориш ва file_id кешлаш
+                async with UPLOAD_SEM:
+                    msg = await _upload_keeping_file(
+                        key, url, path, "video",
+                        _send_video_with_retry(context, chat_id, res, caption, reply_to_message_id),
+                    )
+                # size fallback: file_id so‘ralgan sifatga tegishli emas — kesh kalitlariga yozilmaydi
+                try:
+                    if msg and getattr(msg, "video", None) is not None and not res.fallback:
+                        await _fileid_remember(FILEID_CACHE, key, msg.video.file_id, FILEID_CACHE_MAX)
+                except Exception:
+                    pass
+                if yt_key and msg and getattr(msg, "video", None) is not None and not res.fallback:
                     try:
-                        if msg and getattr(msg, "video", None) is not None:
-                            _cache_put_fileid(FILEID_CACHE, key, msg.video.file_id, FILEID_CACHE_MAX)
+                        await _fileid_remember(YOUTUBE_FILEID_CACHE, yt_key, msg.video.file_id, YOUTUBE_FILEID_CACHE_MAX)
                     except Exception:
                         pass
-                    if yt_key and msg and getattr(msg, "video", None) is not None:
-                        try:
-                            _cache_put_fileid(YOUTUBE_FILEID_CACHE, yt_key, msg.video.file_id, YOUTUBE_FILEID_CACHE_MAX)
-                        except Exception:
-                            pass
-
+            return True
+
+    except asyncio.CancelledError:
+        # stage worker o‘ldirilgan, slotlar `async with`lar bilan bo‘shaydi, papka o‘chadi.
+        # Faqat ❌ bo‘lsa tasdiq; shutdown'da job qayta bajariladi — status xabari va tugma tegilmaydi.
+        cancelled = bool(cancel_id) and cancel_id in _USER_CANCELLED
+        shutting_down = not cancelled
+        log.info("Job to‘xtatildi (cancel_id=%s, foydalanuvchi=%s): %s", cancel_id, cancelled, url)
+        raise
+    except DiskSpaceBusy as e:
+        log.warning("Disk admission rad etdi: %s", e)
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=_t(lang, "err_disk_busy"),
+                reply_to_message_id=reply_to_message_id,
+            )
+        except Exception:
+            pass
+        return False
+    except UploadNotDelivered as e:
+        log.warning("Yuborilmadi (fayl saqlandi): %s", e.cause)
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=_t(lang, "err_upload_failed", minutes=max(1, UPLOAD_RETRY_TTL // 60)),
+                reply_to_message_id=reply_to_message_id,
+            )
+        except Exception:
+            pass
+        return False
+    except (MediaTooLarge, DownloadTooLarge) as e:
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=_t(lang, "yt_too_big", size=int(e.size / (1024 * 1024) + 0.999), max=e.limit // (1024 * 1024)),
+                reply_to_message_id=reply_to_message_id,
+            )
+        except Exception:
+            pass
+        return False
     except Exception as e:
         log.exception("Download/send xato: %s", e)
         try:
@@ -2775,17 +5588,527 @@ async def _task_download_and_send(
             )
         except Exception:
             pass
+        return False
     finally:
+        DISK_ADMISSION.release(disk_held)
         if status_chat_id and status_message_id:
             try:
-                await context.bot.delete_message(chat_id=status_chat_id, message_id=status_message_id)
+                if cancelled:
+                    # status xabari tasdiqqa aylanadi (tugmasiz) — o‘chirilsa, foydalanuvchi natijani ko‘rmaydi
+                    await context.bot.edit_message_text(
+                        chat_id=status_chat_id, message_id=status_message_id, text=_t(lang, "job_cancelled"),
+                    )
+                elif not shutting_down:
+                    await context.bot.delete_message(chat_id=status_chat_id, message_id=status_message_id)
             except Exception:
                 pass
 
 
+# ---------------------------- Update processing ----------------------------
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently (at most `limit` at a time) but strictly in arrival order
+    within one chat, so a user's link and their button tap are never reordered.
+
+    PTB takes its own semaphore *before* do_process_update; if that were the limit, updates
+    queued behind a busy chat would hold slots idle. So the base semaphore is left effectively
+    unbounded and the real limit (`self.limit`) is taken here, after the per-chat lock.
+    """
+
+    def __init__(self, limit: int) -> None:
+        super().__init__(max_concurrent_updates=2 ** 20)
+        self.limit = max(1, int(limit))
+        self._slots = asyncio.Semaphore(self.limit)
+        # chat_id -> [lock, shu chatdagi kutayotgan/ishlayotgan update'lar soni]
+        self._chats: Dict[int, List[Any]] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        # inline callback (xabarsiz) — foydalanuvchi bo‘yicha
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        ent = self._chats.get(key)
+        if ent is None:
+            ent = self._chats[key] = [asyncio.Lock(), 0]
+        ent[1] += 1
+        try:
+            # asyncio.Lock FIFO: update'lar shu chatga kelgan tartibda o‘tadi
+            async with ent[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            ent[1] -= 1
+            if ent[1] <= 0:
+                self._chats.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# ---------------------------- Outbound rate limiter ----------------------------
+RL_PRIO_INTERACTIVE = 0   # tugma javoblari, status xabarini tahrirlash/o‘chirish
+RL_PRIO_MEDIA = 1         # tayyor media yetkazish — foydalanuvchi kutyapti, menyulardan oldin
+RL_PRIO_NORMAL = 2        # menyular, matnli xabarlar
+RL_PRIO_BULK = 3          # broadcast
+
+_RL_INTERACTIVE_METHODS = frozenset({
+    "answerCallbackQuery", "deleteMessage", "editMessageText", "editMessageReplyMarkup", "sendChatAction",
+})
+_RL_MEDIA_METHODS = frozenset({
+    "sendVideo", "sendAudio", "sendDocument", "sendPhoto", "sendAnimation", "sendVoice", "sendVideoNote", "sendMediaGroup",
+})
+# chatga "xabar yuborish" hisoblanadigan metodlar (per-chat limit faqat shularga)
+_RL_CHAT_SEND_PREFIXES = ("send", "copyMessage", "forwardMessage")
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "ts")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = max(1e-6, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.ts = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def ready_in(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Every Bot API call (except getUpdates) waits here for a slot.
+
+    Waiters sit in a priority heap (RL_PRIO_*; pass `rate_limit_args=RL_PRIO_BULK` to demote a call)
+    and a single pump hands out slots: global token bucket first, then the chat's bucket for
+    message-sending methods. A waiter whose chat is exhausted does not block other chats.
+    RetryAfter pauses only the chat it came from (the whole pump for calls without a chat) and
+    the call is repeated — except uploads with an open file stream, which cannot be replayed;
+    those raise to the upload retry policy.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, group_per_min: float, max_retries: int) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_min / 60.0
+        self.max_retries = max(0, int(max_retries))
+        self._global = _TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Any, _TokenBucket] = {}
+        # (priority, seq, chat_key, chat bucket'i qo‘llanadimi, future)
+        self._heap: List[Tuple[int, int, Any, bool, asyncio.Future]] = []
+        self._seq = 0
+        self._paused_until = 0.0
+        # RetryAfter bitta chatdan kelsa — faqat o‘sha chat to‘xtaydi
+        self._chat_paused: Dict[Any, float] = {}
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+        self.retry_after_hits = 0
+
+    async def initialize(self) -> None:
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def shutdown(self) -> None:
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except BaseException:
+                pass
+            self._pump_task = None
+        for *_, fut in self._heap:
+            if not fut.done():
+                fut.cancel()
+        self._heap.clear()
+
+    def _bucket(self, chat: Any) -> _TokenBucket:
+        b = self._chats.get(chat)
+        if b is None:
+            if len(self._chats) > 5000:
+                # to‘lib turgan (uzoq vaqt ishlatilmagan) bucket'lar — keraksiz
+                now = time.monotonic()
+                for k in [k for k, v in self._chats.items() if v.ready_in(now) == 0 and v.tokens >= v.burst]:
+                    del self._chats[k]
+            group = not isinstance(chat, int) or chat < 0
+            b = _TokenBucket(self.group_rate, max(1, self.group_rate * 30)) if group else _TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat] = b
+        return b
+
+    async def _sleep(self, seconds: float) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.001, seconds))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _pump(self) -> None:
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self._global.ready_in(now))
+            if wait > 0:
+                await self._sleep(wait)
+                continue
+            skipped = []
+            grant = None
+            min_wait = float("inf")
+            while self._heap:
+                item = heapq.heappop(self._heap)
+                if item[4].done():
+                    continue
+                w = self._chat_pause_left(item[2], now)
+                if item[3]:
+                    w = max(w, self._bucket(item[2]).ready_in(now))
+                if w <= 0:
+                    grant = item
+                    break
+                min_wait = min(min_wait, w)
+                skipped.append(item)
+            for item in skipped:
+                heapq.heappush(self._heap, item)
+            if grant is None:
+                if skipped:
+                    await self._sleep(min_wait)
+                continue
+            self._global.consume()
+            if grant[3]:
+                self._bucket(grant[2]).consume()
+            grant[4].set_result(None)
+
+    def _chat_pause_left(self, chat: Any, now: float) -> float:
+        if chat is None or not self._chat_paused:
+            return 0.0
+        until = self._chat_paused.get(chat)
+        if until is None:
+            return 0.0
+        if until <= now:
+            del self._chat_paused[chat]
+            return 0.0
+        return until - now
+
+    async def _acquire(self, prio: int, chat: Any, sends: bool) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._heap, (prio, self._seq, chat, sends, fut))
+        self._wakeup.set()
+        await fut
+
+    @staticmethod
+    def _chat_key(data: Dict[str, Any]) -> Any:
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return None
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return str(chat_id)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == "getUpdates":
+            return await callback(*args, **kwargs)
+        if isinstance(rate_limit_args, int):
+            prio = rate_limit_args
+        elif endpoint in _RL_INTERACTIVE_METHODS:
+            prio = RL_PRIO_INTERACTIVE
+        elif endpoint in _RL_MEDIA_METHODS:
+            prio = RL_PRIO_MEDIA
+        else:
+            prio = RL_PRIO_NORMAL
+        chat = self._chat_key(data)
+        sends = chat is not None and endpoint.startswith(_RL_CHAT_SEND_PREFIXES)
+        replayable = not any(isinstance(v, InputFile) for v in data.values())
+        attempt = 0
+        while True:
+            await self._acquire(prio, chat, sends)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                secs = _retry_after_seconds(e)
+                self.retry_after_hits += 1
+                until = time.monotonic() + secs
+                if chat is not None:
+                    self._chat_paused[chat] = max(self._chat_paused.get(chat, 0.0), until)
+                else:
+                    self._paused_until = max(self._paused_until, until)
+                self._wakeup.set()
+                log.warning("Telegram flood limit (%s, chat=%s): %.0fs pauza", endpoint, chat, secs)
+                if not replayable or attempt >= self.max_retries or secs > UL_RETRY_AFTER_MAX:
+                    raise
+                attempt += 1
+
+    def stats(self) -> str:
+        now = time.monotonic()
+        pending = [it[0] for it in self._heap if not it[4].done()]
+        by_prio = {p: pending.count(p) for p in sorted(set(pending))}
+        paused = max(0.0, self._paused_until - now)
+        paused_chats = sum(1 for until in self._chat_paused.values() if until > now)
+        return (
+            f"queue={by_prio or 0} chats={len(self._chats)} retry_after={self.retry_after_hits} "
+            f"paused={paused:.0f}s paused_chats={paused_chats}"
+        )
+
+
+RATE_LIMITER: Optional[OutboundRateLimiter] = None
+
+
+def _rl_bulk() -> Dict[str, Any]:
+    """kwargs for low-priority (broadcast) calls; rate_limit_args is only allowed with a limiter."""
+    return {"rate_limit_args": RL_PRIO_BULK} if RATE_LIMITER is not None else {}
+
+
+# ---------------------------- Telegram HTTP clients ----------------------------
+# Local Bot API zero-copy'da fayl baytlari emas, file:// yo‘li ketadi — lekin server faylni o‘zi Telegram'ga
+# yuklaguncha javob bermaydi, shuning uchun bu chaqiruvlar ham upload pool'iga.
+_UPLOAD_METHODS = frozenset({
+    "sendVideo", "sendAudio", "sendDocument", "sendPhoto", "sendAnimation", "sendVoice", "sendVideoNote", "sendMediaGroup",
+})
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class _RoutingRequest(BaseRequest):
+    """Sends uploads (multipart bodies, file:// media in local mode) through their own HTTPXRequest
+    and everything else through a control one, so short calls never wait for a pool slot held by
+    a multi-minute upload. Timeouts left at DEFAULT_NONE resolve to the chosen client's own."""
+
+    def __init__(self, control: HTTPXRequest, upload: HTTPXRequest) -> None:
+        self.control = control
+        self.upload = upload
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.control.read_timeout
+
+    async def initialize(self) -> None:
+        await self.control.initialize()
+        await self.upload.initialize()
+
+    async def shutdown(self) -> None:
+        await self.control.shutdown()
+        await self.upload.shutdown()
+
+    def _is_upload(self, url: str, request_data: Optional[RequestData]) -> bool:
+        if request_data is None:
+            return False
+        if request_data.contains_files:
+            return True
+        if url.rsplit("/", 1)[-1] not in _UPLOAD_METHODS:
+            return False
+        return any(isinstance(v, str) and v.startswith("file://") for v in request_data.parameters.values())
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        target = self.upload if self._is_upload(url, request_data) else self.control
+        return await target.do_request(
+            url,
+            method,
+            request_data=request_data,
+            read_timeout=read_timeout,
+            write_timeout=write_timeout,
+            connect_timeout=connect_timeout,
+            pool_timeout=pool_timeout,
+        )
+
+
+def _build_requests() -> Tuple[BaseRequest, HTTPXRequest]:
+    """(bot API request, getUpdates request) from TG_* env."""
+    http_version = "1.1"
+    if TG_HTTP2:
+        if _http2_available():
+            http_version = "2"
+        else:
+            log.warning("TG_HTTP2=1, lekin 'h2' paketi yo‘q (pip install httpx[http2]) — HTTP/1.1 ishlatiladi")
+    control = HTTPXRequest(
+        connection_pool_size=max(1, TG_CONTROL_POOL),
+        connect_timeout=TG_CONNECT_TIMEOUT,
+        read_timeout=TG_CONTROL_TIMEOUT,
+        write_timeout=TG_CONTROL_TIMEOUT,
+        pool_timeout=TG_CONTROL_TIMEOUT,
+        http_version=http_version,
+    )
+    # Local Bot API bilan катта файл юборилганда write/read timeout каттароқ бўлиши керак.
+    upload = HTTPXRequest(
+        connection_pool_size=max(1, TG_UPLOAD_POOL),
+        connect_timeout=TG_CONNECT_TIMEOUT,
+        read_timeout=TG_UPLOAD_TIMEOUT,
+        write_timeout=TG_UPLOAD_TIMEOUT,
+        media_write_timeout=TG_UPLOAD_TIMEOUT,
+        pool_timeout=TG_UPLOAD_TIMEOUT,
+        http_version="1.1",
+    )
+    # getUpdates: bitta long-poll ulanishi; read timeout ustiga PTB poll timeout'ini o‘zi qo‘shadi
+    updates = HTTPXRequest(
+        connection_pool_size=1,
+        connect_timeout=TG_CONNECT_TIMEOUT,
+        read_timeout=TG_UPDATES_TIMEOUT,
+        write_timeout=TG_UPDATES_TIMEOUT,
+        pool_timeout=TG_UPDATES_TIMEOUT,
+        http_version=http_version,
+    )
+    log.info(
+        "Telegram HTTP: control pool=%d (%.0fs), upload pool=%d (%.0fs), HTTP/%s",
+        TG_CONTROL_POOL, TG_CONTROL_TIMEOUT, TG_UPLOAD_POOL, TG_UPLOAD_TIMEOUT, http_version,
+    )
+    return _RoutingRequest(control, upload), updates
+
+
+# ---------------------------- Startup backlog triage ----------------------------
+def _triage_backlog(updates: List[Update], now: float) -> Tuple[List[Update], Dict[int, Tuple[List[int], int]], int]:
+    """Split a pending backlog into what to process and what to drop.
+
+    Returns (kept updates: callback queries first, then the rest in arrival order;
+    {chat_id: (distinct senders, expired requests)} for the apology; number of coalesced duplicates).
+    An expired request is any message in a private chat, and a link or command in a group.
+    """
+    callbacks: List[Update] = []
+    rest: List[Update] = []
+    expired: Dict[int, Tuple[List[int], int]] = {}
+    seen_callbacks: set = set()
+    # (chat_id, normalized url) -> index in rest; keyin kelgani oldingisining o‘rnini egallaydi
+    link_slot: Dict[Tuple[int, str], int] = {}
+    dup = 0
+    for u in updates:
+        if u.callback_query is not None:
+            q = u.callback_query
+            k = (q.from_user.id if q.from_user else 0, q.data or "", q.message.message_id if q.message else 0)
+            if k in seen_callbacks:
+                dup += 1
+                continue
+            seen_callbacks.add(k)
+            callbacks.append(u)
+            continue
+        msg = u.message
+        if msg is None or msg.date is None:
+            rest.append(u)
+            continue
+        url = extract_first_url(msg.text or "") if msg.text and not msg.text.startswith("/") else None
+        if now - msg.date.timestamp() > BACKLOG_MAX_AGE:
+            # guruhda oddiy suhbat so‘rov emas — faqat link va buyruqlar uchun uzr so‘raymiz
+            is_request = msg.chat_id > 0 or url or (msg.text or "").startswith("/")
+            if is_request and msg.from_user:
+                uids, n = expired.get(msg.chat_id, ([], 0))
+                if msg.from_user.id not in uids:
+                    uids.append(msg.from_user.id)
+                expired[msg.chat_id] = (uids, n + 1)
+            continue
+        if url:
+            k2 = (msg.chat_id, _normalize_url_for_cache(url))
+            if k2 in link_slot:
+                rest[link_slot[k2]] = None  # type: ignore[call-overload]
+                dup += 1
+            link_slot[k2] = len(rest)
+        rest.append(u)
+    return callbacks + [u for u in rest if u is not None], expired, dup
+
+async def _drain_backlog(app) -> None:
+    """Fetch the pending updates ourselves before polling/webhook starts, triage them and feed
+    the kept ones to app.update_queue. Fetching with an offset confirms them on Telegram's side,
+    so the updater/webhook does not deliver them a second time."""
+    bot = app.bot
+    try:
+        # getUpdates webhook o‘rnatilgan bo‘lsa ishlamaydi; webhook rejimida run_webhook uni qayta o‘rnatadi
+        await bot.delete_webhook(drop_pending_updates=False)
+    except Exception as e:
+        log.warning("Backlog triage o‘tkazib yuborildi: %s", e)
+        return
+    updates: List[Update] = []
+    # oxirgi batch keyingi offset'li so‘rovgacha Telegram'da tasdiqlanmagan
+    unconfirmed = 0
+    offset: Optional[int] = None
+    try:
+        while len(updates) < BACKLOG_MAX:
+            batch = await bot.get_updates(offset=offset, limit=100, timeout=0, allowed_updates=Update.ALL_TYPES)
+            unconfirmed = 0
+            if not batch:
+                break
+            updates.extend(batch)
+            unconfirmed = len(batch)
+            offset = batch[-1].update_id + 1
+        if unconfirmed:
+            # limitga yetdik — olinganlarni tasdiqlaymiz, qolganini updater odatdagidek oladi
+            await bot.get_updates(offset=offset, limit=1, timeout=0, allowed_updates=Update.ALL_TYPES)
+            unconfirmed = 0
+    except Exception as e:
+        # oldingi batch'lar offset bilan allaqachon tasdiqlangan — ularni tashlab yubormaymiz.
+        # Tasdiqlanmagan oxirgi batch'ni updater qayta yetkazadi (ikki marta bajarilmasin).
+        log.warning("Backlog: get_updates xato, olinganlari (%d) bilan davom etamiz: %s", len(updates) - unconfirmed, e)
+        if unconfirmed:
+            del updates[-unconfirmed:]
+    if not updates:
+        return
+
+    kept, expired, dup = _triage_backlog(updates, _now_ts())
+    log.info(
+        "Backlog: %d ta update — bajariladi %d, eskirgan %d chat, takror %d",
+        len(updates), len(kept), len(expired), dup,
+    )
+    for chat_id, (uids, n) in expired.items():
+        try:
+            # guruhda yozganlar tillari har xil bo‘lsa — ikkala tilda
+            langs = {await STORE.get_lang(uid) for uid in uids}
+            order = [lg for lg in (LANG_UZ, LANG_RU) if lg in langs] or [LANG_UZ]
+            text = "\n\n".join(_t(lg, "backlog_expired", n=n) for lg in order)
+            await bot.send_message(chat_id=chat_id, text=text, **_rl_bulk())
+        except Exception:
+            pass
+    for u in kept:
+        await app.update_queue.put(u)
+
+
 # ---------------------------- App lifecycle ----------------------------
+async def _startup_sweep() -> None:
+    try:
+        WORK_ROOT.mkdir(parents=True, exist_ok=True)
+        await asyncio.get_running_loop().run_in_executor(None, _sweep_stale_workdirs, WORK_ROOT)
+        await asyncio.get_running_loop().run_in_executor(None, UPLOAD_RETRY.prune)
+        log.info("Work dir: %s", DISK_ADMISSION.stats())
+    except Exception as e:
+        log.warning("Work dir tozalash xato: %s", e)
+
 async def _post_init(app):
     await STORE.init()
+    await _startup_sweep()
+    if BACKLOG_TRIAGE:
+        await _drain_backlog(app)
+    if BOT_ROLE == "front" and not STORE.pool:
+        log.warning("BOT_ROLE=front, lekin DB yo‘q — job'lar shu jarayonda bajariladi.")
     try:
         users = await STORE.get_users()
         log.info("Users loaded: %d", len(users))
@@ -2796,14 +6119,14 @@ async def _post_shutdown(app):
     await STORE.close()
 
 def build_app():
-    # Telegram upload vaqtida timeout kamayиши учун timeoutlarni kattalashtiramiz
-    # Local Bot API bilan катта файл юборилганда write_timeout каттароқ бўлиши керак.
-    request = HTTPXRequest(connect_timeout=30, read_timeout=900, write_timeout=900, pool_timeout=30)
+    # getUpdates, tezkor chaqiruvlar va upload'lar — alohida pool/timeout'lar (TG_* env)
+    request, updates_request = _build_requests()
 
     builder = (
         ApplicationBuilder()
         .token(TOKEN)
         .request(request)
+        .get_updates_request(updates_request)
         .post_init(_post_init)
         .post_shutdown(_post_shutdown)
     )
@@ -2815,28 +6138,148 @@ def build_app():
         local_api = local_api.rstrip("/")
         builder = builder.base_url(f"{local_api}/bot").base_file_url(f"{local_api}/file/bot")
         log.info("Telegram API endpoint: %s (LOCAL BOT API)", local_api)
+        if LOCAL_API_ZERO_COPY:
+            # file:// URI'larni PTB faqat local_mode'da qabul qiladi
+            builder = builder.local_mode(True)
+            log.info("Local Bot API zero-copy: %s -> %s", LOCAL_BOT_API_FILES_DIR, LOCAL_BOT_API_SERVER_DIR)
     else:
         log.info("Telegram API endpoint: https://api.telegram.org (cloud)")
 
+    global RATE_LIMITER
+    if TG_RATE_GLOBAL > 0:
+        RATE_LIMITER = OutboundRateLimiter(
+            TG_RATE_GLOBAL, TG_RATE_CHAT, TG_RATE_CHAT_BURST, TG_RATE_GROUP_PER_MIN, TG_RATE_RETRIES
+        )
+        builder = builder.rate_limiter(RATE_LIMITER)
+
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        log.info("Update'lar parallel: %d ta (chat ichida tartib saqlanadi)", UPDATE_CONCURRENCY)
+
     app = builder.build()
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("id", cmd_id))
     app.add_handler(CommandHandler("cacheclear", cmd_cacheclear))
     app.add_handler(CommandHandler("cacheprune", cmd_cacheprune))
+    app.add_handler(CommandHandler("cachestats", cmd_cachestats))
+    app.add_handler(CommandHandler("dlslots", cmd_dlslots))
     app.add_handler(CommandHandler("broadcast", cmd_broadcast))
     app.add_handler(CommandHandler("broadcastpost", cmd_broadcastpost))
     app.add_handler(CommandHandler("broadcastgroup", cmd_broadcastgroup))
     app.add_handler(CommandHandler("broadcastpostgroup", cmd_broadcastpostgroup))
 
     app.add_handler(CallbackQueryHandler(on_lang_button, pattern=r"^lang\|"))
-    app.add_handler(CallbackQueryHandler(on_download_button, pattern=r"^dl\|"))
+    app.add_handler(CallbackQueryHandler(on_download_button, pattern=r"^d[ls]\|"))
+    app.add_handler(CallbackQueryHandler(on_cancel_button, pattern=r"^cx\|"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link))
 
     return app
 
 
+# ---------------------------- Worker (BOT_ROLE=worker) ----------------------------
+
+async def _job_heartbeat(job_id: int) -> None:
+    while True:
+        await asyncio.sleep(max(5, JOB_LEASE_SECONDS // 3))
+        await STORE.heartbeat_job(job_id)
+
+# worker'dagi job'lar: DB id -> (task, cancel_id) (front'da ❌ bosilsa, DB'da 'cancelled' bo‘ladi)
+_CLAIMED_JOBS: Dict[int, Tuple[asyncio.Task, Optional[str]]] = {}
+# foydalanuvchi bekor qilgan job'lar (worker to‘xtashidagi cancel'dan ajratish uchun)
+_CANCELLED_BY_USER: set[int] = set()
+
+async def _run_claimed_job(context: ContextTypes.DEFAULT_TYPE, job_id: int, payload: Dict[str, Any]) -> None:
+    hb = asyncio.create_task(_job_heartbeat(job_id))
+    me = asyncio.current_task()
+    if me is not None:
+        _CLAIMED_JOBS[job_id] = (me, payload.get("cancel_id"))
+    ok = False
+    shutting_down = False
+    try:
+        ok = await _task_download_and_send(context=context, **payload)
+    except asyncio.CancelledError:
+        if job_id not in _CANCELLED_BY_USER:
+            # worker to‘xtayapti: qator 'running' qoladi, lease tugagach boshqa worker qayta oladi
+            shutting_down = True
+            raise
+        log.info("Job #%s bekor qilindi", job_id)
+    except Exception as e:
+        log.exception("Job #%s xato: %s", job_id, e)
+    finally:
+        hb.cancel()
+        _, cancel_id = _CLAIMED_JOBS.pop(job_id, (None, None))
+        if cancel_id:
+            _USER_CANCELLED.discard(cancel_id)
+        _CANCELLED_BY_USER.discard(job_id)
+        if not shutting_down:
+            # 'cancelled' holati finish_job'da ustiga yozilmaydi
+            await STORE.finish_job(job_id, ok)
+
+async def _watch_cancelled_jobs() -> None:
+    while True:
+        await asyncio.sleep(JOB_CANCEL_POLL_SECONDS)
+        ids = list(_CLAIMED_JOBS.keys())
+        for job_id in await STORE.cancelled_job_ids(ids):
+            ent = _CLAIMED_JOBS.get(job_id)
+            if ent is not None and not ent[0].done():
+                t, cancel_id = ent
+                _CANCELLED_BY_USER.add(job_id)
+                if cancel_id:
+                    _USER_CANCELLED.add(cancel_id)
+                t.cancel()
+
+async def _worker_main() -> None:
+    """Consume download jobs from the shared Postgres queue (no update handling here)."""
+    app = build_app()
+    async with app:
+        await STORE.init()
+        await _startup_sweep()
+        if not STORE.pool:
+            raise RuntimeError("BOT_ROLE=worker uchun DATABASE_URL (Postgres) kerak")
+        context = CallbackContext(app)
+        running: set[asyncio.Task] = set()
+        watcher = asyncio.create_task(_watch_cancelled_jobs())
+        last_maint = 0.0
+        log.info("Worker started: %s (slots=%d)", WORKER_ID, DOWNLOAD_SEM.limit)
+        try:
+            while True:
+                if _now_ts() - last_maint > max(10, JOB_LEASE_SECONDS // 2):
+                    last_maint = _now_ts()
+                    n = await STORE.requeue_stale_jobs(JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+                    if n:
+                        log.warning("Stale jobs qayta navbatga: %d", n)
+
+                claimed = None
+                # Adaptive limit: download slotlari + upload bosqichidagilardan ko‘p job olmaymiz
+                # (qolganlari boshqa workerlarga)
+                if len(running) < DOWNLOAD_SEM.limit + max(1, UL_CONCURRENCY):
+                    try:
+                        claimed = await STORE.claim_job(WORKER_ID)
+                    except Exception as e:
+                        log.warning("Job olishda xato: %s", e)
+                if claimed:
+                    job_id, payload = claimed
+                    t = asyncio.create_task(_run_claimed_job(context, job_id, payload))
+                    running.add(t)
+                    t.add_done_callback(running.discard)
+                    continue
+                await asyncio.sleep(JOB_POLL_SECONDS)
+        finally:
+            watcher.cancel()
+            for t in list(running):
+                t.cancel()
+            # stage worker'lar o‘ldirilib, papkalar o‘chishini kutamiz; qatorlar 'running' qoladi (lease)
+            await asyncio.gather(*running, return_exceptions=True)
+            await STORE.close()
+
+
 def main() -> None:
+    if BOT_ROLE == "worker":
+        asyncio.run(_worker_main())
+        return
+
     app = build_app()
+    log.info("Bot role: %s", BOT_ROLE)
     log.info("Bot started. Admins: %s", ",".join(str(x) for x in sorted(ADMIN_IDS)) if ADMIN_IDS else "(not set)")
 
     mode = RUN_MODE